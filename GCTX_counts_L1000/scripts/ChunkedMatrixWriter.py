@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def format_block(labels, values, sep, precision, compression, compression_level):
+    """
+    task: one block of rows as (compressed) csv text, bytes
+    """
+    values = np.asarray(values)
+    nan_rows = np.isnan(values).any(axis=1)
+    if precision is None:
+        #shortest repr of the dtype, as DataFrame.to_csv
+        text = values.astype(str)
+        text[np.isnan(values)] = ''
+        rows = [sep.join(row) for row in text.tolist()]
+    else:
+        value_format = '%.'+str(precision)+'g'
+        row_format = sep.join([value_format]*values.shape[1])
+        rows = [sep.join('' if value != value else value_format % value\
+                         for value in row) if has_nan else row_format % tuple(row)\
+                for row, has_nan in zip(values.tolist(), nan_rows)]
+    lines = [str(label)+sep+row+'\n' for label, row in zip(labels, rows)]
+    return compress_bytes(''.join(lines).encode(), compression, compression_level)
+
+
+def compress_bytes(data, compression, compression_level=None):
+    """
+    data as one gzip member / zstd frame; concatenated members (frames)
+    are read as one stream by gzip, pandas and zstd
+    """
+    if compression == 'gzip':
+        import gzip
+        return gzip.compress(data, mtime=0,\
+                             compresslevel=compression_level or 1)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=compression_level or 3).compress(data)
+    return data
+
+
+class ChunkedMatrixWriter:
+    """
+    Y/P matrix export (genes x experiments) for all pipelines.
+
+    csv: blocks of rows are formatted with a fixed float precision
+    (significant digits) and optionally compressed in a pool of workers
+    (created once per writer), and streamed to disk in order; compression
+    is inferred from the file name (.gz gzip, .zst zstd, which needs the
+    optional zstandard package). gctx/h5: an HDF5 file in
+    gctx layout whose chunks hold whole columns (one chunk read per
+    experiment), gzip compressed.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, precision=6, block_rows=500, n_workers=None,\
+                 executor='thread', compression_level=None):
+        """
+        Parameters
+        ----------
+        precision : significant digits of csv values, int (None: the
+                    shortest repr, as DataFrame.to_csv)
+        block_rows : number of rows per formatting task, int
+        n_workers : number of workers (default: cores)
+        executor : 'thread' (default, no fork of the calling process):
+                   only compression runs in parallel (zlib/zstd release
+                   the GIL), formatting is GIL-bound; 'process' is needed
+                   to format blocks in parallel
+        compression_level : gzip (1-9, default 1) / zstd (1-22, default 3)
+                            level, int
+        """
+        self.precision = precision
+        self.block_rows = block_rows
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.executor = executor
+        self.compression_level = compression_level
+        self.pool = None
+
+    def __getstate__(self):
+        #the pool stays with the process that created it
+        state = dict(self.__dict__)
+        state['pool'] = None
+        return state
+
+    def get_pool(self):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        if self.pool is None:
+            pool_class = ProcessPoolExecutor if self.executor == 'process'\
+                else ThreadPoolExecutor
+            self.pool = pool_class(self.n_workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def compression(self, output_file):
+        if output_file.endswith('.gz'):
+            return 'gzip'
+        if output_file.endswith('.zst'):
+            #fail before any block is formatted
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError('.zst exports need the zstandard package')
+            return 'zstd'
+        return None
+
+    def write(self, matrix_df, output_file, sep='\t'):
+        """
+        Parameters
+        ----------
+        matrix_df : pd dataframe genes x experiments
+        output_file : .csv/.tsv (optionally .gz/.zst) or .gctx/.h5, str
+
+        Returns
+        -------
+        output_file
+        """
+        if output_file.endswith(('.gctx', '.h5', '.hdf5')):
+            return self.write_gctx(matrix_df, output_file)
+        values = matrix_df.values
+        labels = matrix_df.index.values
+        blocks = ((labels[start:start+self.block_rows],\
+                   values[start:start+self.block_rows])\
+                  for start in range(0, len(matrix_df), self.block_rows))
+        return self.write_csv_blocks(output_file, matrix_df.index.name,\
+                                     matrix_df.columns, blocks, sep)
+
+    def write_csv_blocks(self, output_file, index_name, columns, blocks, sep='\t'):
+        """
+        stream (labels, values) blocks of rows as csv (DataFrame.to_csv
+        layout: index name and columns in the header row)
+        """
+        from collections import deque
+
+        compression = self.compression(output_file)
+        header = sep.join([index_name or '']+[str(column) for column in columns])+'\n'
+        args = (sep, self.precision, compression, self.compression_level)
+
+        tmp_file = output_file+'.tmp'
+        with open(tmp_file, 'wb') as csv_file:
+            csv_file.write(compress_bytes(header.encode(), compression,\
+                                          self.compression_level))
+            if self.n_workers == 1:
+                for labels, values in blocks:
+                    csv_file.write(format_block(labels, values, *args))
+            else:
+                #bounded number of blocks in flight, written in order
+                pool = self.get_pool()
+                pending = deque()
+                for labels, values in blocks:
+                    pending.append(pool.submit(format_block, labels, values, *args))
+                    if len(pending) >= 2*self.n_workers:
+                        csv_file.write(pending.popleft().result())
+                while pending:
+                    csv_file.write(pending.popleft().result())
+        os.replace(tmp_file, output_file)
+        return output_file
+
+    def write_gctx(self, matrix_df, output_file, chunk_bytes=1 << 20):
+        """
+        gctx layout (/0/DATA/0/matrix experiments x genes, float32);
+        duplicated experiment labels (replicates) get '.N' suffixes in
+        META/COL/id, the labels are kept in META/COL/label
+        """
+        import h5py
+
+        values = np.asarray(matrix_df.values, dtype=np.float32)
+        num_rows, num_cols = values.shape
+        chunk_cols = int(min(num_cols, max(1, chunk_bytes//(4*max(num_rows, 1)))))
+        labels = pd.Series(matrix_df.columns.astype(str))
+        occurrence = labels.groupby(labels).cumcount()
+        col_ids = labels.where(occurrence == 0, labels+'.'+occurrence.astype(str))
+
+        #(chunked datasets cannot be empty)
+        storage = dict(chunks=(chunk_cols, num_rows), compression='gzip',\
+                       compression_opts=self.compression_level or 4, shuffle=True)\
+            if values.size else {}
+
+        tmp_file = output_file+'.tmp'
+        with h5py.File(tmp_file, 'w') as gctx_file:
+            gctx_file.attrs['version'] = 'GCTX1.0'
+            gctx_file.create_dataset('/0/DATA/0/matrix', data=values.T, **storage)
+            gctx_file.create_dataset('/0/META/ROW/id',\
+                                     data=np.asarray(matrix_df.index.astype(str), dtype='S'))
+            gctx_file.create_dataset('/0/META/COL/id', data=np.asarray(col_ids, dtype='S'))
+            gctx_file.create_dataset('/0/META/COL/label', data=np.asarray(labels, dtype='S'))
+            if 'replicates' in matrix_df.attrs:
+                gctx_file.create_dataset('/0/META/COL/replicate',\
+                                         data=np.asarray(matrix_df.attrs['replicates'],\
+                                                         dtype=np.int32))
+        os.replace(tmp_file, output_file)
+        return output_file
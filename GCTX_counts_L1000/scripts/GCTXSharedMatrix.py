@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+
+
+class GCTXSharedMatrix:
+    """
+    Data matrix of a GCToo instance (plus row/col ids and int32 metadata
+    codes) published in multiprocessing.shared_memory.
+
+    The publishing process owns the segments; worker processes attach
+    with the (small, picklable) handle and get read-only numpy views,
+    so N workers share one copy of the data and nothing is pickled but
+    the handle. Workers should be started by the publishing process
+    (e.g. a ProcessPoolExecutor), which then unlinks the segments.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, handle, segments, owner):
+        self.handle = handle
+        self.segments = segments
+        self.owner = owner
+
+        self.arrays = {}
+        for name, (shm_name, shape, dtype) in handle['arrays'].items():
+            array = np.ndarray(shape, dtype=dtype, buffer=segments[name].buf)
+            if not owner:
+                array.flags.writeable = False
+            self.arrays[name] = array
+
+        self.data = self.arrays['data']
+        self.row_ids = self.arrays['row_ids']
+        self.col_ids = self.arrays['col_ids']
+        self.codes = {column: self.arrays['code_'+column]\
+                      for column in handle['labels']}
+
+    @classmethod
+    def publish(cls, data_df, codes=None, labels=None):
+        """
+        Parameters
+        ----------
+        data_df : pd dataframe genes x columns
+        codes : int32 metadata codes per column, {column: np array}
+        labels : labels of the codes, {column: list}
+
+        Returns
+        -------
+        owning GCTXSharedMatrix
+
+        """
+        codes = codes or {}
+        arrays = {'data': np.ascontiguousarray(data_df.values),
+                  'row_ids': np.asarray(data_df.index, dtype=str),
+                  'col_ids': np.asarray(data_df.columns, dtype=str)}
+        for column, column_codes in codes.items():
+            arrays['code_'+column] = np.asarray(column_codes, dtype=np.int32)
+
+        segments = {}
+        handle = {'arrays': {}, 'labels': {}}
+        for name, array in arrays.items():
+            segment = shared_memory.SharedMemory(create=True,\
+                                                 size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            segments[name] = segment
+            handle['arrays'][name] = (segment.name, array.shape, array.dtype.str)
+        for column in codes:
+            handle['labels'][column] = list((labels or {}).get(column, []))
+
+        return cls(handle, segments, owner=True)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        read-only views of published arrays (zero-copy)
+        """
+        segments = {name: shared_memory.SharedMemory(name=shm_name)\
+                    for name, (shm_name, shape, dtype) in handle['arrays'].items()}
+        return cls(handle, segments, owner=False)
+
+    def data_df(self):
+        """
+        pd dataframe view of the data matrix (genes x columns)
+        """
+        return pd.DataFrame(self.data, index=pd.Index(self.row_ids),\
+                            columns=pd.Index(self.col_ids), copy=False)
+
+    def decode(self, column, codes=None):
+        """
+        string labels of the codes of a metadata column
+        """
+        codes = self.codes[column] if codes is None else codes
+        return np.asarray(self.handle['labels'][column], dtype=object)[codes]
+
+    def close(self):
+        """
+        drop the views and detach; the owner also unlinks the segments
+        """
+        self.arrays = {}
+        self.data = self.row_ids = self.col_ids = None
+        self.codes = {}
+        for segment in self.segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self.segments = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
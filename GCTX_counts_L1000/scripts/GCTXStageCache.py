@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+
+class GCTXStageCache:
+    """
+    Content-addressed on-disk cache for GCToo intermediates
+    (cell-line subsets, filtered and merged replicates).
+
+    Keys are hashes of the input file identity (path, size, mtime)
+    or of the upstream cache key, plus the stage parameters.
+    Each entry is a directory with the data matrix as .npy and the
+    row/col metadata as pickles; entries are evicted least recently
+    used first once the cache grows above max_bytes.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, cache_dir, max_bytes=50*1024**3):
+        """
+        Parameters
+        ----------
+        cache_dir : directory to keep cache entries in, str
+        max_bytes : size bound of the cache, int
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_identity(self, file_name):
+        """
+        identity of an input file: absolute path, size and mtime
+        """
+        file_stat = os.stat(file_name)
+        return [os.path.abspath(file_name), file_stat.st_size,\
+                file_stat.st_mtime_ns]
+
+    def make_key(self, stage, input_files=(), input_keys=(), **params):
+        """
+        Parameters
+        ----------
+        stage : name of the stage, str
+        input_files : files read by the stage, list of str
+        input_keys : cache keys of upstream intermediates, list of str
+        params : stage parameters (json-serialisable)
+
+        Returns
+        -------
+        hex digest, str
+
+        """
+        key_content = {'stage': stage,
+                       'files': [self.file_identity(f) for f in input_files],
+                       'inputs': list(input_keys),
+                       'params': params}
+        return hashlib.sha1(json.dumps(key_content, sort_keys=True,\
+                                       default=str).encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        list of GCToo instances stored under key, None if missing
+        """
+        import cmapPy.pandasGEXpress.GCToo as GCToo
+
+        entry_dir = self.entry_dir(key)
+        if not os.path.exists(os.path.join(entry_dir, 'manifest.json')):
+            return None
+        with open(os.path.join(entry_dir, 'manifest.json')) as manifest_file:
+            num_of_parts = json.load(manifest_file)['parts']
+
+        gctoo_instances = []
+        for part in range(num_of_parts):
+            part_name = os.path.join(entry_dir, str(part))
+            row_meta_data = pd.read_pickle(part_name+'_row.pkl')
+            col_meta_data = pd.read_pickle(part_name+'_col.pkl')
+            data_df = pd.DataFrame(np.load(part_name+'_data.npy'),\
+                                   index=row_meta_data.index,\
+                                   columns=col_meta_data.index)
+            gctoo_instance = GCToo.GCToo(data_df=data_df,\
+                                         row_metadata_df=row_meta_data,\
+                                         col_metadata_df=col_meta_data)
+            gctoo_instance.cache_key = key
+            gctoo_instances.append(gctoo_instance)
+
+        #mark as recently used
+        os.utime(os.path.join(entry_dir, 'manifest.json'))
+        return gctoo_instances
+
+    def put(self, key, gctoo_instances):
+        """
+        store a list of GCToo instances under key, then evict
+        """
+        entry_dir = self.entry_dir(key)
+        tmp_dir = entry_dir+'.tmp%d_%d' % (os.getpid(), threading.get_ident())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        for part, gctoo_instance in enumerate(gctoo_instances):
+            part_name = os.path.join(tmp_dir, str(part))
+            np.save(part_name+'_data.npy', gctoo_instance.data_df.values)
+            gctoo_instance.row_metadata_df.to_pickle(part_name+'_row.pkl',\
+                                                     protocol=4)
+            gctoo_instance.col_metadata_df.to_pickle(part_name+'_col.pkl',\
+                                                     protocol=4)
+            gctoo_instance.cache_key = key
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump({'parts': len(gctoo_instances)}, manifest_file)
+
+        #publish atomically
+        if os.path.exists(entry_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.replace(tmp_dir, entry_dir)
+
+        self.evict(keep=key)
+        return gctoo_instances
+
+    def evict(self, keep=None):
+        """
+        remove least recently used entries until the cache fits max_bytes
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            manifest_file = os.path.join(self.entry_dir(key), 'manifest.json')
+            if not os.path.exists(manifest_file):
+                continue
+            entry_size = sum(entry.stat().st_size for entry in\
+                             os.scandir(self.entry_dir(key)))
+            entries.append((os.stat(manifest_file).st_mtime, key, entry_size))
+
+        cache_size = sum(entry[2] for entry in entries)
+        for _, key, entry_size in sorted(entries):
+            if cache_size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            cache_size -= entry_size
+
+        return cache_size
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class GeneSpiderBundle:
+    """
+    GeneSpider dataset (Y expression matrix genes x experiments, sparse
+    P perturbation matrix, gene and experiment labels, replicate of each
+    experiment, provenance) in one binary file.
+
+    Layout: 8 magic bytes, header length (uint64), json header (labels,
+    replicates, provenance, array offsets), then the arrays (Y C-order,
+    P rows/cols/values) at 64-byte aligned offsets. load maps Y with
+    np.memmap, so opening a 12k x 50k matrix reads the header only;
+    to_csv writes the tab-separated Y/P files of the csv export.
+
+    @author: Erik Zhivkoplias
+    """
+
+    magic = b'GSBNDL01'
+    alignment = 64
+
+    def __init__(self, Y, genes, experiments, P_rows=None, P_cols=None,\
+                 P_values=None, P_shape=None, P_genes=None, P_experiments=None,\
+                 replicates=None, provenance=None, gene_index_name=None):
+        """
+        Parameters
+        ----------
+        Y : np array (or memmap) genes x experiments
+        genes, experiments : labels of Y, list of str
+        P_rows, P_cols, P_values : nonzero entries of P (coordinates)
+        P_shape : shape of P, default Y.shape
+        P_genes, P_experiments : labels of P, default those of Y
+        replicates : replicate of each experiment, list of int
+        provenance : source files, parameters etc., json-serialisable dict
+        """
+        self.Y = Y
+        self.genes = [str(gene) for gene in genes]
+        self.experiments = [str(experiment) for experiment in experiments]
+        self.P_rows = np.asarray(P_rows if P_rows is not None else [], dtype=np.int32)
+        self.P_cols = np.asarray(P_cols if P_cols is not None else [], dtype=np.int32)
+        self.P_values = np.asarray(P_values if P_values is not None else [],\
+                                   dtype=np.float32)
+        self.P_shape = tuple(P_shape) if P_shape is not None else tuple(Y.shape)
+        self.P_genes = [str(gene) for gene in P_genes]\
+            if P_genes is not None else self.genes
+        self.P_experiments = [str(experiment) for experiment in P_experiments]\
+            if P_experiments is not None else self.experiments
+        self.replicates = [int(rep) for rep in replicates]\
+            if replicates is not None else None
+        self.provenance = dict(provenance or {})
+        self.gene_index_name = gene_index_name
+
+    @classmethod
+    def from_matrices(cls, Y_df, P_df=None, replicates=None, provenance=None,\
+                      dtype=np.float32):
+        """
+        Parameters
+        ----------
+        Y_df : pd dataframe genes x experiments
+        P_df : pd dataframe perturbation design (dense), stored sparse
+        replicates : replicate of each experiment (column of Y_df)
+        provenance : json-serialisable dict
+        dtype : dtype of the stored Y matrix
+
+        Returns
+        -------
+        GeneSpiderBundle
+        """
+        P_args = {}
+        if P_df is not None:
+            P_values = np.asarray(P_df.values, dtype=np.float32)
+            P_rows, P_cols = np.nonzero(P_values)
+            P_args = dict(P_rows=P_rows, P_cols=P_cols,\
+                          P_values=P_values[P_rows, P_cols], P_shape=P_values.shape,\
+                          P_genes=list(P_df.index), P_experiments=list(P_df.columns))
+        if replicates is not None and len(replicates) != Y_df.shape[1]:
+            raise ValueError('one replicate per experiment (column) is required')
+        return cls(np.ascontiguousarray(Y_df.values, dtype=dtype), list(Y_df.index),\
+                   list(Y_df.columns), replicates=replicates, provenance=provenance,\
+                   gene_index_name=Y_df.index.name, **P_args)
+
+    def write(self, bundle_file):
+        """
+        write the bundle (via a temporary file, replaced when complete)
+
+        Returns
+        -------
+        bundle_file
+        """
+        import time
+
+        arrays = {'Y': np.ascontiguousarray(self.Y), 'P_rows': self.P_rows,\
+                  'P_cols': self.P_cols, 'P_values': self.P_values}
+        offsets = {}
+        offset = 0
+        for name, array in arrays.items():
+            offsets[name] = [offset, list(array.shape), array.dtype.str]
+            offset += -(-array.nbytes//self.alignment)*self.alignment
+
+        provenance = dict(self.provenance)
+        provenance.setdefault('created', time.strftime('%Y-%m-%dT%H:%M:%S'))
+        header = json.dumps({'genes': self.genes, 'experiments': self.experiments,\
+                             'gene_index_name': self.gene_index_name,\
+                             'P_shape': list(self.P_shape), 'P_genes': self.P_genes,\
+                             'P_experiments': self.P_experiments,\
+                             'replicates': self.replicates,\
+                             'provenance': provenance, 'arrays': offsets}).encode()
+        data_start = -(-(len(self.magic)+8+len(header))//self.alignment)*self.alignment
+
+        tmp_file = bundle_file+'.tmp'
+        with open(tmp_file, 'wb') as bundle:
+            bundle.write(self.magic)
+            bundle.write(np.uint64(len(header)).tobytes())
+            bundle.write(header)
+            for name, array in arrays.items():
+                bundle.seek(data_start + offsets[name][0])
+                bundle.write(array.tobytes())
+            bundle.truncate(data_start + offset)
+        os.replace(tmp_file, bundle_file)
+        return bundle_file
+
+    @classmethod
+    def load(cls, bundle_file, mmap=True):
+        """
+        Parameters
+        ----------
+        bundle_file : name of the bundle, str
+        mmap : map Y read-only instead of reading it, bool
+
+        Returns
+        -------
+        GeneSpiderBundle
+        """
+        with open(bundle_file, 'rb') as bundle:
+            if bundle.read(len(cls.magic)) != cls.magic:
+                raise ValueError(bundle_file+' is not a GeneSpider bundle')
+            header_length = int(np.frombuffer(bundle.read(8), dtype=np.uint64)[0])
+            header = json.loads(bundle.read(header_length).decode())
+            data_start = -(-(len(cls.magic)+8+header_length)//cls.alignment)*\
+                cls.alignment
+
+            arrays = {}
+            for name, (offset, shape, dtype) in header['arrays'].items():
+                if name == 'Y' and mmap and np.prod(shape) > 0:
+                    arrays[name] = np.memmap(bundle_file, dtype=dtype, mode='r',\
+                                             offset=data_start+offset, shape=tuple(shape))
+                else:
+                    bundle.seek(data_start+offset)
+                    arrays[name] = np.fromfile(bundle, dtype=dtype,\
+                                               count=int(np.prod(shape))).reshape(shape)
+
+        return cls(arrays['Y'], header['genes'], header['experiments'],\
+                   arrays['P_rows'], arrays['P_cols'], arrays['P_values'],\
+                   header['P_shape'], header['P_genes'], header['P_experiments'],\
+                   header['replicates'], header['provenance'],\
+                   header['gene_index_name'])
+
+    def Y_df(self):
+        """
+        pd dataframe view of Y (genes x experiments), no copy of a mapped Y
+        """
+        index = pd.Index(self.genes, name=self.gene_index_name)
+        return pd.DataFrame(self.Y, index=index, columns=self.experiments, copy=False)
+
+    def P_df(self):
+        """
+        dense pd dataframe of P
+        """
+        P_values = np.zeros(self.P_shape, dtype=np.float32)
+        P_values[self.P_rows, self.P_cols] = self.P_values
+        return pd.DataFrame(P_values, index=self.P_genes, columns=self.P_experiments)
+
+    def to_csv(self, Y_file, P_file=None, sep='\t'):
+        """
+        csv export of Y (and P, if given and present)
+        """
+        self.Y_df().to_csv(Y_file, index=True, header=True, sep=sep)
+        if P_file is not None and len(self.P_values):
+            self.P_df().to_csv(P_file, index=True, header=True, sep=sep)
+        return Y_file
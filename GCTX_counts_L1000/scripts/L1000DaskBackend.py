@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+#parser of a worker process, created by its first task
+worker_parser = None
+
+
+def read_column_block(L1000_gctx_file, ridx, block_idx):
+    """
+    task: read sorted column indices of a gctx file, rows x columns float32
+    """
+    import h5py
+    global worker_parser
+    if worker_parser is None:
+        from PandasGCTXParserL1000 import PandasGCTXParserL1000
+        worker_parser = PandasGCTXParserL1000()
+
+    with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+        return worker_parser.read_gctx_block(gctx_file['/0/DATA/0/matrix'],\
+                                             block_idx, ridx)
+
+
+def block_slot_sums(L1000_gctx_file, ridx, block_idx, block_slots):
+    """
+    task: read a column block and sum its columns per slot (merged
+    column or control set)
+
+    Returns
+    -------
+    slots present in the block, np array slots x rows (float64)
+
+    """
+    block = read_column_block(L1000_gctx_file, ridx, block_idx)
+    local_slots, local_inverse = np.unique(block_slots, return_inverse=True)
+    local_sum = np.zeros((len(local_slots), block.shape[0]))
+    np.add.at(local_sum, local_inverse, block.T)
+    return local_slots, local_sum
+
+
+class L1000DaskBackend:
+    """
+    Optional out-of-core backend (dask.distributed) for full-dataset
+    processing of level 3/4 gctx files across all cell lines.
+
+    The gctx file is split into column-block tasks; filtering and
+    grouping are resolved from the metadata (PandasGCTXParserL1000
+    plan_lvl4_FC), workers read blocks and return per group sums,
+    which are reduced as they complete, and fold changes are exported
+    per cell line (write_lvl4_FC). A LocalCluster of processes is
+    started by default; pass a scheduler address to use a multi-node
+    cluster (workers need the gctx file at the same path).
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, scheduler_address=None, n_workers=None,\
+                 threads_per_worker=1, gparser=None):
+        """
+        Parameters
+        ----------
+        scheduler_address : address of a running dask scheduler, e.g.
+                            'tcp://10.0.0.1:8786'; a LocalCluster if None
+        n_workers : number of local worker processes (default: cores)
+        threads_per_worker : threads per local worker, int
+        gparser : PandasGCTXParserL1000 instance (created if None)
+        """
+        from dask.distributed import Client, LocalCluster
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+        self.gparser = gparser
+
+        self.cluster = None
+        if scheduler_address is None:
+            self.cluster = LocalCluster(n_workers=n_workers,\
+                                        threads_per_worker=threads_per_worker,\
+                                        processes=True)
+            self.client = Client(self.cluster)
+        else:
+            self.client = Client(scheduler_address)
+
+    def close(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column_blocks(self, L1000_gctx_file, rid, cid, block_size=2000):
+        """
+        row indices and sorted column indices of each block
+
+        Returns
+        -------
+        ridx, list of block column indices, column ids (file order)
+
+        """
+        import h5py
+
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            ridx = self.gparser.read_gctx_ids(gctx_file, 'ROW').get_indexer(list(rid))
+            col_ids = self.gparser.read_gctx_ids(gctx_file, 'COL')
+        cidx = np.sort(col_ids.get_indexer(list(cid)))
+        if (ridx < 0).any() or (cidx < 0).any():
+            raise ValueError('ids not found in '+L1000_gctx_file)
+        blocks = [cidx[start:start+block_size]\
+                  for start in range(0, len(cidx), block_size)]
+        return ridx, blocks, col_ids[cidx]
+
+    def gctx_array(self, L1000_gctx_file, rid, cid, block_size=2000):
+        """
+        lazy dask array (rows x columns, float32) of a gctx subset, one
+        task per column block
+
+        Returns
+        -------
+        dask array, column ids (file order)
+
+        """
+        import dask
+        import dask.array as da
+
+        ridx, blocks, cids = self.column_blocks(L1000_gctx_file, rid, cid, block_size)
+        return da.concatenate([da.from_delayed(dask.delayed(read_column_block)\
+                                (L1000_gctx_file, ridx, block_idx),\
+                                shape=(len(ridx), len(block_idx)), dtype=np.float32)\
+                               for block_idx in blocks], axis=1), cids
+
+    def stream_lvl4_FC(self, list_of_cell_lines, L1000_gctx_file, gene_info_file,\
+                       inst_info_file, output_files, list_of_plates=("X1","X2","X3"),\
+                       num_of_plates=3, min_shRNAs_num=1, hrs="96",\
+                       fold_change=True, block_size=2000, row_chunk=100):
+        """
+        PandasGCTXParserL1000.stream_lvl4_FC for many cell lines in one
+        distributed pass over the gctx file
+
+        Parameters
+        ----------
+        list_of_cell_lines : names of the cell lines, list of str
+        output_files : Y matrix (csv) of each cell line, {cell_line: str}
+        other parameters : see PandasGCTXParserL1000.stream_lvl4_FC
+
+        Returns
+        -------
+        output_files
+
+        """
+        from dask.distributed import as_completed
+
+        #filter/merge groups from metadata; slots: merged columns of
+        #every cell line, then one control slot per cell line
+        plans = {}
+        slot_cids = []
+        slot_of_cid = []
+        num_slots = 0
+        for cell_line in list_of_cell_lines:
+            plan = self.gparser.plan_lvl4_FC(cell_line, gene_info_file,\
+                        inst_info_file, list_of_plates, num_of_plates,\
+                        min_shRNAs_num, hrs)
+            plan['first_slot'] = num_slots
+            plan['ctrl_slot'] = num_slots + plan['num_groups']
+            slot_cids += [plan['trt_cids'], plan['ctrl_cids']]
+            slot_of_cid += [num_slots + plan['group_inverse'],\
+                            np.full(len(plan['ctrl_cids']), plan['ctrl_slot'])]
+            num_slots = plan['ctrl_slot'] + 1
+            plans[cell_line] = plan
+        slot_of_cid = pd.Series(np.concatenate(slot_of_cid),\
+                                index=np.concatenate(slot_cids))
+
+        #rows: union of the Y matrix rows of all cell lines
+        rid = pd.Index(np.unique(np.concatenate([plan['landmark_gene'].index\
+                                                 for plan in plans.values()])))
+        ridx, blocks, cids = self.column_blocks(L1000_gctx_file, rid,\
+                                                slot_of_cid.index, block_size)
+
+        #one task per column block, partial sums reduced as they arrive
+        acc = np.zeros((num_slots, len(rid)))
+        block_starts = np.cumsum([0]+[len(block_idx) for block_idx in blocks])
+        futures = [self.client.submit(block_slot_sums, L1000_gctx_file, ridx,\
+                       block_idx, slot_of_cid[cids[block_starts[block_num]:\
+                           block_starts[block_num+1]]].values, pure=False)\
+                   for block_num, block_idx in enumerate(blocks)]
+        for future in as_completed(futures):
+            local_slots, local_sum = future.result()
+            acc[local_slots] += local_sum
+            future.release()
+
+        #fold changes and export per cell line
+        for cell_line, plan in plans.items():
+            gene_idx = rid.get_indexer(plan['landmark_gene'].index)
+            group_slots = slice(plan['first_slot'], plan['ctrl_slot'])
+            self.gparser.write_lvl4_FC(plan, acc[group_slots][:, gene_idx],\
+                                       acc[plan['ctrl_slot'], gene_idx],\
+                                       output_files[cell_line], fold_change, row_chunk)
+        return output_files
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+
+
+class L1000GeneInference:
+    """
+    Linear landmark -> inferred gene model, so that full-gene matrices
+    can be computed from landmark-only subsets (read_gctx_data reads
+    978 of 12328 rows).
+
+    The model (weights landmarks x genes and intercepts) is a ridge
+    regression fitted on a sample of columns of a gctx file that stores
+    inferred values (e.g. Level3_INF_mlr12k), from normal equations
+    accumulated over column blocks. It is applied as one matrix
+    multiplication per column block, and can be validated against the
+    stored inferred values of held-out columns.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, model_file):
+        """
+        Parameters
+        ----------
+        model_file : .npz file of the model, str
+        """
+        self.model_file = model_file
+        self.weights = None
+        if os.path.exists(model_file):
+            self.load_model()
+
+    def load_model(self):
+        with np.load(self.model_file, allow_pickle=False) as model:
+            self.weights = model['weights']
+            self.intercepts = model['intercepts']
+            self.landmark_ids = pd.Index(model['landmark_ids'])
+            self.target_ids = pd.Index(model['target_ids'])
+            self.target_symbols = model['target_symbols']
+            self.train_cids = pd.Index(model['train_cids'])
+        return self
+
+    def fit(self, L1000_gctx_file, gene_info_file, num_train=20000, ridge=1.0,\
+            bing_only=False, block_size=2000, seed=0, gparser=None):
+        """
+        Parameters
+        ----------
+        L1000_gctx_file : gctx file with landmark and inferred rows, str
+        gene_info_file : name of gene annotation file, str
+        num_train : number of columns sampled for training, int
+        ridge : ridge penalty on the weights (not the intercepts), float
+        bing_only : predict best inferred genes only (pr_is_bing), bool
+        block_size : number of columns per block, int
+        seed : random seed of the column sample, int
+        gparser : PandasGCTXParserL1000 instance (created if None)
+
+        Returns
+        -------
+        self
+
+        """
+        import h5py
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+
+        gene_info = pd.read_csv(gene_info_file, sep="\t", dtype=str)
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            row_ids = gparser.read_gctx_ids(gctx_file, 'ROW')
+            col_ids = gparser.read_gctx_ids(gctx_file, 'COL')
+        gene_info = gene_info[gene_info["pr_gene_id"].isin(row_ids)]
+        landmarks = gene_info[gene_info["pr_is_lm"] == "1"]
+        targets = gene_info[gene_info["pr_is_lm"] != "1"]
+        if bing_only:
+            targets = targets[targets["pr_is_bing"] == "1"]
+
+        #at most half of the columns, the rest is left for validation
+        rng = np.random.default_rng(seed)
+        train_cids = col_ids[np.sort(rng.choice(len(col_ids),\
+                             min(num_train, len(col_ids)//2), replace=False))]
+
+        #normal equations with an intercept column
+        num_landmarks = len(landmarks)
+        xtx = np.zeros((num_landmarks+1, num_landmarks+1))
+        xty = np.zeros((num_landmarks+1, len(targets)))
+        rid = list(landmarks["pr_gene_id"])+list(targets["pr_gene_id"])
+        for cids, block in gparser.read_gctx_column_blocks(L1000_gctx_file, rid,\
+                train_cids, block_size):
+            x = np.vstack([block[:num_landmarks], np.ones((1, block.shape[1]))])
+            xtx += x @ x.T
+            xty += x @ block[num_landmarks:].T.astype(np.float64)
+        penalty = ridge*np.eye(num_landmarks+1)
+        penalty[-1, -1] = 0
+        solution = np.linalg.solve(xtx + penalty, xty)
+
+        np.savez(self.model_file,\
+                 weights=solution[:-1].astype(np.float32),\
+                 intercepts=solution[-1].astype(np.float32),\
+                 landmark_ids=landmarks["pr_gene_id"].values.astype(str),\
+                 target_ids=targets["pr_gene_id"].values.astype(str),\
+                 target_symbols=targets["pr_gene_symbol"].values.astype(str),\
+                 train_cids=np.asarray(train_cids, dtype=str))
+        #np.savez adds .npz to names without it
+        if not self.model_file.endswith('.npz'):
+            os.replace(self.model_file+'.npz', self.model_file)
+
+        return self.load_model()
+
+    def predict(self, landmark_df, block_size=10000):
+        """
+        Parameters
+        ----------
+        landmark_df : pd dataframe landmark genes (pr_gene_id) x columns
+        block_size : number of columns per matrix multiplication, int
+
+        Returns
+        -------
+        pd dataframe inferred genes (pr_gene_id) x columns, float32
+
+        """
+        landmark_idx = landmark_df.index.astype(str).get_indexer(self.landmark_ids)
+        if (landmark_idx < 0).any():
+            raise ValueError('landmark genes of the model are missing')
+        landmark_values = landmark_df.values
+
+        inferred = np.empty((len(self.target_ids), landmark_df.shape[1]),\
+                            dtype=np.float32)
+        for start in range(0, landmark_df.shape[1], block_size):
+            block = landmark_values[landmark_idx, start:start+block_size]\
+                .astype(np.float32)
+            inferred[:, start:start+block_size] = self.weights.T @ block +\
+                self.intercepts[:, None]
+        return pd.DataFrame(inferred, index=self.target_ids,\
+                            columns=landmark_df.columns)
+
+    def apply(self, gctoo_instance, block_size=10000):
+        """
+        gctoo instance with landmark rows extended by the inferred genes
+        (row metadata: pr_gene_symbol, pr_is_lm = "0")
+        """
+        import cmapPy.pandasGEXpress.GCToo as GCToo
+
+        inferred = self.predict(gctoo_instance.data_df, block_size)
+        inferred_meta = pd.DataFrame({'pr_gene_symbol': self.target_symbols,\
+                                      'pr_is_lm': '0'}, index=self.target_ids)
+        inferred_meta.index.name = gctoo_instance.row_metadata_df.index.name
+        row_meta_data = pd.concat([gctoo_instance.row_metadata_df, inferred_meta])
+        data_df = pd.concat([gctoo_instance.data_df.astype(np.float32), inferred])
+        data_df.index.name = gctoo_instance.data_df.index.name
+
+        return GCToo.GCToo(data_df=data_df, row_metadata_df=row_meta_data,\
+                           col_metadata_df=gctoo_instance.col_metadata_df)
+
+    def validate(self, L1000_gctx_file, num_columns=1000, block_size=2000,\
+                 seed=1, report_file=None, gparser=None):
+        """
+        compare predictions with the stored inferred values of a sample
+        of columns that were not used for training
+
+        Returns
+        -------
+        pd dataframe per inferred gene with pearson_r, rmse and the
+        standard deviation of the stored values
+
+        """
+        import h5py
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            col_ids = gparser.read_gctx_ids(gctx_file, 'COL')
+        held_out = col_ids[~col_ids.isin(self.train_cids)]
+        if len(held_out) == 0:
+            raise ValueError('no held-out columns in '+L1000_gctx_file)
+        rng = np.random.default_rng(seed)
+        sample_cids = held_out[rng.choice(len(held_out),\
+                               min(num_columns, len(held_out)), replace=False)]
+
+        stored = []
+        predicted = []
+        rid = list(self.landmark_ids)+list(self.target_ids)
+        for cids, block in gparser.read_gctx_column_blocks(L1000_gctx_file, rid,\
+                sample_cids, block_size):
+            landmark_df = pd.DataFrame(block[:len(self.landmark_ids)],\
+                                       index=self.landmark_ids)
+            predicted.append(self.predict(landmark_df).values)
+            stored.append(block[len(self.landmark_ids):])
+        stored = np.hstack(stored).astype(np.float64)
+        predicted = np.hstack(predicted).astype(np.float64)
+
+        stored_centred = stored - stored.mean(axis=1, keepdims=True)
+        predicted_centred = predicted - predicted.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(stored_centred, axis=1)*\
+            np.linalg.norm(predicted_centred, axis=1)
+        report = pd.DataFrame({'pr_gene_symbol': self.target_symbols,\
+            'pearson_r': (stored_centred*predicted_centred).sum(axis=1)/\
+                np.where(norms > 0, norms, np.nan),\
+            'rmse': np.sqrt(((stored - predicted)**2).mean(axis=1)),\
+            'stored_sd': stored.std(axis=1)},\
+            index=pd.Index(self.target_ids, name='pr_gene_id'))
+
+        print('inferred genes: '+str(len(report))+', validation columns: '+\
+              str(stored.shape[1])+', median pearson r: '+\
+              str(round(report['pearson_r'].median(), 3)))
+        if report_file is not None:
+            report.to_csv(report_file, sep='\t')
+        return report
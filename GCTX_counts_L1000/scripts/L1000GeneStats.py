@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class L1000GeneStats:
+    """
+    Sidecar index of per-gene population statistics of a gctx file,
+    grouped by column metadata (default cell_id x pert_type).
+
+    A streaming pass over column blocks keeps, per group and gene,
+    the count, mean and sum of squared deviations (Welford updates,
+    merged across blocks with Chan's formula), min, max and a fixed-bin
+    histogram sketch for quantiles and MAD. The result is a small .npz
+    file next to the gctx, so later stages look statistics up (also
+    pooled over several groups, e.g. all controls of a cell line)
+    instead of rescanning the matrix.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, stats_file):
+        """
+        Parameters
+        ----------
+        stats_file : sidecar file, e.g. gctx+'.stats.npz', str
+        """
+        self.stats_file = stats_file
+        self.groups = None
+        if os.path.exists(stats_file):
+            self.load_stats()
+
+    def load_stats(self):
+        with np.load(self.stats_file, allow_pickle=False) as stats:
+            self.params = json.loads(str(stats['params']))
+            self.genes = pd.Index(stats['genes'], name='pr_gene_id')
+            self.groups = pd.DataFrame(stats['groups'],\
+                                       columns=self.params['group_by'])
+            for name in ['count', 'mean', 'm2', 'min', 'max', 'hist']:
+                setattr(self, name, stats[name])
+        self.edges = np.linspace(self.params['range'][0], self.params['range'][1],\
+                                 self.params['num_bins']+1)
+        return self
+
+    def build(self, L1000_gctx_file, gene_info_file, col_info_file,\
+              group_by=('cell_id', 'pert_type'), landmark_only=True,\
+              num_bins=128, value_range=None, block_size=5000, gparser=None):
+        """
+        Parameters
+        ----------
+        L1000_gctx_file : name of gctx file, str
+        gene_info_file : name of gene annotation file, str
+        col_info_file : inst_info (level 3/4) or sig_info (level 5) file, str
+        group_by : column metadata to group signatures by, list of str
+        landmark_only : keep statistics of the landmark genes only, bool
+        num_bins : number of histogram bins per group and gene, int
+        value_range : histogram range (values outside go to the end
+                      bins); if None, the global min/max from a first
+                      pass over the file (two reads)
+        block_size : number of columns per block, int
+        gparser : PandasGCTXParserL1000 instance (created if None)
+
+        Returns
+        -------
+        self
+
+        """
+        import h5py
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+
+        group_by = list(group_by)
+        gene_info = pd.read_csv(gene_info_file, sep="\t", dtype=str)
+        col_info = pd.read_csv(col_info_file, sep="\t", dtype=str)
+        id_column = 'sig_id' if 'sig_id' in col_info.columns else 'inst_id'
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            row_ids = gparser.read_gctx_ids(gctx_file, 'ROW')
+            col_ids = gparser.read_gctx_ids(gctx_file, 'COL')
+        if landmark_only:
+            row_ids = row_ids[row_ids.isin(gene_info.loc[gene_info["pr_is_lm"]\
+                                                         == "1", "pr_gene_id"])]
+
+        #group code of every column, -1 if it has no metadata
+        col_info = col_info.drop_duplicates(id_column).set_index(id_column)\
+            .reindex(col_ids)
+        group_codes, groups = pd.MultiIndex.from_frame(col_info[group_by]\
+                                                       .fillna('NA')).factorize()
+        group_codes = pd.Series(group_codes, index=col_ids)
+
+        num_groups, num_genes = len(groups), len(row_ids)
+        self.count = np.zeros(num_groups, dtype=np.int64)
+        self.mean = np.zeros((num_groups, num_genes))
+        self.m2 = np.zeros((num_groups, num_genes))
+        self.min = np.full((num_groups, num_genes), np.inf)
+        self.max = np.full((num_groups, num_genes), -np.inf)
+        self.hist = np.zeros((num_groups, num_genes, num_bins), dtype=np.uint32)
+        gene_offsets = (np.arange(num_genes)*num_bins)[:, None]
+
+        if value_range is None:
+            #one range for all blocks, so that the histograms can be merged
+            lo, hi = np.inf, -np.inf
+            for cids, block in gparser.read_gctx_column_blocks(L1000_gctx_file,\
+                    row_ids, col_ids, block_size):
+                lo, hi = np.fmin(lo, np.nanmin(block)), np.fmax(hi, np.nanmax(block))
+            value_range = (float(lo), float(hi))
+        if not np.isfinite(value_range).all() or value_range[1] <= value_range[0]:
+            raise ValueError('histogram range must have a positive width: '+\
+                             str(value_range))
+        bin_width = (value_range[1] - value_range[0])/num_bins
+
+        for cids, block in gparser.read_gctx_column_blocks(L1000_gctx_file,\
+                row_ids, col_ids, block_size):
+            block_codes = group_codes[cids].values
+            for group in np.unique(block_codes):
+                values = block[:, block_codes == group].astype(np.float64)
+                self.merge_block(group, values)
+
+                #(missing values are not counted)
+                measured = ~np.isnan(values)
+                bins = np.clip(((np.where(measured, values, value_range[0]) -\
+                                 value_range[0])/bin_width).astype(np.int64),\
+                               0, num_bins-1)
+                self.hist[group] += np.bincount((gene_offsets + bins).ravel(),\
+                    weights=measured.ravel(), minlength=num_genes*num_bins)\
+                    .reshape(num_genes, num_bins).astype(np.uint32)
+
+        self.params = {'source': os.path.abspath(L1000_gctx_file),
+                       'group_by': group_by, 'num_bins': num_bins,
+                       'range': list(value_range)}
+        np.savez(self.stats_file, params=json.dumps(self.params),\
+                 genes=np.asarray(row_ids, dtype=str),\
+                 groups=np.asarray(groups.tolist(), dtype=str)\
+                     .reshape(num_groups, len(group_by)),\
+                 count=self.count, mean=self.mean, m2=self.m2,\
+                 min=self.min, max=self.max, hist=self.hist)
+        #np.savez adds .npz to names without it
+        if not self.stats_file.endswith('.npz'):
+            os.replace(self.stats_file+'.npz', self.stats_file)
+
+        return self.load_stats()
+
+    def merge_block(self, group, values):
+        """
+        merge count, mean and m2 of a block (genes x columns) into a group
+        """
+        block_count = values.shape[1]
+        block_mean = values.mean(axis=1)
+        block_m2 = ((values - block_mean[:, None])**2).sum(axis=1)
+
+        count = self.count[group] + block_count
+        delta = block_mean - self.mean[group]
+        self.mean[group] += delta*block_count/count
+        self.m2[group] += block_m2 + delta**2*self.count[group]*block_count/count
+        self.count[group] = count
+        self.min[group] = np.minimum(self.min[group], values.min(axis=1))
+        self.max[group] = np.maximum(self.max[group], values.max(axis=1))
+
+    def select_groups(self, **group_values):
+        """
+        boolean mask of groups matching metadata values, e.g.
+        select_groups(cell_id='HEPG2', pert_type=['ctl_vector'])
+        """
+        mask = np.ones(len(self.groups), dtype=bool)
+        for column, values in group_values.items():
+            if isinstance(values, str):
+                values = [values]
+            mask &= self.groups[column].isin(values).values
+        return mask
+
+    def pooled(self, mask):
+        """
+        count, mean, m2, min, max and histogram pooled over groups
+        """
+        count = 0
+        mean = np.zeros(len(self.genes))
+        m2 = np.zeros(len(self.genes))
+        for group in np.flatnonzero(mask):
+            if self.count[group] == 0:
+                continue
+            total = count + self.count[group]
+            delta = self.mean[group] - mean
+            mean = mean + delta*self.count[group]/total
+            m2 = m2 + self.m2[group] + delta**2*count*self.count[group]/total
+            count = total
+        return count, mean, m2, self.min[mask].min(axis=0),\
+            self.max[mask].max(axis=0), self.hist[mask].sum(axis=0, dtype=np.int64)
+
+    def hist_quantile(self, hist, q, value_min, value_max):
+        """
+        per-gene quantile of histograms (genes x bins), linear within bins
+        """
+        cdf = np.cumsum(hist, axis=1)
+        target = q*cdf[:, -1]
+        bins = np.minimum((cdf < target[:, None]).sum(axis=1), hist.shape[1]-1)
+        rows = np.arange(len(hist))
+        below = np.where(bins > 0, cdf[rows, bins-1], 0)
+        fraction = (target - below)/np.maximum(hist[rows, bins], 1)
+        values = self.edges[bins] + fraction*(self.edges[1]-self.edges[0])
+        return np.clip(values, value_min, value_max)
+
+    def stats(self, quantiles=(0.25, 0.5, 0.75), **group_values):
+        """
+        Parameters
+        ----------
+        quantiles : quantiles estimated from the histogram sketch, list
+        group_values : metadata values of the pooled groups, e.g.
+                       cell_id='HEPG2' (all groups if empty)
+
+        Returns
+        -------
+        pd dataframe genes x (count, mean, var, std, min, max, quantiles, mad)
+
+        """
+        mask = self.select_groups(**group_values)
+        if not mask.any():
+            raise ValueError('no group matches '+str(group_values))
+        count, mean, m2, value_min, value_max, hist = self.pooled(mask)
+
+        stats = pd.DataFrame({'count': count, 'mean': mean,\
+                              'var': m2/max(count-1, 1)}, index=self.genes)
+        stats['std'] = np.sqrt(stats['var'])
+        stats['min'] = value_min
+        stats['max'] = value_max
+        for q in quantiles:
+            stats['q'+str(q)] = self.hist_quantile(hist, q, value_min, value_max)
+
+        #mad: weighted median of |bin centre - median|
+        median = self.hist_quantile(hist, 0.5, value_min, value_max)
+        centres = (self.edges[:-1] + self.edges[1:])/2
+        deviations = np.abs(centres[None, :] - median[:, None])
+        order = np.argsort(deviations, axis=1)
+        cdf = np.cumsum(np.take_along_axis(hist, order, axis=1), axis=1)
+        mad_bins = (cdf < cdf[:, -1:]/2).sum(axis=1)
+        stats['mad'] = np.take_along_axis(deviations, order, axis=1)\
+            [np.arange(len(hist)), mad_bins]
+        return stats
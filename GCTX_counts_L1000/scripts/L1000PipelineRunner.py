@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import pickle
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class L1000PipelineRunner:
+    """
+    Small incremental stage graph for the L1000 driver
+    (read -> filter -> select/merge -> FC -> export).
+
+    Every stage gets a key: a hash of its name, parameters, input file
+    identities and the keys of the stages it depends on. Keys of the
+    last successful run are kept in a json manifest, and a stage is
+    re-executed only if its key changed or its output is gone, so
+    changing one cell line, one parameter or one input file re-runs
+    only the stages downstream of it.
+
+    run_pipelined overlaps I/O and compute across groups of targets
+    (e.g. cell lines): a prefetch thread runs the 'read' stages of the
+    next groups, the main thread computes, and a writer thread runs the
+    'write' stages, with bounded queues in between.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, manifest_file, artifact_dir):
+        """
+        Parameters
+        ----------
+        manifest_file : json file with stage keys of the last run, str
+        artifact_dir : directory for pickled stage outputs, str
+        """
+        self.manifest_file = manifest_file
+        self.artifact_dir = artifact_dir
+        os.makedirs(artifact_dir, exist_ok=True)
+
+        self.manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+
+        self.stages = {}
+        self.keys = {}
+        self.outputs = {}
+        self.executed = []
+        #manifest and executed list are shared with the I/O threads
+        self.lock = threading.RLock()
+
+    def add_stage(self, name, func, deps=(), input_files=(), output_files=(),\
+                  persist=True, kind='compute', **params):
+        """
+        Parameters
+        ----------
+        name : unique stage name, e.g. 'HEPG2/lvl3/filter', str
+        func : callable, called as func(*outputs_of_deps, **params)
+        deps : names of upstream stages, list of str
+        input_files : files read by the stage, list of str
+        output_files : files written by the stage, list of str
+        persist : pickle the stage output; stages that are cheap to
+                  recompute (e.g. served from GCTXStageCache) can skip it
+        kind : 'read', 'compute' or 'write', thread of the stage in
+               run_pipelined
+        params : stage parameters (json-serialisable)
+
+        Returns
+        -------
+        name
+
+        """
+        self.stages[name] = {'func': func, 'deps': list(deps),\
+                             'input_files': list(input_files),\
+                             'output_files': list(output_files),\
+                             'persist': persist, 'kind': kind,\
+                             'params': params}
+        return name
+
+    def stage_key(self, name):
+        """
+        hash of stage name, params, input files and upstream keys
+        """
+        if name not in self.keys:
+            stage = self.stages[name]
+            file_ids = []
+            for input_file in stage['input_files']:
+                file_stat = os.stat(input_file)
+                file_ids.append([os.path.abspath(input_file),\
+                                 file_stat.st_size, file_stat.st_mtime_ns])
+            key_content = {'name': name,
+                           'func': getattr(stage['func'], '__qualname__',\
+                                           repr(stage['func'])),
+                           'params': stage['params'],
+                           'files': file_ids,
+                           'deps': [self.stage_key(dep) for dep in stage['deps']]}
+            self.keys[name] = hashlib.sha1(json.dumps(key_content,\
+                sort_keys=True, default=str).encode()).hexdigest()
+        return self.keys[name]
+
+    def artifact_file(self, name):
+        return os.path.join(self.artifact_dir,\
+                            hashlib.sha1(name.encode()).hexdigest()+'.pkl')
+
+    def is_up_to_date(self, name):
+        stage = self.stages[name]
+        if self.manifest.get(name) != self.stage_key(name):
+            return False
+        if not all(os.path.exists(f) for f in stage['output_files']):
+            return False
+        if stage['persist'] and not os.path.exists(self.artifact_file(name)):
+            return False
+        return all(self.is_up_to_date(dep) for dep in stage['deps'])
+
+    def output(self, name):
+        """
+        output of a stage: in memory, from its artifact if up to date,
+        otherwise (re-)computed from the outputs of its deps
+        """
+        if name in self.outputs:
+            return self.outputs[name]
+
+        stage = self.stages[name]
+        if self.is_up_to_date(name) and stage['persist']:
+            with open(self.artifact_file(name), 'rb') as f:
+                self.outputs[name] = pickle.load(f)
+            return self.outputs[name]
+
+        print('running '+name)
+        dep_outputs = [self.output(dep) for dep in stage['deps']]
+        return self.execute(name, dep_outputs)
+
+    def execute(self, name, dep_outputs):
+        """
+        run a stage on the outputs of its deps, store and record it
+        """
+        stage = self.stages[name]
+        output = stage['func'](*dep_outputs, **stage['params'])
+        self.outputs[name] = output
+
+        if stage['persist']:
+            with open(self.artifact_file(name), 'wb') as f:
+                pickle.dump(output, f, protocol=4)
+        with self.lock:
+            self.executed.append(name)
+            self.manifest[name] = self.stage_key(name)
+            self.save_manifest()
+
+        return output
+
+    def stages_to_run(self, name, stages=None):
+        """
+        stages that output(name) would execute, in dependency order
+        """
+        if stages is None:
+            stages = []
+        if name in self.outputs or name in stages:
+            return stages
+        stage = self.stages[name]
+        if stage['persist'] and self.is_up_to_date(name):
+            return stages
+        for dep in stage['deps']:
+            self.stages_to_run(dep, stages)
+        stages.append(name)
+        return stages
+
+    def save_manifest(self):
+        tmp_file = self.manifest_file+'.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+    def run(self, targets=None):
+        """
+        bring targets (default: stages nobody depends on) up to date
+
+        Returns
+        -------
+        names of the stages that were executed, list
+
+        """
+        if targets is None:
+            all_deps = set(dep for stage in self.stages.values()\
+                           for dep in stage['deps'])
+            targets = [name for name in self.stages if name not in all_deps]
+
+        self.executed = []
+        for name in targets:
+            if not self.is_up_to_date(name):
+                self.output(name)
+        return self.executed
+
+    def run_pipelined(self, groups, prefetch_depth=1, write_depth=2):
+        """
+        bring groups of targets up to date, one group after the other,
+        overlapping the reads of the next groups and the writes of the
+        previous ones with the compute of the current group
+
+        Parameters
+        ----------
+        groups : targets per group (e.g. per cell line), list of lists
+        prefetch_depth : number of groups read ahead, int
+        write_depth : number of write stages queued before compute
+                      waits for the writer, int
+
+        Returns
+        -------
+        names of the stages that were executed, list
+
+        """
+        self.executed = []
+        plans = []
+        for targets in groups:
+            plan = []
+            for name in targets:
+                if not self.is_up_to_date(name):
+                    self.stages_to_run(name, plan)
+            plans.append(plan)
+        #outputs still needed by later groups are kept in memory
+        needed_later = [set() for _ in plans]
+        for group_num in range(len(plans)-2, -1, -1):
+            needed_later[group_num] = needed_later[group_num+1] |\
+                set(plans[group_num+1]) |\
+                set(dep for name in plans[group_num+1]\
+                    for dep in self.stages[name]['deps'])
+
+        read_futures = {}
+        pending_writes = deque()
+        with ThreadPoolExecutor(max_workers=1) as reader,\
+                ThreadPoolExecutor(max_workers=1) as writer:
+            for group_num, plan in enumerate(plans):
+                for ahead in range(group_num, min(group_num+prefetch_depth+1,\
+                                                  len(plans))):
+                    if ahead not in read_futures:
+                        read_futures[ahead] = [reader.submit(self.output, name)\
+                            for name in plans[ahead]\
+                            if self.stages[name]['kind'] == 'read']
+                for future in read_futures.pop(group_num):
+                    future.result()
+
+                for name in plan:
+                    stage = self.stages[name]
+                    if stage['kind'] == 'read':
+                        continue
+                    if stage['kind'] != 'write':
+                        self.output(name)
+                        continue
+                    #writer gets the dep outputs, so they can be released
+                    print('running '+name)
+                    pending_writes.append(writer.submit(self.execute, name,\
+                        [self.output(dep) for dep in stage['deps']]))
+                    while len(pending_writes) > write_depth:
+                        pending_writes.popleft().result()
+
+                for name in plan:
+                    if name not in needed_later[group_num]:
+                        self.outputs.pop(name, None)
+
+            while pending_writes:
+                pending_writes.popleft().result()
+        return self.executed
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class L1000RankStore:
+    """
+    Precomputed per-signature gene ranks of a gctx file, int16.
+
+    Ranks are computed once while streaming column blocks and stored as
+    memory-mapped blocks (signatures x genes). Rank 1 is the lowest value
+    in a signature (as rankdata in calc_pert_rank, so a knocked down
+    target has rank 1); ties are broken in gene order. Up/down gene sets
+    are scored against all signatures at once with the rank based
+    Kolmogorov-Smirnov connectivity score of Lamb et al. (2006).
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, store_dir):
+        """
+        Parameters
+        ----------
+        store_dir : directory of the rank store, e.g. gctx+'.ranks', str
+        """
+        self.store_dir = store_dir
+        self.manifest = None
+        if os.path.exists(os.path.join(store_dir, 'manifest.json')):
+            self.load_store()
+
+    def load_store(self):
+        with open(os.path.join(self.store_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.sig_ids = pd.Index(np.load(os.path.join(self.store_dir, 'sig_ids.npy')))
+        self.genes = pd.read_csv(os.path.join(self.store_dir, 'genes.txt'),\
+                                 sep='\t', dtype=str)
+        self.blocks = [np.load(os.path.join(self.store_dir, block_file),\
+                               mmap_mode='r')\
+                       for block_file in self.manifest['blocks']]
+        self.block_starts = np.cumsum([0]+[len(b) for b in self.blocks])
+        return self
+
+    def rank_block(self, block):
+        """
+        ascending ordinal ranks of the columns of a block (genes x
+        signatures), returned as signatures x genes, int16
+        """
+        order = np.argsort(block.T, axis=1, kind='stable')
+        ranks = np.empty(order.shape, dtype=np.int16)
+        np.put_along_axis(ranks, order, np.arange(1, order.shape[1]+1,\
+                                                  dtype=np.int16)[None, :], axis=1)
+        return ranks
+
+    def build_store(self, L1000_gctx_file, gene_info_file, landmark_only=False,\
+                    block_size=20000, gparser=None):
+        """
+        Parameters
+        ----------
+        L1000_gctx_file : name of gctx file, str
+        gene_info_file : name of gene annotation file, str
+        landmark_only : rank the landmark genes only, bool
+        block_size : number of signatures per block, int
+        gparser : PandasGCTXParserL1000 instance (created if None)
+
+        Returns
+        -------
+        self
+
+        """
+        import h5py
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        gene_info = pd.read_csv(gene_info_file, sep="\t", dtype=str)
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            row_ids = gparser.read_gctx_ids(gctx_file, 'ROW')
+            all_sig_ids = gparser.read_gctx_ids(gctx_file, 'COL')
+        genes = gene_info.set_index("pr_gene_id").reindex(row_ids)\
+            .rename_axis("pr_gene_id").reset_index()
+        if landmark_only:
+            genes = genes[genes["pr_is_lm"] == "1"]
+        if len(genes) > np.iinfo(np.int16).max:
+            raise ValueError('too many genes for int16 ranks')
+
+        block_files = []
+        sig_ids = []
+        for block_num, (cids, block) in enumerate(gparser.read_gctx_column_blocks\
+                (L1000_gctx_file, genes["pr_gene_id"], all_sig_ids, block_size)):
+            block_file = 'block_%05d.npy' % block_num
+            np.save(os.path.join(self.store_dir, block_file), self.rank_block(block))
+            block_files.append(block_file)
+            sig_ids.append(cids)
+
+        np.save(os.path.join(self.store_dir, 'sig_ids.npy'),\
+                np.concatenate(sig_ids).astype(str))
+        genes[["pr_gene_id", "pr_gene_symbol"]].to_csv\
+            (os.path.join(self.store_dir, 'genes.txt'), sep='\t', index=False)
+        with open(os.path.join(self.store_dir, 'manifest.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(L1000_gctx_file),
+                       'blocks': block_files,
+                       'ranks': 'ascending, ordinal, 1 = lowest'}, f)
+
+        return self.load_store()
+
+    def gene_positions(self, genes):
+        """
+        store columns of genes given as pr_gene_id or pr_gene_symbol;
+        unknown genes are dropped
+        """
+        genes = pd.Index([str(gene) for gene in genes])
+        if genes.isin(self.genes["pr_gene_id"]).any():
+            gene_ids = pd.Index(self.genes["pr_gene_id"])
+        else:
+            gene_ids = pd.Index(self.genes["pr_gene_symbol"])
+        positions = gene_ids.get_indexer(genes)
+        return np.unique(positions[positions >= 0])
+
+    def lookup(self, sig_ids, genes=None):
+        """
+        ranks of signatures, pd dataframe genes x signatures, int16
+        """
+        sig_nums = self.sig_ids.get_indexer(list(sig_ids))
+        if (sig_nums < 0).any():
+            raise ValueError('sig_ids not found in '+self.store_dir)
+        gene_nums = np.arange(len(self.genes)) if genes is None\
+            else self.gene_positions(genes)
+
+        ranks = np.empty((len(sig_nums), len(gene_nums)), dtype=np.int16)
+        block_nums = np.searchsorted(self.block_starts, sig_nums, side='right')-1
+        for block_num in np.unique(block_nums):
+            in_block = block_nums == block_num
+            ranks[in_block] = self.blocks[block_num]\
+                [sig_nums[in_block] - self.block_starts[block_num]][:, gene_nums]
+        return pd.DataFrame(ranks.T, index=self.genes["pr_gene_id"].values[gene_nums],\
+                            columns=list(sig_ids))
+
+    def ks_score(self, ranks, num_genes):
+        """
+        Kolmogorov-Smirnov enrichment of a gene set in every signature
+
+        Parameters
+        ----------
+        ranks : ascending ranks of the set genes, np array signatures x genes
+        num_genes : length of the ranked lists, int
+
+        Returns
+        -------
+        np array of ks scores, positive if the set is up-regulated
+
+        """
+        #positions in the descending list, sorted per signature
+        positions = np.sort(num_genes + 1 - ranks.astype(np.float64), axis=1)
+        set_size = positions.shape[1]
+        set_nums = np.arange(1, set_size+1)
+        a = (set_nums/set_size - positions/num_genes).max(axis=1)
+        b = (positions/num_genes - (set_nums-1)/set_size).max(axis=1)
+        return np.where(a > b, a, -b)
+
+    def connectivity(self, up_genes, down_genes):
+        """
+        Parameters
+        ----------
+        up_genes : up-regulated genes of the query (pr_gene_id or symbol)
+        down_genes : down-regulated genes of the query
+
+        Returns
+        -------
+        pd dataframe indexed by sig_id with ks_up, ks_down, score and
+        connectivity (score scaled to [-1, 1])
+
+        """
+        up_nums = self.gene_positions(up_genes)
+        down_nums = self.gene_positions(down_genes)
+        if len(up_nums) == 0 or len(down_nums) == 0:
+            raise ValueError('no query genes found in '+self.store_dir)
+
+        ks_up = []
+        ks_down = []
+        for block in self.blocks:
+            ks_up.append(self.ks_score(block[:, up_nums], len(self.genes)))
+            ks_down.append(self.ks_score(block[:, down_nums], len(self.genes)))
+        scores = pd.DataFrame({'ks_up': np.concatenate(ks_up),\
+                               'ks_down': np.concatenate(ks_down)},\
+                              index=pd.Index(self.sig_ids, name='sig_id'))
+
+        scores['score'] = np.where(np.sign(scores['ks_up']) ==\
+                                   np.sign(scores['ks_down']), 0,\
+                                   scores['ks_up'] - scores['ks_down'])
+        max_score, min_score = scores['score'].max(), scores['score'].min()
+        scores['connectivity'] = 0.0
+        if max_score > 0:
+            scores.loc[scores['score'] > 0, 'connectivity'] =\
+                scores['score']/max_score
+        if min_score < 0:
+            scores.loc[scores['score'] < 0, 'connectivity'] =\
+                -scores['score']/min_score
+        return scores
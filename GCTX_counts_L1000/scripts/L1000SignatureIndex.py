@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class L1000SignatureIndex:
+    """
+    Persistent approximate nearest neighbour index (IVF with product
+    quantisation, numpy only) over normalised level 5 signatures.
+
+    Signatures come from an L1000SignatureQuery block store (centred,
+    unit norm landmark vectors), so inner product == Pearson correlation.
+    A coarse spherical k-means splits signatures into n_lists inverted
+    lists; residuals to the list centroid are encoded with n_subspaces
+    byte codes. The index is saved next to the gctx file and memory-mapped
+    at query time. n_probe (number of lists scanned) tunes recall; exact
+    re-ranking against the stored vectors is optional.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, index_dir):
+        """
+        Parameters
+        ----------
+        index_dir : directory of the index, e.g. default_index_dir(gctx), str
+        """
+        self.index_dir = index_dir
+        self.store = None
+        if os.path.exists(os.path.join(index_dir, 'index.json')):
+            self.load_index()
+
+    @staticmethod
+    def default_index_dir(L1000_gctx_file):
+        return L1000_gctx_file+'.ivfpq'
+
+    def load_index(self):
+        from L1000SignatureQuery import L1000SignatureQuery
+
+        with open(os.path.join(self.index_dir, 'index.json')) as f:
+            self.params = json.load(f)
+        for name in ['centroids', 'codebooks', 'list_offsets']:
+            setattr(self, name, np.load(os.path.join(self.index_dir, name+'.npy')))
+        for name in ['codes', 'order']:
+            setattr(self, name, np.load(os.path.join(self.index_dir, name+'.npy'),\
+                                        mmap_mode='r'))
+        self.store = L1000SignatureQuery(self.params['store_dir'])
+        return self
+
+    def kmeans(self, vectors, num_clusters, num_iter, rng, spherical=False):
+        """
+        Lloyd k-means; spherical (cosine) assignment for unit vectors
+        """
+        num_clusters = min(num_clusters, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+        for _ in range(num_iter):
+            labels = self.assign(vectors, centroids, spherical)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            counts = np.bincount(labels, minlength=num_clusters)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty]/counts[~empty, None]
+            #re-seed empty clusters
+            centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+            if spherical:
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1,\
+                                                       keepdims=True), 1e-12)
+        return centroids
+
+    def assign(self, vectors, centroids, spherical=False, chunk=65536):
+        labels = np.empty(len(vectors), dtype=np.int64)
+        half_norms = 0 if spherical else (centroids**2).sum(axis=1)/2
+        for start in range(0, len(vectors), chunk):
+            scores = vectors[start:start+chunk] @ centroids.T - half_norms
+            labels[start:start+chunk] = scores.argmax(axis=1)
+        return labels
+
+    def split(self, vectors):
+        """
+        vectors zero-padded and split into n_subspaces, (m, n, dsub)
+        """
+        num_subspaces = self.params['n_subspaces']
+        dsub = self.params['dsub']
+        padded = np.zeros((len(vectors), num_subspaces*dsub), dtype=np.float32)
+        padded[:, :vectors.shape[1]] = vectors
+        return padded.reshape(len(vectors), num_subspaces, dsub).transpose(1, 0, 2)
+
+    def encode(self, residuals):
+        codes = np.empty((len(residuals), self.params['n_subspaces']), dtype=np.uint8)
+        for sub_num, sub_vectors in enumerate(self.split(residuals)):
+            codes[:, sub_num] = self.assign(sub_vectors, self.codebooks[sub_num])
+        return codes
+
+    def build(self, signature_store, n_lists=1024, n_subspaces=64, n_train=100000,\
+              n_iter=20, seed=0):
+        """
+        Parameters
+        ----------
+        signature_store : L1000SignatureQuery with a built block store
+        n_lists : number of inverted lists (coarse centroids), int
+        n_subspaces : number of byte codes per signature, int
+        n_train : number of signatures sampled to train the quantisers, int
+        n_iter : k-means iterations, int
+        seed : random seed, int
+
+        Returns
+        -------
+        self
+
+        """
+        rng = np.random.default_rng(seed)
+        self.store = signature_store
+        num_sigs = len(signature_store.sig_ids)
+        num_genes = signature_store.blocks[0].shape[1]
+        self.params = {'store_dir': os.path.abspath(signature_store.store_dir),
+                       'n_lists': n_lists, 'n_subspaces': n_subspaces,
+                       'dsub': int(np.ceil(num_genes/n_subspaces)),
+                       'n_genes': num_genes}
+
+        #train quantisers on a sample
+        train = self.vectors(np.sort(rng.choice(num_sigs, min(n_train, num_sigs),\
+                                                replace=False)))
+        self.centroids = self.kmeans(train, n_lists, n_iter, rng, spherical=True)
+        train_residuals = train - self.centroids[self.assign(train, self.centroids,\
+                                                             spherical=True)]
+        self.codebooks = np.stack([self.kmeans(sub_vectors, 256, n_iter, rng)\
+            for sub_vectors in self.split(train_residuals)]).astype(np.float32)
+
+        #assign and encode all signatures, block by block
+        lists = []
+        codes = []
+        for block in signature_store.blocks:
+            block = np.asarray(block)
+            block_lists = self.assign(block, self.centroids, spherical=True)
+            lists.append(block_lists)
+            codes.append(self.encode(block - self.centroids[block_lists]))
+        lists = np.concatenate(lists)
+        order = np.argsort(lists, kind='stable')
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        np.save(os.path.join(self.index_dir, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(self.index_dir, 'codebooks.npy'), self.codebooks)
+        np.save(os.path.join(self.index_dir, 'list_offsets.npy'),\
+                np.concatenate([[0], np.cumsum(np.bincount(lists,\
+                    minlength=len(self.centroids)))]))
+        np.save(os.path.join(self.index_dir, 'order.npy'), order)
+        np.save(os.path.join(self.index_dir, 'codes.npy'), np.concatenate(codes)[order])
+        with open(os.path.join(self.index_dir, 'index.json'), 'w') as f:
+            json.dump(self.params, f)
+
+        return self.load_index()
+
+    def vectors(self, sig_nums):
+        """
+        stored (normalised) vectors of sorted signature indices
+        """
+        block_nums = np.searchsorted(self.store.block_starts, sig_nums, side='right')-1
+        return np.concatenate([np.asarray(self.store.blocks[block_num]\
+            [sig_nums[block_nums == block_num] - self.store.block_starts[block_num]])\
+            for block_num in np.unique(block_nums)]).astype(np.float32)
+
+    def search(self, query, k, n_probe, rerank, rerank_factor):
+        """
+        top-k (signature indices, scores) of one normalised query
+        """
+        coarse_scores = self.centroids @ query
+        probe = np.argpartition(-coarse_scores, min(n_probe, len(coarse_scores))-1)\
+            [:n_probe]
+
+        #asymmetric distance: lookup tables of query . codeword
+        lookup = np.einsum('md,mcd->mc', self.split(query[None, :])[:, 0, :],\
+                           self.codebooks)
+        candidates = []
+        scores = []
+        for list_num in probe:
+            start, end = self.list_offsets[list_num], self.list_offsets[list_num+1]
+            if start == end:
+                continue
+            list_codes = np.asarray(self.codes[start:end])
+            scores.append(coarse_scores[list_num] +\
+                lookup[np.arange(lookup.shape[0]), list_codes].sum(axis=1))
+            candidates.append(np.asarray(self.order[start:end]))
+        if not candidates:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        candidates = np.concatenate(candidates)
+        scores = np.concatenate(scores)
+
+        num_keep = min(k*rerank_factor if rerank else k, len(scores))
+        top = np.argpartition(-scores, num_keep-1)[:num_keep]
+        candidates, scores = candidates[top], scores[top]
+        if rerank:
+            sorted_candidates = np.sort(candidates)
+            scores = self.vectors(sorted_candidates) @ query
+            candidates = sorted_candidates
+        top = np.argsort(-scores)[:k]
+        return candidates[top], scores[top]
+
+    def query(self, query_signatures, k=50, n_probe=16, rerank=True,\
+              rerank_factor=4, sig_info_file=None):
+        """
+        Parameters
+        ----------
+        query_signatures : pd dataframe genes x queries (or a pd series)
+        k : number of signatures per query, int
+        n_probe : number of inverted lists scanned (recall knob), int
+        rerank : re-rank candidates with exact correlations, bool
+        rerank_factor : candidates re-ranked per requested hit, int
+        sig_info_file : GSE92742_Broad_LINCS_sig_info.txt, to attach metadata
+
+        Returns
+        -------
+        pd dataframe with query, rank, sig_id, score (+ sig_info columns)
+
+        """
+        if isinstance(query_signatures, pd.Series):
+            query_signatures = query_signatures.to_frame()
+        queries = self.store.align_queries(query_signatures)
+
+        hits = []
+        for query_name, query in zip(query_signatures.columns, queries):
+            sig_nums, scores = self.search(query, k, n_probe, rerank, rerank_factor)
+            for rank, (sig_num, score) in enumerate(zip(sig_nums, scores)):
+                hits.append((query_name, rank+1, self.store.sig_ids[sig_num], score))
+        hits = pd.DataFrame(hits, columns=['query', 'rank', 'sig_id', 'score'])
+
+        if sig_info_file is not None:
+            sig_info = pd.read_csv(sig_info_file, sep="\t", dtype=str)
+            hits = hits.merge(sig_info, on='sig_id', how='left')
+        return hits
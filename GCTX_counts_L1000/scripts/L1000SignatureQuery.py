@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import heapq
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+class L1000SignatureQuery:
+    """
+    Exact batched similarity (Pearson) queries against level 5 signatures
+    (e.g. GSE92742_Broad_LINCS_Level5_COMPZ.MODZ).
+
+    The landmark matrix is normalised once (centred, unit norm per
+    signature) into a store of float32 column blocks, so that a
+    correlation is a dot product. Query batches are answered with one
+    matrix multiplication per block, blocks are memory-mapped and scored
+    in parallel threads, and per-block top-k candidates are merged with
+    a heap. The full matrix is never held in RAM.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, store_dir):
+        """
+        Parameters
+        ----------
+        store_dir : directory of the block store, str
+        """
+        self.store_dir = store_dir
+        self.manifest = None
+        if os.path.exists(os.path.join(store_dir, 'manifest.json')):
+            self.load_store()
+
+    def load_store(self):
+        with open(os.path.join(self.store_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.sig_ids = np.load(os.path.join(self.store_dir, 'sig_ids.npy'))
+        self.genes = pd.read_csv(os.path.join(self.store_dir, 'genes.txt'),\
+                                 sep='\t', dtype=str)
+        self.blocks = [np.load(os.path.join(self.store_dir, block_file),\
+                               mmap_mode='r')\
+                       for block_file in self.manifest['blocks']]
+        self.block_starts = np.cumsum([0]+[len(b) for b in self.blocks])
+        return self
+
+    def normalise(self, signatures):
+        """
+        centre and scale signatures (rows) to unit norm, float32
+        """
+        signatures = np.asarray(signatures, dtype=np.float32)
+        signatures = signatures - signatures.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(signatures, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return signatures/norms
+
+    def build_store(self, L1000_gctx_file, gene_info_file, block_size=20000,\
+                    gparser=None):
+        """
+        stream the landmark rows of a level 5 gctx file once and write
+        normalised signatures as float32 blocks (signatures x genes)
+
+        Parameters
+        ----------
+        L1000_gctx_file : name of level 5 gctx file, str
+        gene_info_file : name of gene annotation file, str
+        block_size : number of signatures per block, int
+        gparser : PandasGCTXParserL1000 instance (created if None)
+
+        Returns
+        -------
+        self
+
+        """
+        import h5py
+        if gparser is None:
+            from PandasGCTXParserL1000 import PandasGCTXParserL1000
+            gparser = PandasGCTXParserL1000()
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        gene_info = pd.read_csv(gene_info_file, sep="\t", dtype=str)
+        landmark_gene = gene_info[gene_info["pr_is_lm"] == "1"]
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            all_sig_ids = gparser.read_gctx_ids(gctx_file, 'COL')
+
+        block_files = []
+        sig_ids = []
+        for block_num, (cids, block) in enumerate(gparser.read_gctx_column_blocks\
+                (L1000_gctx_file, landmark_gene["pr_gene_id"], all_sig_ids,\
+                 block_size)):
+            block_file = 'block_%05d.npy' % block_num
+            np.save(os.path.join(self.store_dir, block_file),\
+                    np.ascontiguousarray(self.normalise(block.T)))
+            block_files.append(block_file)
+            sig_ids.append(cids)
+
+        np.save(os.path.join(self.store_dir, 'sig_ids.npy'),\
+                np.concatenate(sig_ids).astype(str))
+        landmark_gene[["pr_gene_id", "pr_gene_symbol"]].to_csv\
+            (os.path.join(self.store_dir, 'genes.txt'), sep='\t', index=False)
+        with open(os.path.join(self.store_dir, 'manifest.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(L1000_gctx_file),
+                       'blocks': block_files,
+                       'normalisation': 'centred, unit norm (pearson)'}, f)
+
+        return self.load_store()
+
+    def align_queries(self, query_signatures):
+        """
+        queries (pd dataframe genes x queries, indexed by pr_gene_id or
+        pr_gene_symbol) as normalised float32 rows in store gene order;
+        genes missing from a query are set to its mean
+        """
+        if query_signatures.index.isin(self.genes["pr_gene_id"]).any():
+            gene_ids = self.genes["pr_gene_id"]
+        else:
+            gene_ids = self.genes["pr_gene_symbol"]
+        queries = query_signatures.reindex(gene_ids.values)
+        queries = queries.fillna(queries.mean(axis=0))
+        return self.normalise(queries.values.T)
+
+    def score_block(self, block_num, queries, k):
+        """
+        top-k (score, signature index) candidates of one block per query
+        """
+        scores = self.blocks[block_num] @ queries.T
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k-1, axis=0)[:k]
+        top_scores = np.take_along_axis(scores, top, axis=0)
+        return top_scores, top + self.block_starts[block_num]
+
+    def query(self, query_signatures, k=50, n_jobs=4, sig_info_file=None):
+        """
+        Parameters
+        ----------
+        query_signatures : pd dataframe genes x queries (or a pd series)
+        k : number of most correlated signatures per query, int
+        n_jobs : number of threads scoring blocks, int
+        sig_info_file : GSE92742_Broad_LINCS_sig_info.txt, to attach metadata
+
+        Returns
+        -------
+        pd dataframe with query, rank, sig_id, score (+ sig_info columns)
+
+        """
+        if isinstance(query_signatures, pd.Series):
+            query_signatures = query_signatures.to_frame()
+        queries = self.align_queries(query_signatures)
+
+        #score blocks in parallel, keep the k best of each query in a heap
+        heaps = [[] for _ in range(len(queries))]
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for top_scores, top in pool.map(\
+                    lambda block_num: self.score_block(block_num, queries, k),\
+                    range(len(self.blocks))):
+                for query_num, heap in enumerate(heaps):
+                    for score, sig_num in zip(top_scores[:, query_num],\
+                                              top[:, query_num]):
+                        if len(heap) < k:
+                            heapq.heappush(heap, (score, sig_num))
+                        elif score > heap[0][0]:
+                            heapq.heapreplace(heap, (score, sig_num))
+
+        hits = []
+        for query_name, heap in zip(query_signatures.columns, heaps):
+            for rank, (score, sig_num) in enumerate(sorted(heap, reverse=True)):
+                hits.append((query_name, rank+1, self.sig_ids[sig_num], score))
+        hits = pd.DataFrame(hits, columns=['query', 'rank', 'sig_id', 'score'])
+
+        if sig_info_file is not None:
+            sig_info = pd.read_csv(sig_info_file, sep="\t", dtype=str)
+            hits = hits.merge(sig_info, on='sig_id', how='left')
+        return hits
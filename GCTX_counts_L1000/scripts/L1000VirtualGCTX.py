@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+
+
+class L1000VirtualGCTX:
+    """
+    Several gctx releases (e.g. GSE92742 and GSE70138) as one gctx file.
+
+    The data matrices are mapped into an HDF5 virtual dataset with one
+    column index (ids must be unique across releases) and the row order
+    of the first file; no data is copied, HDF5 routes each read to the
+    source file of its columns. The result is a regular gctx file for
+    cmapPy parse and PandasGCTXParserL1000, and the info files of the
+    releases are concatenated into one metadata table.
+
+    @author: Erik Zhivkoplias
+    """
+
+    def __init__(self, gctx_files, info_files=(), releases=None):
+        """
+        Parameters
+        ----------
+        gctx_files : gctx file of each release, list of str
+        info_files : inst_info/sig_info file of each release, list of str
+        releases : release names, e.g. ['GSE92742', 'GSE70138']
+        """
+        self.gctx_files = [os.path.abspath(f) for f in gctx_files]
+        self.info_files = list(info_files)
+        self.releases = list(releases) if releases is not None else\
+            [os.path.basename(f).split('_')[0] for f in gctx_files]
+
+    def row_runs(self, source_idx):
+        """
+        (source start, target start, length) of runs of consecutive rows,
+        mapping source rows to the row order of the first file
+        """
+        breaks = np.flatnonzero(np.diff(source_idx) != 1) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(source_idx)]])
+        return [(int(source_idx[start]), int(start), int(end - start))\
+                for start, end in zip(starts, ends)]
+
+    def build(self, virtual_file):
+        """
+        write the virtual gctx file (ids and virtual data matrix)
+
+        Returns
+        -------
+        virtual_file
+
+        """
+        import h5py
+        from PandasGCTXParserL1000 import PandasGCTXParserL1000
+        gparser = PandasGCTXParserL1000()
+
+        row_ids = None
+        col_ids = []
+        sources = []
+        for gctx_file_name in self.gctx_files:
+            with h5py.File(gctx_file_name, 'r') as gctx_file:
+                data_dset = gctx_file['/0/DATA/0/matrix']
+                file_row_ids = gparser.read_gctx_ids(gctx_file, 'ROW')
+                if row_ids is None:
+                    row_ids = file_row_ids
+                    dtype = data_dset.dtype
+                source_idx = file_row_ids.get_indexer(row_ids)
+                if (source_idx < 0).any() or data_dset.dtype != dtype:
+                    raise ValueError(gctx_file_name+' does not match the rows '+\
+                                     'or dtype of '+self.gctx_files[0])
+                col_ids.append(gparser.read_gctx_ids(gctx_file, 'COL'))
+                sources.append((gctx_file_name, data_dset.shape, source_idx))
+
+        all_col_ids = col_ids[0].append(col_ids[1:])
+        if all_col_ids.has_duplicates:
+            raise ValueError('column ids are not unique across releases')
+
+        layout = h5py.VirtualLayout(shape=(len(all_col_ids), len(row_ids)),\
+                                    dtype=dtype)
+        col_start = 0
+        for gctx_file_name, shape, source_idx in sources:
+            source = h5py.VirtualSource(gctx_file_name, '/0/DATA/0/matrix',\
+                                        shape=shape)
+            col_end = col_start + shape[0]
+            for source_row, target_row, length in self.row_runs(source_idx):
+                layout[col_start:col_end, target_row:target_row+length] =\
+                    source[:, source_row:source_row+length]
+            col_start = col_end
+
+        tmp_file = virtual_file+'.tmp'
+        with h5py.File(tmp_file, 'w') as gctx_file:
+            gctx_file.attrs['version'] = 'GCTX1.0'
+            gctx_file.create_virtual_dataset('/0/DATA/0/matrix', layout)
+            gctx_file.create_dataset('/0/META/ROW/id',\
+                                     data=np.asarray(row_ids, dtype='S'))
+            gctx_file.create_dataset('/0/META/COL/id',\
+                                     data=np.asarray(all_col_ids, dtype='S'))
+            gctx_file.create_dataset('/0/META/COL/release', data=np.repeat(\
+                np.asarray(self.releases, dtype='S'), [len(c) for c in col_ids]))
+        os.replace(tmp_file, virtual_file)
+        return virtual_file
+
+    def col_info(self):
+        """
+        concatenated info files with a release column, pd dataframe
+        """
+        return pd.concat([pd.read_csv(info_file, sep="\t", dtype=str)\
+                              .assign(release=release)\
+                          for info_file, release in zip(self.info_files,\
+                                                        self.releases)],\
+                         ignore_index=True)
+
+    def write_info(self, output_file):
+        self.col_info().to_csv(output_file, sep="\t", index=False)
+        return output_file
@@ -11,24 +11,220 @@ class PandasGCTXParserL1000:
 
     @author: Erik Zhivkoplias
     """
+
+    #metadata columns used as grouping keys, kept as int32 codes
+    metadata_key_columns = ['pert_iname', 'pert_id', 'pert_dose', 'rna_well']
     
-    def __init__(self):
+    #controls matched to each perturbation type, (pert_type, pert_iname)
+    control_pert_types = {'trt_sh': ('ctl_vector', 'EMPTY_VECTOR'),
+                          'trt_oe': ('ctl_vector', 'EMPTY_VECTOR'),
+                          'trt_cp': ('ctl_vehicle', 'DMSO')}
+    #genetic perturbations, restricted to landmark genes
+    genetic_pert_types = ['trt_sh', 'trt_oe', 'trt_xpr', 'trt_sh.cgs']
+
+    def __init__(self, cache_dir=None, cache_max_bytes=50*1024**3,\
+                 matrix_writer=None):
         
         """import libraries
+
+        cache_dir : directory for cached intermediates (None disables
+                    caching), see GCTXStageCache
+        cache_max_bytes : size bound of the cache
+        matrix_writer : ChunkedMatrixWriter of the Y/P exports (default:
+                        shortest float repr, as DataFrame.to_csv)
         """
-        
+
+        import threading
+
+        #labels of integer-coded metadata keys, {column: pd.Index};
+        #extended under a lock (reads may run in a prefetch thread)
+        self.metadata_labels = {}
+        self.labels_lock = threading.Lock()
+
+        self.cache = None
+        if cache_dir is not None:
+            from GCTXStageCache import GCTXStageCache
+            self.cache = GCTXStageCache(cache_dir, cache_max_bytes)
+
+        if matrix_writer is None:
+            from ChunkedMatrixWriter import ChunkedMatrixWriter
+            matrix_writer = ChunkedMatrixWriter(precision=None)
+        self.matrix_writer = matrix_writer
+
         print('loaded')
         return
 
+    def stage_cache_key(self, stage, input_files=(), input_gctoos=(), **params):
+        """
+        cache key of a stage, None if caching is off or an upstream
+        instance has no cache key
+        """
+        if self.cache is None:
+            return None
+        input_keys = [getattr(gctoo_instance, 'cache_key', None)\
+                      for gctoo_instance in input_gctoos]
+        if None in input_keys:
+            return None
+        return self.cache.make_key(stage, input_files, input_keys, **params)
+
+    def load_cached(self, cache_key):
+        """
+        cached gctoo instances, None on a miss. Codes are rebuilt from
+        the labels since label tables belong to the parser that stored them
+        """
+        if cache_key is None:
+            return None
+        gctoo_instances = self.cache.get(cache_key)
+        if gctoo_instances is None:
+            return None
+        for gctoo_instance in gctoo_instances:
+            col_meta_data = gctoo_instance.col_metadata_df
+            self.encode_metadata_keys(col_meta_data,\
+                [column[:-len('_code')] for column in col_meta_data.columns\
+                 if column.endswith('_code')])
+        return gctoo_instances
+
+    def store_cached(self, cache_key, gctoo_instances):
+        """
+        store gctoo instances under cache_key (no-op if caching is off)
+        """
+        if cache_key is not None:
+            self.cache.put(cache_key, list(gctoo_instances))
+        return tuple(gctoo_instances)
+
+    def encode_metadata_keys(self, col_meta_data, columns):
+        """
+        factorise string metadata columns into int32 codes, stored
+        in '<column>_code'. Label tables are append-only, so codes stay
+        valid across instances (cell lines) parsed by the same parser
+
+        Parameters
+        ----------
+        col_meta_data : column metadata, pd dataframe
+        columns : names of columns to encode, list of str
+
+        Returns
+        -------
+        col_meta_data with additional code columns
+
+        """
+        import numpy as np
+        import pandas as pd
+
+        for column in columns:
+            if column not in col_meta_data.columns:
+                continue
+            values = col_meta_data[column].values
+            with self.labels_lock:
+                labels = self.metadata_labels.get(column, pd.Index([], dtype=object))
+                new_labels = pd.Index(pd.unique(values)).difference(labels, sort=False)
+                labels = labels.append(new_labels)
+                self.metadata_labels[column] = labels
+            col_meta_data[column+'_code'] =\
+                labels.get_indexer(values).astype(np.int32)
+
+        return col_meta_data
+
+    def metadata_codes(self, col_meta_data, column):
+        """
+        int32 codes of a metadata column, encoded on the fly if missing
+        """
+        if column+'_code' not in col_meta_data.columns:
+            self.encode_metadata_keys(col_meta_data, [column])
+        return col_meta_data[column+'_code'].values
+
+    def decode_metadata_keys(self, column, codes):
+        """
+        attach string labels to int32 codes (export only)
+        """
+        return self.metadata_labels[column].values[codes]
+
+    def subset_columns(self, gctoo_instance, mask):
+        """
+        subset gctoo instance with a boolean mask over its columns;
+        GCToo keeps col_metadata_df aligned with data_df.columns
+        """
+        import cmapPy.pandasGEXpress.subset_gctoo as sg
+
+        return sg.subset_gctoo(gctoo_instance, col_bool=mask)
+
+    def publish_shared(self, gctoo_instance, columns=None):
+        """
+        publish the data matrix, ids and int32 metadata codes of a gctoo
+        instance in shared memory, for worker processes to attach to
+        (GCTXSharedMatrix.attach(shared.handle)) without copies
+
+        Parameters
+        ----------
+        gctoo_instance : gctoo instance
+        columns : metadata columns to publish as codes (default
+                  metadata_key_columns present in col_metadata_df)
+
+        Returns
+        -------
+        owning GCTXSharedMatrix; close() it once the workers are done
+
+        """
+        from GCTXSharedMatrix import GCTXSharedMatrix
+
+        col_meta_data = gctoo_instance.col_metadata_df
+        if columns is None:
+            columns = [column for column in self.metadata_key_columns\
+                       if column in col_meta_data.columns]
+        codes = {column: self.metadata_codes(col_meta_data, column)\
+                 for column in columns}
+        labels = {column: self.metadata_labels[column].tolist()\
+                  for column in columns}
+
+        return GCTXSharedMatrix.publish(gctoo_instance.data_df, codes, labels)
+
+    def resolve_gctx_file(self, L1000_gctx_file):
+        """
+        gctx file name; a list of gctx files (releases) is resolved to a
+        virtual gctx file (see L1000VirtualGCTX) next to the first one,
+        built once per set of input file identities
+        """
+        import os
+        import json
+        import hashlib
+        
+        if isinstance(L1000_gctx_file, str):
+            return L1000_gctx_file
+        
+        file_ids = []
+        for gctx_file_name in L1000_gctx_file:
+            file_stat = os.stat(gctx_file_name)
+            file_ids.append([os.path.abspath(gctx_file_name), file_stat.st_size,\
+                             file_stat.st_mtime_ns])
+        virtual_file = os.path.join(os.path.dirname(os.path.abspath(\
+            L1000_gctx_file[0])), 'virtual_'+hashlib.sha1(json.dumps(file_ids)\
+                                 .encode()).hexdigest()[:12]+'.gctx')
+        if not os.path.exists(virtual_file):
+            from L1000VirtualGCTX import L1000VirtualGCTX
+            L1000VirtualGCTX(L1000_gctx_file).build(virtual_file)
+        return virtual_file
+    
+    def read_info_file(self, info_file):
+        """
+        inst_info/sig_info table; a list of files (releases) is concatenated
+        """
+        import pandas as pd
+        
+        if isinstance(info_file, str):
+            return pd.read_csv(info_file, sep="\t", dtype=str)
+        return pd.concat([pd.read_csv(f, sep="\t", dtype=str) for f in info_file],\
+                         ignore_index=True)
+    
     def read_gctx_data(self, cell_line,\
                        L1000_gctx_file, gene_info_file, inst_info_file, level, hrs="96"):
         """
     
         Parameters
         ----------
-        L1000_gctx_file : name of gctx file, str.
+        L1000_gctx_file : name of gctx file, str (or list of gctx files of
+                          several releases, read as one virtual gctx file)
         gene_info_file : name of level3 annotation file, str
-        inst_info_file : name of level3 annotation file, str
+        inst_info_file : name of level3 annotation file, str (or list)
         cell_line : name of the cell line, str.
     
         !see list of files here: https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc=GSE92742    
@@ -44,10 +240,57 @@ class PandasGCTXParserL1000:
         import pandas as pd
         from cmapPy.pandasGEXpress.parse import parse
         
+        #cached cell-line subset
+        L1000_gctx_file = self.resolve_gctx_file(L1000_gctx_file)
+        info_files = [inst_info_file] if isinstance(inst_info_file, str)\
+            else list(inst_info_file)
+        cache_key = self.stage_cache_key('read_gctx_data',\
+                        [L1000_gctx_file, gene_info_file]+info_files,\
+                        cell_line=cell_line, level=level, hrs=hrs)
+        cached = self.load_cached(cache_key)
+        if cached is not None:
+            return tuple(cached)
+        
+        #read meta info
+        trt_sh, ctrl, landmark_gene = self.read_gctx_metadata(cell_line,\
+                        gene_info_file, inst_info_file, level, hrs)
+
+        #subset gctx files
+        level3_data_experiments = parse\
+                    (L1000_gctx_file,\
+                                  rid = landmark_gene.index, cid = trt_sh.index)          
+        level3_data_ctrl = parse\
+                    (L1000_gctx_file,\
+                                  rid = landmark_gene.index, cid = ctrl.index)
+                        
+                
+        #annotate instances
+        level3_data_experiments.col_metadata_df = trt_sh
+        level3_data_experiments.row_metadata_df = landmark_gene
+        level3_data_ctrl.col_metadata_df = ctrl
+        level3_data_ctrl.row_metadata_df = landmark_gene
+    
+                
+        return self.store_cached(cache_key,\
+                                 [level3_data_experiments, level3_data_ctrl])
+    
+    def read_gctx_metadata(self, cell_line, gene_info_file, inst_info_file,\
+                           level, hrs="96"):
+        """
+        cell-line specific metadata, without reading the gctx file
+
+        Returns
+        -------
+        trt_sh, ctrl : col metadata of experiments and controls, indexed
+                       by gctx ids (sig_id for level 5, inst_id otherwise)
+        landmark_gene : row metadata of landmark genes, indexed by pr_gene_id
+
+        """
+        #import libs
+        import pandas as pd
+        
         #read meta info
-        inst_info = pd.read_csv\
-        (inst_info_file,\
-         sep="\t", dtype=str)
+        inst_info = self.read_info_file(inst_info_file)
         
         gene_info = pd.read_csv\
             (gene_info_file,\
@@ -59,57 +302,33 @@ class PandasGCTXParserL1000:
             gctx_ids = 'inst_id'
         #lm genes
         landmark_gene = gene_info[gene_info["pr_is_lm"] == "1"]  
-        landmark_gene_row_ids = landmark_gene["pr_gene_id"]
         landmark_gene_names = landmark_gene["pr_gene_symbol"]
        
         #parse meta info
         #experiments
-        trt_sh = inst_info[(inst_info["pert_type"] == "trt_sh") &\
-                           (inst_info["pert_time"] == hrs) &\
-                           (inst_info["cell_id"] == cell_line) &\
-                            (inst_info["pert_iname"].isin(landmark_gene_names))]
-               
-        
-        trt_sh_ids = inst_info[gctx_ids][(inst_info["pert_type"] == "trt_sh") &\
-                                           (inst_info["pert_time"] == hrs) &\
-                                           (inst_info["cell_id"] == cell_line) &\
-                            (inst_info["pert_iname"].isin(landmark_gene_names))]
-        
-        #print(trt_sh_ids)
+        trt_sh_mask = (inst_info["pert_type"] == "trt_sh") &\
+                      (inst_info["pert_time"] == hrs) &\
+                      (inst_info["cell_id"] == cell_line) &\
+                      (inst_info["pert_iname"].isin(landmark_gene_names))
+        trt_sh = inst_info[trt_sh_mask]
+
         #ctrl
-        ctrl = inst_info[(inst_info["pert_type"] == "ctl_vector") &\
-                                                  (inst_info['pert_iname'] == "EMPTY_VECTOR") &\
-                                                      (inst_info["pert_time"] == hrs) &\
-                                                  (inst_info["cell_id"] == cell_line)]
-        ctrl_ids = inst_info[gctx_ids][(inst_info["pert_type"] == "ctl_vector") &\
-                                                  (inst_info['pert_iname'] == "EMPTY_VECTOR") &\
-                                                      (inst_info["pert_time"] == hrs) &\
-                                                  (inst_info["cell_id"] == cell_line)]
-        #print(ctrl_ids)
-        
-        
-                
-        #subset gctx files
-        level3_data_experiments = parse\
-                    (L1000_gctx_file,\
-                                  rid = landmark_gene_row_ids, cid = trt_sh_ids)          
-        level3_data_ctrl = parse\
-                    (L1000_gctx_file,\
-                                  rid = landmark_gene_row_ids, cid = ctrl_ids)
-                        
+        ctrl_mask = (inst_info["pert_type"] == "ctl_vector") &\
+                    (inst_info['pert_iname'] == "EMPTY_VECTOR") &\
+                    (inst_info["pert_time"] == hrs) &\
+                    (inst_info["cell_id"] == cell_line)
+        ctrl = inst_info[ctrl_mask]
+
+        #integer-coded grouping keys
+        trt_sh = self.encode_metadata_keys(trt_sh.copy(), self.metadata_key_columns)
+        ctrl = self.encode_metadata_keys(ctrl.copy(), self.metadata_key_columns)
                 
         #annotate instances
         trt_sh.set_index(gctx_ids, inplace=True) 
         ctrl.set_index(gctx_ids, inplace=True)
-        landmark_gene.set_index("pr_gene_id", inplace=True)
+        landmark_gene = landmark_gene.set_index("pr_gene_id")
         
-        level3_data_experiments.col_metadata_df = trt_sh
-        level3_data_experiments.row_metadata_df = landmark_gene
-        level3_data_ctrl.col_metadata_df = ctrl
-        level3_data_ctrl.row_metadata_df = landmark_gene
-    
-                
-        return level3_data_experiments, level3_data_ctrl
+        return trt_sh, ctrl, landmark_gene
     
     def filter_gctx_data(self, gctoo_instance, list_of_plates,\
                          num_of_plates):
@@ -131,55 +350,58 @@ class PandasGCTXParserL1000:
         """
         
         #import libs
-        import pandas as pd
-        import cmapPy.pandasGEXpress.subset_gctoo as sg
+        import numpy as np
         
+        cache_key = self.stage_cache_key('filter_gctx_data',\
+                        input_gctoos=[gctoo_instance],\
+                        list_of_plates=list(list_of_plates),\
+                        num_of_plates=num_of_plates)
+        cached = self.load_cached(cache_key)
+        if cached is not None:
+            return cached[0]
+        
+        #subset gctoo instance with selected cids
+        gctoo_instance_subset = self.subset_columns(gctoo_instance,\
+            self.filter_metadata(gctoo_instance.col_metadata_df,\
+                                 list_of_plates, num_of_plates))
+            
+        return self.store_cached(cache_key, [gctoo_instance_subset])[0]
+    
+    def filter_metadata(self, col_meta_data, list_of_plates, num_of_plates):
+        """
+        metadata part of filter_gctx_data: adds plate_num to col_meta_data
+
+        Returns
+        -------
+        boolean mask of columns on the listed plates whose (rna_well, pert_id)
+        pair is present on at least num_of_plates of them
+
+        """
+        #import libs
+        import numpy as np
         
-        #subset experiments performed on the plates with valid names
-        col_meta_data = gctoo_instance.col_metadata_df
+        #experiments performed on the plates with valid names
         col_meta_data['plate_num'] =\
-            col_meta_data['rna_plate'].str.split('_',3,True)[3]  
-        all_plate_ids =\
-        col_meta_data.index[col_meta_data.plate_num.isin(list(list_of_plates))]
-        
-        gctoo_instance = sg.subset_gctoo(gctoo_instance,\
-                                          cid=list(all_plate_ids))
-        col_meta_data = gctoo_instance.col_metadata_df
-   
-
+            col_meta_data['rna_plate'].str.split('_', n=3, expand=True)[3]
+        plate_codes = self.encode_metadata_keys(col_meta_data, ['plate_num'])\
+            ['plate_num_code'].values
+        list_of_plate_codes =\
+            self.metadata_labels['plate_num'].get_indexer(list(list_of_plates))
+        plate_mask = np.isin(plate_codes, list_of_plate_codes)
 
         #select pertubated genes with at least "num_of_plates" plates
-        mask_col_data = col_meta_data[['rna_well', 'pert_id']]
-        mask_col_data['key_to_filter'] = mask_col_data.values.tolist()
-        #create dict with cids
-        dict_with_cids = pd.Series(tuple(mask_col_data.key_to_filter.values), index=mask_col_data.index).to_dict()     
-        del mask_col_data['key_to_filter'] 
-
-        #create list of keys
-        mask = mask_col_data.groupby(mask_col_data.columns.tolist()).size().reset_index().\
-            rename(columns={0:'counts'})
-        mask_pert_id_filter = mask[mask.counts>=num_of_plates]
-        mask_pert_id_filter = mask_pert_id_filter[["rna_well", 'pert_id']]
-
-        mask_pert_id_filter['key_to_filter'] = mask_pert_id_filter.values.tolist()
-        list_of_keys = mask_pert_id_filter['key_to_filter'].values.tolist()
-
-        #create list of cids
-        list_of_cids = []
-        
-        #add cid to a list if key is present in dictionary with cids
-        for key in list_of_keys:
-            if [k for k,v in dict_with_cids.items() if v == key]:
-                list_of_cids.append([k for k,v in dict_with_cids.items() if v == key])
-
-        list_of_cids = [item for sublist in list_of_cids for item in sublist]
-
-        #subset gctoo instance with list of cids
-        gctoo_instance_subset = sg.subset_gctoo\
-            (gctoo_instance, cid=list_of_cids)
-            
-        return gctoo_instance_subset
-    
+        #key_to_filter: (rna_well, pert_id) pair as one int64 code
+        well_codes = self.metadata_codes(col_meta_data, 'rna_well')
+        pert_id_codes = self.metadata_codes(col_meta_data, 'pert_id')
+        key_to_filter = well_codes.astype(np.int64)*\
+            len(self.metadata_labels['pert_id']) + pert_id_codes
+        
+        _, key_inverse, key_counts = np.unique(key_to_filter[plate_mask],\
+                                    return_inverse=True, return_counts=True)
+        
+        mask = plate_mask.copy()
+        mask[plate_mask] = key_counts[key_inverse] >= num_of_plates
+        return mask
     
     def merge_tech_duplicates(self, gctoo_instance, column_name, min_shRNAs_num=1):
         """
@@ -201,67 +423,38 @@ class PandasGCTXParserL1000:
         import pandas as pd
         import numpy as np
         import cmapPy.pandasGEXpress.GCToo as GCToo
-        import cmapPy.pandasGEXpress.subset_gctoo as sg
-        import cmapPy.pandasGEXpress.concat as cg 
-        
         
         #select pert_iname duplicated on each plate
         col_meta_data = gctoo_instance.col_metadata_df
-        mask_pert_ids_non_dup = \
-                gctoo_instance.col_metadata_df.groupby\
-                    ([column_name]).size().loc[lambda x: x == 1].index        
-        mask_pert_ids_dup = \
-                gctoo_instance.col_metadata_df.groupby\
-                ([column_name]).size().loc[lambda x: x > min_shRNAs_num].index
-                
+        key_codes = self.metadata_codes(col_meta_data, column_name)
+        _, key_first, key_inverse, key_counts = np.unique(key_codes,\
+                    return_index=True, return_inverse=True, return_counts=True)
+        cid_counts = key_counts[key_inverse]
+        
         #subset without duplicates
-        data_rep1_nondup_ids = col_meta_data.index\
-                    [col_meta_data[column_name].isin(list(mask_pert_ids_non_dup))]
-        data_rep1_nondup = sg.subset_gctoo\
-                    (gctoo_instance, cid=list(data_rep1_nondup_ids))
+        nondup_mask = cid_counts == 1
+        if min_shRNAs_num > 1:
+            nondup_mask[:] = False
                 
         #subset duplicates
-        data_rep1_dup_ids = col_meta_data.index\
-                [col_meta_data[column_name].isin(list(mask_pert_ids_dup))]
-        data_rep1_dup = sg.subset_gctoo\
-                    (gctoo_instance, cid=list(data_rep1_dup_ids))
-        
-        #merged gctoo instances
-        new_gctoo_instances = []
-        
-        #calculate means for each duplicated perturbator
-        for pert_dup in mask_pert_ids_dup:
-            #select cis
-            pert_dup_ids = list(col_meta_data.index\
-                            [col_meta_data[column_name] == pert_dup])
-            #calculate mean expression value for them
-            merged_pert_dup_array = data_rep1_dup.\
-                    data_df[pert_dup_ids].mean(axis=1).values
-            
-            cid_index = np.where(data_rep1_dup.col_metadata_df.index.values\
-                                 == pert_dup_ids[0])
-            #create cid pd
-            cid_db = data_rep1_dup.col_metadata_df.iloc[cid_index]
-            
-            #create pd for expression values
-            merged_pert_dup_db =\
-                    pd.DataFrame(merged_pert_dup_array,
-                        index = data_rep1_nondup.row_metadata_df.index.values,
-                        columns=[pert_dup_ids[0]])
-            
-            #create new gctoo instances
-            merged_pert_dup_gctoo =\
-                    GCToo.GCToo(data_df=pd.DataFrame(merged_pert_dup_db), 
-                        row_metadata_df=data_rep1_nondup.row_metadata_df.copy(), 
-                        col_metadata_df=cid_db, 
-                        make_multiindex=True)
-            
-            #add to the list
-            new_gctoo_instances.append(merged_pert_dup_gctoo)
-        if min_shRNAs_num == 1:
-            new_gctoo_instances.append(data_rep1_nondup)
-        
-        data_rep_cleaned = cg.hstack(new_gctoo_instances)
+        dup_mask = cid_counts > min_shRNAs_num
+        
+        #calculate means for each duplicated perturbator,
+        #merged column keeps the cid of its first member
+        data_dup = gctoo_instance.data_df.loc[:, dup_mask]
+        merged_pert_dup_db = data_dup.T.groupby(key_codes[dup_mask]).mean().T
+        dup_groups = np.flatnonzero(key_counts > min_shRNAs_num)
+        merged_cids = col_meta_data.index.values[key_first[dup_groups]]
+        merged_pert_dup_db.columns = merged_cids
+        
+        #merged gctoo instance
+        data_rep_cleaned =\
+                GCToo.GCToo(data_df=pd.concat([merged_pert_dup_db,\
+                                gctoo_instance.data_df.loc[:, nondup_mask]], axis=1),
+                    row_metadata_df=gctoo_instance.row_metadata_df.copy(),
+                    col_metadata_df=pd.concat([col_meta_data.loc[merged_cids],\
+                                col_meta_data.loc[nondup_mask]]),
+                    make_multiindex=True)
             
         return data_rep_cleaned
     
@@ -270,38 +463,34 @@ class PandasGCTXParserL1000:
             Input: gctoo_instance
             Returns
         -------
-        data_rep1, data_rep2, data_rep3: 3 gctoo instances, plate-selected 
+        data_rep1, data_rep2, data_rep3: gctoo instances, one per plate
         
         
         """
-        #import libs
-        import cmapPy.pandasGEXpress.subset_gctoo as sg
-        
-        #gctoo_instance = HEPG2_data_3_reps
-        col_meta_data = gctoo_instance.col_metadata_df
-        
-        
-        #select reps
-        rep1_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[0]]
-        data_rep1 = sg.subset_gctoo\
-                (gctoo_instance, cid=list(rep1_ids))
-                    
-        rep2_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[1]]
-        data_rep2 = sg.subset_gctoo\
-                (gctoo_instance, cid=list(rep2_ids))
-        
-        rep3_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[2]]
-        data_rep3 = sg.subset_gctoo\
-                (gctoo_instance, cid=list(rep3_ids))
-        
-        data_rep1_all = self.merge_tech_duplicates(data_rep1, "pert_iname", min_shRNAs_num)
-        data_rep2_all = self.merge_tech_duplicates(data_rep2, "pert_iname", min_shRNAs_num)
-        data_rep3_all = self.merge_tech_duplicates(data_rep3, "pert_iname", min_shRNAs_num)
+        cache_key = self.stage_cache_key('merge_all_perturbators',\
+                        input_gctoos=[gctoo_instance],\
+                        list_of_plates=list(list_of_plates),\
+                        min_shRNAs_num=min_shRNAs_num)
+        cached = self.load_cached(cache_key)
+        if cached is not None:
+            return tuple(cached)
+        
+        #select reps and merge shRNAs of each pert_iname
+        return self.store_cached(cache_key,\
+            [self.merge_tech_duplicates(data_rep, "pert_iname", min_shRNAs_num)\
+             for data_rep in self.split_replicates(gctoo_instance, list_of_plates)])
+    
+    def split_replicates(self, gctoo_instance, list_of_plates):
+        """
+        split gctoo instance into one instance per plate (replicate),
+        plates are matched on plate_num codes
+        """
+        plate_codes = self.metadata_codes(gctoo_instance.col_metadata_df, 'plate_num')
+        list_of_plate_codes =\
+            self.metadata_labels['plate_num'].get_indexer(list(list_of_plates))
         
-        return data_rep1_all, data_rep2_all, data_rep3_all
+        return [self.subset_columns(gctoo_instance, plate_codes == plate_code)\
+                for plate_code in list_of_plate_codes]
     
     def select_one_perturbator(self, gctoo_instance, list_of_plates):
         
@@ -314,80 +503,46 @@ class PandasGCTXParserL1000:
     
         Returns
         -------
-        data_rep1, data_rep2, data_rep3: 3 gctoo instances, plate-selected
+        data_rep1, data_rep2, data_rep3: gctoo instances, one per plate
     
         """
         #import libs
-        import cmapPy.pandasGEXpress.subset_gctoo as sg
-        import cmapPy.pandasGEXpress.concat as cg
+        import numpy as np
+        import pandas as pd
         
-        col_meta_data = gctoo_instance.col_metadata_df
-        pert_gctoo_names = []
+        cache_key = self.stage_cache_key('select_one_perturbator',\
+                        input_gctoos=[gctoo_instance],\
+                        list_of_plates=list(list_of_plates))
+        cached = self.load_cached(cache_key)
+        if cached is not None:
+            return tuple(cached)
         
-        for pert_name in col_meta_data['pert_iname'].unique():
-            
-            #subset shRNA
-            DDR_ids = col_meta_data.index[col_meta_data["pert_iname"] == pert_name]
-            data_DDR = sg.subset_gctoo(gctoo_instance, cid=list(DDR_ids))
-            col_meta_data_DDR = data_DDR.col_metadata_df
-            shRNA_types = col_meta_data_DDR['pert_id'].unique()
-        
-            dict_shRNA_type_var = {}
-            for shRNA_type in shRNA_types:
-                #print(shRNA_type)
-                #store cids and subset data
-                col_meta_data_DDR_oneshRNA_ids = \
-                col_meta_data_DDR.index[col_meta_data_DDR['pert_id'] == shRNA_type]
-                data_DDR_oneshRNA = sg.subset_gctoo\
-                (gctoo_instance, cid=list(col_meta_data_DDR_oneshRNA_ids))
-                #data_DDR_oneshRNA.data_df
-                
-            
-                #calculate variance between shRNAs replicates (sum all genes)
-                shRNA_type_var = sum(data_DDR_oneshRNA.data_df.var(axis=1))/len(data_DDR_oneshRNA.data_df)
-                #add shRNA type and variance to dictionary
-                dict_shRNA_type_var[shRNA_type] = shRNA_type_var
-        
-            #select shRNA with the min variance
-            dict_shRNA_type_var_sorted = {k: v for k, v in sorted(dict_shRNA_type_var.items(),\
-                                                     key=lambda item: item[1])}
-            dict_shRNA_type_var_keys = list(dict_shRNA_type_var_sorted.keys())
-            #print(dict_shRNA_type_var_sorted)
-            #choose the one with the least variance across plates
-            min_var_shRNA = dict_shRNA_type_var_keys[0]
-        
-            shRNA_id = col_meta_data_DDR.index\
-            [col_meta_data_DDR['pert_id'] == min_var_shRNA]
-            
-            data_DDR_oneshRNA = sg.subset_gctoo\
-                (gctoo_instance, cid=list(shRNA_id))
-            pert_gctoo_names.append(data_DDR_oneshRNA)
-        
-        merged_instance = cg.hstack(pert_gctoo_names)
-        col_meta_data = merged_instance.col_metadata_df
-        
-        #select reps
-        rep1_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[0]]
-        data_rep1 = sg.subset_gctoo\
-                (merged_instance, cid=list(rep1_ids))
-        #data_rep1.col_metadata_df.sort_values('pert_id').head(40)
-                
-        rep2_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[1]]
-        data_rep2 = sg.subset_gctoo\
-                (merged_instance, cid=list(rep2_ids))
-        
-        rep3_ids = col_meta_data.index[col_meta_data["plate_num"] ==\
-                                       list_of_plates[2]]
-        data_rep3 = sg.subset_gctoo\
-                (merged_instance, cid=list(rep3_ids))
-                
-        data_rep1_all = self.merge_tech_duplicates(data_rep1, "pert_id")
-        data_rep2_all = self.merge_tech_duplicates(data_rep2, "pert_id")
-        data_rep3_all = self.merge_tech_duplicates(data_rep3, "pert_id")
-        
-        return data_rep1_all, data_rep2_all, data_rep3_all
+        col_meta_data = gctoo_instance.col_metadata_df
+        pert_iname_codes = self.metadata_codes(col_meta_data, 'pert_iname')
+        pert_id_codes = self.metadata_codes(col_meta_data, 'pert_id')
+        
+        #calculate variance between shRNAs replicates (mean over all genes)
+        shRNA_type_var = gctoo_instance.data_df.T.groupby(pert_id_codes).var().\
+            mean(axis=1)
+        
+        #shRNA types in order of appearance, with their pert_iname
+        _, first_cids = np.unique(pert_id_codes, return_index=True)
+        first_cids.sort()
+        shRNA_types = pd.DataFrame({'pert_iname': pert_iname_codes[first_cids],
+                                    'var': shRNA_type_var.reindex\
+                                        (pert_id_codes[first_cids]).values},
+                                   index=pert_id_codes[first_cids])
+        
+        #choose the one with the least variance across plates
+        min_var_shRNAs = shRNA_types['var'].fillna(np.inf).\
+            groupby(shRNA_types['pert_iname']).idxmin().values
+        merged_instance = self.subset_columns\
+            (gctoo_instance, np.isin(pert_id_codes, min_var_shRNAs))
+        
+        #select reps and merge technical duplicates
+        return self.store_cached(cache_key,\
+            [self.merge_tech_duplicates(data_rep, "pert_id")\
+             for data_rep in self.split_replicates(merged_instance, list_of_plates)])
     
     def plot_PCA(self, gctoo_instance_1, gctoo_instance_2, gctoo_instance_3,\
                  gctoo_instance_ctrl, cell_line, output_dir):
@@ -639,7 +794,7 @@ class PandasGCTXParserL1000:
    "/scratch/erikzhi/L1000_data/LIMS/GSE92742_Broad_LINCS_inst_info.txt",
                        gene_info_file =\
    "/scratch/erikzhi/L1000_data/LIMS/GSE92742_Broad_LINCS_gene_info.txt",
-   fold_change=True):
+   fold_change=True, output_format='csv'):
         """
         Save Y and P matrices as csv file
 
@@ -649,6 +804,8 @@ class PandasGCTXParserL1000:
             DESCRIPTION.
         output_dir : TYPE
             DESCRIPTION.
+        output_format : 'csv' (_y.csv/_p.csv), 'bundle' (binary
+            GeneSpiderBundle .gsb with replicates/provenance) or 'both'
 
         Returns
         -------
@@ -688,18 +845,23 @@ class PandasGCTXParserL1000:
         y_all = pd.concat([y1,y2,y3],axis=1)
         p_all = pd.concat([p1,p2,p3],axis=1)
         
-        y_all.to_csv\
-            (output_dir+cell_line+'_y.csv',\
-             index=True, header=True, sep = '\t')
+        if output_format in ('bundle', 'both'):
+            from GeneSpiderBundle import GeneSpiderBundle
+            replicates = np.repeat([1, 2, 3], [y1.shape[1], y2.shape[1], y3.shape[1]])
+            GeneSpiderBundle.from_matrices(y_all, p_all, replicates,\
+                provenance={'cell_line': cell_line, 'inst_info_file': inst_info_file,\
+                            'fold_change': fold_change})\
+                .write(output_dir+cell_line+'.gsb')
         
-        p_all.to_csv\
-            (output_dir+cell_line+'_p.csv',\
-             index=True, header=True, sep = '\t')
+        if output_format in ('csv', 'both'):
+            self.matrix_writer.write(y_all, output_dir+cell_line+'_y.csv')
+            
+            self.matrix_writer.write(p_all, output_dir+cell_line+'_p.csv')
                 
         return True
     
     
-    def gctoo2matrices_lvl5(self, gctoo_instance_lvl5, rep_counts=1):
+    def gctoo2matrices_lvl5(self, gctoo_instance_lvl5, rep_counts=1, all_genes=False):
         """
         
         function to convert pre-processed experimental data (level 5) to matrices
@@ -710,78 +872,59 @@ class PandasGCTXParserL1000:
                             FC values
         gctoo_instance_control : cell line perturbed with empty vectors,
                                 gctoo instance
+        all_genes : keep all rows (e.g. with inferred genes), not only
+                    the perturbed genes
     
         Returns
         -------
         pd dataframe with expression values (Y matrix) in GS format
     
         """
+        import numpy as np
         import pandas as pd
         import cmapPy.pandasGEXpress.subset_gctoo as sg
         
-        mask_col_data = gctoo_instance_lvl5.col_metadata_df['pert_iname']
-        
-        mask_col_data_ktf = mask_col_data.values.tolist()
-        #create dict with cids
-        dict_with_cids = pd.Series(tuple(mask_col_data_ktf),\
-                                   index=mask_col_data.index).to_dict()     
-    
-        #create list of keys
-        mask = mask_col_data.groupby(mask_col_data.tolist()).size().reset_index().\
-            rename(columns={'pert_iname':'counts'})
-        mask_pert_id_filter = mask[mask.counts==rep_counts]
-    
-        list_of_keys = mask_pert_id_filter['index'].values.tolist()
-    
-        #create list of cids
-        list_of_cids = []
-            
-        #add cid to a list if key is present in dictionary with cids
-        for key in list_of_keys:
-            if [k for k,v in dict_with_cids.items() if v == key]:
-                list_of_cids.append([k for k,v in dict_with_cids.items() if v == key])
-    
-        list_of_cids = [item for sublist in list_of_cids for item in sublist]
+        #select pert_inames with rep_counts columns
+        col_meta_data = gctoo_instance_lvl5.col_metadata_df
+        pert_iname_codes = self.metadata_codes(col_meta_data, 'pert_iname')
+        _, key_inverse, key_counts = np.unique(pert_iname_codes,\
+                                    return_inverse=True, return_counts=True)
     
-        #subset gctoo instance with list of cids
-        gctoo_instance_lvl5 = sg.subset_gctoo\
-            (gctoo_instance_lvl5, cid=list_of_cids)
-            
-        #subset pr genes
-        pr_genes = gctoo_instance_lvl5.row_metadata_df['pr_gene_symbol']
-        dict_with_cids = pd.Series(tuple(pr_genes.tolist()), index=pr_genes.index).to_dict() 
-        
-        col_names = gctoo_instance_lvl5.col_metadata_df['pert_iname'].values.tolist()
-        
-        #create list of cids
-        list_of_rids = []
+        #subset gctoo instance with selected cids
+        gctoo_instance_lvl5 = self.subset_columns\
+            (gctoo_instance_lvl5, key_counts[key_inverse] == rep_counts)
+        col_meta_data = gctoo_instance_lvl5.col_metadata_df
+        pert_iname_codes = self.metadata_codes(col_meta_data, 'pert_iname')
             
-        #add cid to a list if key is present in dictionary with cids
-        for key in col_names:
-            if [k for k,v in dict_with_cids.items() if v == key]:
-                list_of_rids.append([k for k,v in dict_with_cids.items() if v == key])
-    
-        list_of_rids = list(set([item for sublist in list_of_rids for item in sublist]))
+        #subset pr genes, joined on pert_iname codes
+        pr_gene_codes = self.metadata_labels['pert_iname'].\
+            get_indexer(gctoo_instance_lvl5.row_metadata_df['pr_gene_symbol'])
         
-        gctoo_instance_lvl5 = sg.subset_gctoo\
-            (gctoo_instance_lvl5, rid=list_of_rids)
+        if not all_genes:
+            gctoo_instance_lvl5 = sg.subset_gctoo\
+                (gctoo_instance_lvl5, row_bool=np.isin(pr_gene_codes, pert_iname_codes))
             
         
-        #annotate
+        #annotate (string labels are attached here only)
         gctoo_instance_lvl5.data_df.index = gctoo_instance_lvl5.\
             row_metadata_df['pr_gene_symbol']
         gctoo_instance_lvl5.data_df.sort_index(inplace=True)
         
-        gctoo_instance_lvl5.data_df.columns = gctoo_instance_lvl5.col_metadata_df['pert_iname'].\
-        values+'_'+gctoo_instance_lvl5.col_metadata_df['pert_id'].values+\
-        gctoo_instance_lvl5.col_metadata_df['pert_dose'].values
-        
-        #drop dupl columns
+        col_meta_data = gctoo_instance_lvl5.col_metadata_df
+        column_names = pd.Series(\
+            self.decode_metadata_keys('pert_iname',\
+                self.metadata_codes(col_meta_data, 'pert_iname')).astype(str))+'_'+\
+            self.decode_metadata_keys('pert_id',\
+                self.metadata_codes(col_meta_data, 'pert_id')).astype(str)+\
+            self.decode_metadata_keys('pert_dose',\
+                self.metadata_codes(col_meta_data, 'pert_dose')).astype(str)
+        
+        #drop dupl columns (rename as name, name.1, name.2, ...)
+        dup_counts = column_names.groupby(column_names).cumcount()
+        column_names[dup_counts > 0] = column_names[dup_counts > 0]+'.'+\
+            dup_counts[dup_counts > 0].astype(str)
         selected_expression = gctoo_instance_lvl5.data_df
-        selected_expression.columns = pd.io.parsers.\
-            ParserBase({'names':selected_expression.columns}).\
-            _maybe_dedup_names(selected_expression.columns)
-        #test = test.loc[:,~test.columns.duplicated()]
+        selected_expression.columns = column_names.values
         
         #sort columns
         selected_expression = selected_expression.\
@@ -810,9 +953,11 @@ class PandasGCTXParserL1000:
     
         return FC_dataset
     
-    def filter_overlapping_experiments(self, rep_matrix, common_labels):
+    def filter_overlapping_experiments(self, rep_matrix, common_labels,\
+                                       all_genes=False):
         """
         filter out genes-esperiments pairs that are not present in all three reps
+        (all_genes: filter experiments only, keep all rows)
         """
         all_experiments = rep_matrix.columns.values.tolist()
         experiment_labels = [experiment.split('_',1)[0] for experiment in all_experiments]
@@ -825,9 +970,355 @@ class PandasGCTXParserL1000:
         rep_matrix =\
         rep_matrix[rep_matrix.\
                             columns.intersection(list(experiments_dictionary.keys()))]
-        rep_matrix =\
-        rep_matrix[rep_matrix.index.\
-                                isin(list(experiments_dictionary.values()))]
+        if not all_genes:
+            rep_matrix =\
+            rep_matrix[rep_matrix.index.\
+                                    isin(list(experiments_dictionary.values()))]
         
         return rep_matrix
         
+    def read_gctx_ids(self, gctx_file, dim):
+        """
+        row ("ROW") or column ("COL") ids of an open gctx (h5py) file
+        """
+        import numpy as np
+        import pandas as pd
+        
+        id_dset = gctx_file['/0/META/'+dim+'/id']
+        ids = np.empty(id_dset.shape, dtype=id_dset.dtype)
+        id_dset.read_direct(ids)
+        return pd.Index(ids.astype('str'))
+    
+    def read_gctx_block(self, data_dset, block_idx, ridx):
+        """
+        read sorted column indices of a gctx data matrix, coalesced into
+        one contiguous slice when the columns are dense enough
+
+        Returns
+        -------
+        np array, rows (ridx order) x columns, float32
+
+        """
+        import numpy as np
+        
+        span = block_idx[-1] - block_idx[0] + 1
+        if span <= 2*len(block_idx):
+            block = data_dset[block_idx[0]:block_idx[-1]+1, :]\
+                [block_idx - block_idx[0]]
+        else:
+            block = data_dset[block_idx, :]
+        return block[:, ridx].T.astype(np.float32)
+    
+    def read_gctx_column_blocks(self, L1000_gctx_file, rid, cid, block_size=2000):
+        """
+        stream a gctx subset in column blocks (in file order), straight
+        from HDF5, so that memory is bounded by block_size
+
+        Parameters
+        ----------
+        L1000_gctx_file : name of gctx file, str (or list, see resolve_gctx_file)
+        rid : row ids, list
+        cid : column ids, list
+        block_size : number of columns per block, int
+
+        Yields
+        -------
+        cids of the block, np array rows (rid order) x block columns
+
+        """
+        import h5py
+        import numpy as np
+        
+        L1000_gctx_file = self.resolve_gctx_file(L1000_gctx_file)
+        with h5py.File(L1000_gctx_file, 'r') as gctx_file:
+            ridx = self.read_gctx_ids(gctx_file, 'ROW').get_indexer(list(rid))
+            col_ids = self.read_gctx_ids(gctx_file, 'COL')
+            cidx = np.sort(col_ids.get_indexer(list(cid)))
+            if (ridx < 0).any() or (cidx < 0).any():
+                raise ValueError('ids not found in '+L1000_gctx_file)
+            
+            data_dset = gctx_file['/0/DATA/0/matrix']
+            for start in range(0, len(cidx), block_size):
+                block_idx = cidx[start:start+block_size]
+                yield col_ids.values[block_idx],\
+                    self.read_gctx_block(data_dset, block_idx, ridx)
+    
+    def stream_lvl4_FC(self, cell_line, L1000_gctx_file, gene_info_file,\
+                       inst_info_file, output_file, list_of_plates=("X1","X2","X3"),\
+                       num_of_plates=3, min_shRNAs_num=1, hrs="96",\
+                       fold_change=True, block_size=2000, row_chunk=100):
+        """
+        streaming version of filter_gctx_data -> merge_all_perturbators ->
+        gctoo2matrices_lvl5 -> calculate_FC for level 4 (ZSPCINF) data.
+        Columns are read in blocks and added into per (plate, pert_iname)
+        sums kept in a memory-mapped accumulator next to output_file;
+        the Y matrix is then written in chunks of rows.
+    
+        Parameters
+        ----------
+        cell_line : name of the cell line, str.
+        L1000_gctx_file : name of level4 gctx file, str.
+        gene_info_file : name of gene annotation file, str
+        inst_info_file : name of level3/4 annotation file, str
+        output_file : name of the Y matrix (csv) to write, str
+        list_of_plates, num_of_plates : see filter_gctx_data
+        min_shRNAs_num : see merge_tech_duplicates
+        block_size : number of gctx columns read at once, int
+        row_chunk : number of Y matrix rows written at once, int
+    
+        Returns
+        -------
+        output_file
+    
+        """
+        import os
+        import numpy as np
+        
+        plan = self.plan_lvl4_FC(cell_line, gene_info_file, inst_info_file,\
+                                 list_of_plates, num_of_plates, min_shRNAs_num, hrs)
+        landmark_gene = plan['landmark_gene']
+        
+        #control mean
+        ctrl_sum = np.zeros(len(landmark_gene))
+        for cids, block in self.read_gctx_column_blocks(L1000_gctx_file,\
+                            landmark_gene.index, plan['ctrl_cids'], block_size):
+            ctrl_sum += block.sum(axis=1)
+        
+        #accumulate merged columns, (groups x genes) so that each
+        #group is a contiguous row of the memmap
+        acc_file = output_file+'.acc.npy'
+        acc = np.lib.format.open_memmap(acc_file, mode='w+', dtype=np.float64,\
+                                        shape=(plan['num_groups'], len(landmark_gene)))
+        for cids, block in self.read_gctx_column_blocks(L1000_gctx_file,\
+                            landmark_gene.index, plan['trt_cids'], block_size):
+            block_groups = plan['group_inverse'][plan['trt_cids'].get_indexer(cids)]
+            local_groups, local_inverse = np.unique(block_groups, return_inverse=True)
+            local_sum = np.zeros((len(local_groups), block.shape[0]))
+            np.add.at(local_sum, local_inverse, block.T)
+            acc[local_groups] += local_sum
+        
+        self.write_lvl4_FC(plan, acc, ctrl_sum, output_file, fold_change, row_chunk)
+        del acc
+        os.remove(acc_file)
+        return output_file
+    
+    def plan_lvl4_FC(self, cell_line, gene_info_file, inst_info_file,\
+                     list_of_plates=("X1","X2","X3"), num_of_plates=3,\
+                     min_shRNAs_num=1, hrs="96"):
+        """
+        metadata part of stream_lvl4_FC (filter and merge groups), no
+        gctx reads
+
+        Returns
+        -------
+        dict with landmark_gene (Y matrix rows), trt_cids and their
+        group_inverse (merged column of each cid), num_groups, ctrl_cids,
+        group_order, group_sizes and column_names (in export order)
+
+        """
+        import numpy as np
+        import pandas as pd
+        
+        #resolve metadata only
+        trt_sh, ctrl, landmark_gene = self.read_gctx_metadata(cell_line,\
+                        gene_info_file, inst_info_file, 4, hrs)
+        trt_sh = trt_sh[self.filter_metadata(trt_sh, list_of_plates, num_of_plates)]
+        
+        #groups: one per (plate, pert_iname), i.e. one merged column each
+        plate_codes = self.metadata_codes(trt_sh, 'plate_num')
+        pert_iname_codes = self.metadata_codes(trt_sh, 'pert_iname')
+        group_key = plate_codes.astype(np.int64)*\
+            len(self.metadata_labels['pert_iname']) + pert_iname_codes
+        _, group_first, group_inverse, group_counts = np.unique(group_key,\
+                    return_index=True, return_inverse=True, return_counts=True)
+        
+        #merge_tech_duplicates: keep single columns (if min_shRNAs_num == 1)
+        #and groups with more than min_shRNAs_num shRNAs
+        keep_group = group_counts > min_shRNAs_num
+        if min_shRNAs_num == 1:
+            keep_group |= group_counts == 1
+        first_meta = trt_sh.iloc[group_first[keep_group]]
+        trt_sh = trt_sh[keep_group[group_inverse]]
+        group_first = group_first[keep_group]
+        group_inverse = np.cumsum(keep_group)[group_inverse[keep_group[group_inverse]]] - 1
+        
+        #genes perturbed on every plate (rows of the Y matrix)
+        group_plates = plate_codes[group_first]
+        group_perts = pert_iname_codes[group_first]
+        list_of_plate_codes =\
+            self.metadata_labels['plate_num'].get_indexer(list(list_of_plates))
+        common_perts = None
+        for plate_code in list_of_plate_codes:
+            plate_perts = group_perts[group_plates == plate_code]
+            common_perts = plate_perts if common_perts is None else\
+                np.intersect1d(common_perts, plate_perts)
+        landmark_codes = self.metadata_labels['pert_iname'].\
+            get_indexer(landmark_gene['pr_gene_symbol'])
+        landmark_gene = landmark_gene[np.isin(landmark_codes, common_perts)].\
+            sort_values('pr_gene_symbol')
+        
+        #column names (labels attached at export) and order:
+        #plate by plate, sorted by name within a plate
+        column_names = pd.Series(\
+            self.decode_metadata_keys('pert_iname', group_perts).astype(str))+'_'+\
+            self.decode_metadata_keys('pert_id',\
+                self.metadata_codes(first_meta, 'pert_id')).astype(str)+\
+            self.decode_metadata_keys('pert_dose',\
+                self.metadata_codes(first_meta, 'pert_dose')).astype(str)
+        group_order = np.concatenate([np.flatnonzero(group_plates == plate_code)\
+            [np.argsort(column_names.values[group_plates == plate_code], kind='stable')]\
+            for plate_code in list_of_plate_codes])
+        
+        return {'landmark_gene': landmark_gene,
+                'trt_cids': trt_sh.index, 'group_inverse': group_inverse,
+                'num_groups': len(group_first), 'ctrl_cids': ctrl.index,
+                'group_order': group_order,
+                'group_sizes': group_counts[keep_group][group_order],
+                'column_names': column_names.values[group_order]}
+    
+    def write_lvl4_FC(self, plan, acc, ctrl_sum, output_file, fold_change=True,\
+                      row_chunk=100):
+        """
+        export part of stream_lvl4_FC: Y matrix from per group sums
+        (acc, groups x genes) and control sums, in chunks of rows
+        (csv streamed by matrix_writer, gctx written at once)
+        """
+        import numpy as np
+        import pandas as pd
+        
+        eps = 1e-7
+        landmark_gene = plan['landmark_gene']
+        gene_symbols = landmark_gene['pr_gene_symbol'].values
+        ctrl_mean = ctrl_sum/max(len(plan['ctrl_cids']), 1) + eps
+        
+        def y_chunks():
+            for start in range(0, len(landmark_gene), row_chunk):
+                rows = slice(start, start+row_chunk)
+                y_chunk = (acc[plan['group_order'], rows]/plan['group_sizes'][:, None]).T
+                if fold_change:
+                    y_chunk = np.log2(y_chunk/ctrl_mean[rows, None] + eps)
+                yield gene_symbols[rows], y_chunk
+        
+        if output_file.endswith(('.gctx', '.h5', '.hdf5')):
+            y_matrix = pd.DataFrame(np.vstack([y_chunk for rows, y_chunk in y_chunks()]),\
+                                    index=pd.Index(gene_symbols, name='pr_gene_symbol'),\
+                                    columns=plan['column_names'])
+            return self.matrix_writer.write(y_matrix, output_file)
+        return self.matrix_writer.write_csv_blocks(output_file, 'pr_gene_symbol',\
+                                                   plan['column_names'], y_chunks())
+    
+    def read_gctx_cube(self, cell_line, L1000_gctx_file, gene_info_file,\
+                       inst_info_file, level, pert_types=("trt_sh",),\
+                       time_points=("96",), doses=None, fold_change=False,\
+                       block_size=2000):
+        """
+        dense gene x perturbation x dose x time cube of one cell line,
+        from one metadata pass and one coalesced read of the gctx file.
+        Replicates are averaged, controls are matched per time point
+        (and per perturbation type, see control_pert_types).
+    
+        Parameters
+        ----------
+        cell_line : name of the cell line, str.
+        L1000_gctx_file : name of gctx file, str.
+        gene_info_file : name of gene annotation file, str
+        inst_info_file : name of inst/sig annotation file, str
+        level : 3, 4 or 5, int
+        pert_types : perturbation types, e.g. ("trt_sh", "trt_cp"), list
+        time_points : pert_time values, e.g. ("96", "144"), list
+        doses : pert_dose values to keep (None keeps all), list
+        fold_change : return log2 FC against matched controls, bool
+        block_size : number of gctx columns read at once, int
+    
+        Returns
+        -------
+        cube : np array genes x perts x doses x times, float32 (nan if missing)
+        mask : np array perts x doses x times, bool (True if measured)
+        ctrl_cube : np array genes x pert_types x times, float32,
+                    mean of matched controls
+        axes : dict with labels of all axes ('genes', 'perts',
+               'pert_types' of each pert, 'doses', 'times', 'counts')
+    
+        """
+        import numpy as np
+        import pandas as pd
+        
+        eps = 1e-7
+        
+        #read meta info once
+        inst_info = self.read_info_file(inst_info_file)
+        gene_info = pd.read_csv(gene_info_file, sep="\t", dtype=str)
+        gctx_ids = 'sig_id' if level==5 else 'inst_id'
+        landmark_gene = gene_info[gene_info["pr_is_lm"] == "1"].\
+            set_index("pr_gene_id")
+        
+        inst_info = inst_info[(inst_info["cell_id"] == cell_line) &\
+                              (inst_info["pert_time"].isin(list(time_points)))]
+        inst_info = inst_info.assign(pert_dose=inst_info["pert_dose"].fillna('NA'))
+        
+        #experiments
+        genetic = inst_info["pert_type"].isin(self.genetic_pert_types)
+        exp_mask = inst_info["pert_type"].isin(list(pert_types)) &\
+            (~genetic | inst_info["pert_iname"].isin(landmark_gene["pr_gene_symbol"]))
+        if doses is not None:
+            exp_mask &= inst_info["pert_dose"].isin(list(doses))
+        exp_info = inst_info[exp_mask].set_index(gctx_ids)
+        
+        #axes, as codes
+        pert_keys = exp_info["pert_type"]+'\t'+exp_info["pert_iname"]
+        pert_codes, perts = pd.factorize(pert_keys, sort=True)
+        dose_codes, dose_labels = pd.factorize(exp_info["pert_dose"], sort=True)
+        time_labels = pd.Index(list(time_points))
+        time_codes = time_labels.get_indexer(exp_info["pert_time"])
+        num_perts, num_doses, num_times = len(perts), len(dose_labels), len(time_labels)
+        
+        #cell index of every (column, cell) pair: experiments first, then
+        #controls in a separate block of cells (pert_types x times); a
+        #control column shared by several types (ctl_vector of trt_sh and
+        #trt_oe) has one pair per type
+        num_cells = num_perts*num_doses*num_times
+        pair_ids = [exp_info.index.values]
+        pair_cells = [(pert_codes*num_doses + dose_codes)*num_times + time_codes]
+        for type_num, pert_type in enumerate(pert_types):
+            ctrl_pert_type, ctrl_pert_iname = self.control_pert_types.get\
+                (pert_type, ('ctl_vector', 'EMPTY_VECTOR'))
+            ctrl_info = inst_info[(inst_info["pert_type"] == ctrl_pert_type) &\
+                                  (inst_info["pert_iname"] == ctrl_pert_iname)]
+            pair_ids.append(ctrl_info[gctx_ids].values)
+            pair_cells.append(num_cells + type_num*num_times +\
+                              time_labels.get_indexer(ctrl_info["pert_time"]))
+        pair_ids = pd.Index(np.concatenate(pair_ids))
+        pair_cells = np.concatenate(pair_cells)
+        
+        #one coalesced pass over the union of columns
+        sums = np.zeros((num_cells + len(pert_types)*num_times, len(landmark_gene)))
+        counts = np.zeros(len(sums), dtype=np.int64)
+        for cids, block in self.read_gctx_column_blocks(L1000_gctx_file,\
+                            landmark_gene.index, pair_ids.unique(), block_size):
+            block_cols = pd.Index(cids).get_indexer(pair_ids)
+            in_block = block_cols >= 0
+            np.add.at(sums, pair_cells[in_block], block.T[block_cols[in_block]])
+            np.add.at(counts, pair_cells[in_block], 1)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (sums/counts[:, None]).T.astype(np.float32)
+        cube = means[:, :num_cells].reshape\
+            (len(landmark_gene), num_perts, num_doses, num_times)
+        ctrl_cube = means[:, num_cells:].reshape\
+            (len(landmark_gene), len(pert_types), num_times)
+        mask = counts[:num_cells].reshape(num_perts, num_doses, num_times) > 0
+        
+        #fold change against controls of the same type and time point
+        pert_type_codes = pd.Index(list(pert_types)).get_indexer\
+            ([pert.split('\t')[0] for pert in perts])
+        if fold_change:
+            cube = np.log2(cube/(ctrl_cube[:, pert_type_codes, None, :] + eps) + eps)
+        
+        axes = {'genes': landmark_gene["pr_gene_symbol"].values,
+                'perts': np.array([pert.split('\t')[1] for pert in perts]),
+                'pert_types': np.array(pert_types)[pert_type_codes],
+                'doses': dose_labels.values,
+                'times': time_labels.values,
+                'counts': counts[:num_cells].reshape(num_perts, num_doses, num_times)}
+        
+        return cube, mask, ctrl_cube, axes
@@ -15,168 +15,236 @@ import os
 import numpy as np
 import pandas as pd
 from PandasGCTXParserL1000 import PandasGCTXParserL1000
-gparser = PandasGCTXParserL1000()
+from L1000PipelineRunner import L1000PipelineRunner
+from L1000GeneInference import L1000GeneInference
+from ChunkedMatrixWriter import ChunkedMatrixWriter
 
 #params
 output_dir = '/home/erikz/sonnhammer/work-in-progress/GCTX_counts_L1000/matrices/'
 data_dir = '/home/erikz/sonnhammer/work-in-progress/GCTX_counts_L1000/data/'
-list_of_cell_lines = ['A375', 'A549', 'HA1E', 'HCC515', 'HEPG2',\
-                      'HT29', 'MCF7', 'PC3']
+#cached cell-line subsets, reused when only late-stage params change
+cache_dir = os.path.join(data_dir, 'cache')
+#Y matrix exports: significant digits, rows formatted in worker threads
+export_precision = 6
+gparser = PandasGCTXParserL1000(cache_dir=cache_dir,\
+                    matrix_writer=ChunkedMatrixWriter(precision=export_precision))
+#stage graph: only stages whose inputs/params changed are re-run
+runner = L1000PipelineRunner(os.path.join(output_dir, 'manifest.json'),\
+                             os.path.join(data_dir, 'stages'))
 
-#parse level5
-for cell_line in list_of_cell_lines:
-    #read data
-    exp_data_lvl5, ctrl_data_lvl5 = gparser.read_gctx_data(cell_line,\
-    L1000_gctx_file =os.path.join(data_dir,\
-                    'GSE92742_Broad_LINCS_Level5_COMPZ.MODZ_n473647x12328.gctx'),\
-    inst_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_sig_info.txt'),
-    gene_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_gene_info.txt'), level=5)
-    
+gene_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_gene_info.txt')
+lvl5_gctx_file = os.path.join(data_dir,\
+                    'GSE92742_Broad_LINCS_Level5_COMPZ.MODZ_n473647x12328.gctx')
+lvl5_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_sig_info.txt')
+lvl3_gctx_file = os.path.join(data_dir,\
+                    'GSE92742_Broad_LINCS_Level3_INF_mlr12k_n1319138x12328.gctx')
+lvl4_gctx_file = os.path.join(data_dir,\
+                    'GSE92742_Broad_LINCS_Level4_ZSPCINF_mlr12k_n1319138x12328.gctx')
+inst_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_inst_info.txt')
+#landmark -> inferred genes model (full-gene matrices from landmark rows)
+inference_model_file = os.path.join(data_dir, 'landmark_inference_model.npz')
+
+
+#stages
+def read_stage(cell_line, gctx_file, info_file, level, hrs):
+    return gparser.read_gctx_data(cell_line, L1000_gctx_file=gctx_file,\
+                                  inst_info_file=info_file,\
+                                  gene_info_file=gene_info_file,\
+                                  level=level, hrs=hrs)
+
+def filter_stage(gctx_data, list_of_plates, num_of_plates):
+    exp_data, ctrl_data = gctx_data
+    return gparser.filter_gctx_data(exp_data, list_of_plates, num_of_plates)
+
+def merge_stage(exp_data_subset, list_of_plates, shRNA_num, best_shRNA):
+    if best_shRNA:
+        #select 'best shRNA experiment' (highest correlation between replicates)
+        return gparser.select_one_perturbator(exp_data_subset, list_of_plates)
+    #compute average across different shRNAs
+    return gparser.merge_all_perturbators(exp_data_subset, list_of_plates,\
+                                          shRNA_num)
+
+def lvl5_matrix_stage(gctx_data):
+    exp_data_lvl5, ctrl_data_lvl5 = gctx_data
     #select columns with 3 reps
-    exp_data_lvl5_matrix = gparser.gctoo2matrices_lvl5(exp_data_lvl5)
-    
-    #save as y-matrix
-    exp_data_lvl5_matrix.to_csv\
-            (output_dir+cell_line+'_lvl5_y.csv',\
-             index=True, header=True, sep = '\t')
+    return gparser.gctoo2matrices_lvl5(exp_data_lvl5)
 
-#parse level3 data
-list_of_cell_lines = ['HA1E', 'HCC515', 'HEPG2',\
-                      'HT29', 'A549', 'MCF7','PC3', 'A375']
-shRNA_num = 2
-time_point = "96"
-for cell_line in list_of_cell_lines:
-    print(cell_line)
-    #read data
-    exp_data_lvl3, ctrl_data_lvl3 = gparser.read_gctx_data(cell_line,\
-    L1000_gctx_file =os.path.join(data_dir,\
-                    'GSE92742_Broad_LINCS_Level3_INF_mlr12k_n1319138x12328.gctx'),\
-    inst_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_inst_info.txt'),\
-    gene_info_file = os.path.join(data_dir, 'GSE92742_Broad_LINCS_gene_info.txt'),\
-    level=3, hrs=time_point)
-    
-    #subset
-    exp_data_lvl3_subset = gparser.filter_gctx_data(exp_data_lvl3, ["X1","X2","X3"], 3)
-    
-    #select 'best shRNA experiment' (highest correlation between replicates)
-    exp_data_lvl3_subset_bestshRNA_rep1, exp_data_lvl3_subset_bestshRNA_rep2,\
-        exp_data_lvl3_subset_bestshRNA_rep3 = \
-        gparser.select_one_perturbator(exp_data_lvl3_subset, ["X1","X2","X3"])
-    
-    #compute average across different shRNAs // comment out if not needed
-    exp_data_lvl3_subset_bulk_rep1, exp_data_lvl3_subset_bulk_rep2,\
-        exp_data_lvl3_subset_bulk_rep3 = \
-        gparser.merge_all_perturbators(exp_data_lvl3_subset, ["X1","X2","X3"], shRNA_num)
+def FC_stage(rep_data, gctx_data, rep_counts, common_experiments, fold_change,\
+             all_genes=False):
+    exp_data, ctrl_data = gctx_data
     
-    #exp_data_lvl3_subset_bulk_rep1 = exp_data_lvl3_subset_bestshRNA_rep1
-    #exp_data_lvl3_subset_bulk_rep2 = exp_data_lvl3_subset_bestshRNA_rep2
-    #exp_data_lvl3_subset_bulk_rep3 = exp_data_lvl3_subset_bestshRNA_rep3
-    
-    
-    #prepare replicates // 
+    #prepare replicates //
     #rep_counts is the threshold for the lowest number of shRNA per gene per experiment
-    exp_data_lvl3_subset_bulk_rep1_matrix =\
-        gparser.gctoo2matrices_lvl5(exp_data_lvl3_subset_bulk_rep1)
-    exp_data_lvl3_subset_bulk_rep2_matrix =\
-        gparser.gctoo2matrices_lvl5(exp_data_lvl3_subset_bulk_rep2)
-    exp_data_lvl3_subset_bulk_rep3_matrix =\
-        gparser.gctoo2matrices_lvl5(exp_data_lvl3_subset_bulk_rep3)
+    rep_matrices = [gparser.gctoo2matrices_lvl5(data_rep, rep_counts=rep_counts,\
+                                                all_genes=all_genes)\
+                    for data_rep in rep_data]
     
     #genes that are the same betwen experiments
-    common_genes = np.intersect1d(np.intersect1d(\
-                   exp_data_lvl3_subset_bulk_rep1_matrix.index,\
-                   exp_data_lvl3_subset_bulk_rep2_matrix.index),\
-                   exp_data_lvl3_subset_bulk_rep3_matrix.index).tolist()
+    common_genes = rep_matrices[0].index
+    for rep_matrix in rep_matrices[1:]:
+        common_genes = np.intersect1d(common_genes, rep_matrix.index)
+    common_genes = list(common_genes)
     
     #filter out experiments that are not present in all three reps
-    exp_data_lvl3_subset_bulk_rep1_matrix =\
-        gparser.filter_overlapping_experiments(exp_data_lvl3_subset_bulk_rep1_matrix,\
-                                               common_genes)
-    exp_data_lvl3_subset_bulk_rep2_matrix =\
-        gparser.filter_overlapping_experiments(exp_data_lvl3_subset_bulk_rep2_matrix,\
-                                               common_genes)
-    exp_data_lvl3_subset_bulk_rep3_matrix =\
-        gparser.filter_overlapping_experiments(exp_data_lvl3_subset_bulk_rep3_matrix,\
-                                               common_genes)
+    if common_experiments:
+        rep_matrices = [gparser.filter_overlapping_experiments(rep_matrix,\
+                        common_genes, all_genes) for rep_matrix in rep_matrices]
     
     #prepare control
-    ctrl_data_lvl3.data_df.index = ctrl_data_lvl3.\
-                row_metadata_df['pr_gene_symbol']
-    ctrl_data_lvl3.data_df.sort_index(inplace=True)
-    ctrl_data_lvl3 = ctrl_data_lvl3.data_df
-    ctrl_data_lvl3 = ctrl_data_lvl3[ctrl_data_lvl3.index.\
-                            isin(common_genes)]
-    ctrl_data_lvl3['mean'] = ctrl_data_lvl3.mean(axis=1)
+    ctrl_data_df = ctrl_data.data_df.copy()
+    ctrl_data_df.index = ctrl_data.row_metadata_df['pr_gene_symbol']
+    ctrl_data_df.sort_index(inplace=True)
+    ctrl_data_df = ctrl_data_df[ctrl_data_df.index.isin(common_genes)]
+    ctrl_mean = ctrl_data_df.mean(axis=1)
     
     #calculate FC
-    exp_data_lvl3_subset_bulk_rep1_matrix_FC =\
-        gparser.calculate_FC(exp_data_lvl3_subset_bulk_rep1_matrix,\
-                             ctrl_data_lvl3['mean'])
-    exp_data_lvl3_subset_bulk_rep2_matrix_FC =\
-        gparser.calculate_FC(exp_data_lvl3_subset_bulk_rep2_matrix,\
-                             ctrl_data_lvl3['mean'])
-    exp_data_lvl3_subset_bulk_rep3_matrix_FC =\
-        gparser.calculate_FC(exp_data_lvl3_subset_bulk_rep3_matrix,\
-                             ctrl_data_lvl3['mean'])
-    
-    #save FC matrices
-    test_all = pd.concat([exp_data_lvl3_subset_bulk_rep1_matrix_FC,\
-                          exp_data_lvl3_subset_bulk_rep2_matrix_FC,\
-                          exp_data_lvl3_subset_bulk_rep3_matrix_FC], axis=1)
-    
-    #save experimental data
-    #test_all = pd.concat([exp_data_lvl3_subset_bulk_rep1_matrix,\
-    #                      exp_data_lvl3_subset_bulk_rep2_matrix,\
-    #                      exp_data_lvl3_subset_bulk_rep3_matrix], axis=1)
-    
-    test_all.to_csv\
-            (output_dir+cell_line+'_'+time_point+'_lvl3.csv',\
-             index=True, header=True, sep = '\t')
+    if fold_change:
+        rep_matrices = [gparser.calculate_FC(rep_matrix, ctrl_mean)\
+                        for rep_matrix in rep_matrices]
+    
+    y_matrix = pd.concat(rep_matrices, axis=1)
+    #replicate of each column, kept by bundle exports
+    y_matrix.attrs['replicates'] = np.repeat(np.arange(1, len(rep_matrices)+1),\
+        [rep_matrix.shape[1] for rep_matrix in rep_matrices]).tolist()
+    return y_matrix
+
+def fit_inference_stage(model_file, report_file):
+    model = L1000GeneInference(model_file)
+    model.fit(lvl3_gctx_file, gene_info_file, gparser=gparser)
+    #compare with stored inferred values of held-out columns
+    model.validate(lvl3_gctx_file, report_file=report_file, gparser=gparser)
+    return model_file
+
+def infer_stage(gctx_data, model_file):
+    #landmark-only instances -> all genes, one matmul per column block
+    model = L1000GeneInference(model_file)
+    return tuple(model.apply(gctoo_instance) for gctoo_instance in gctx_data)
 
+def export_stage(y_matrix, output_file):
+    if output_file.endswith('.gsb'):
+        from GeneSpiderBundle import GeneSpiderBundle
+        return GeneSpiderBundle.from_matrices(y_matrix,\
+                    replicates=y_matrix.attrs.get('replicates'),\
+                    provenance={'output_dir': output_dir, 'time_point': time_point})\
+            .write(output_file)
+    return gparser.matrix_writer.write(y_matrix, output_file)
+
+
+list_of_cell_lines = ['A375', 'A549', 'HA1E', 'HCC515', 'HEPG2',\
+                      'HT29', 'MCF7', 'PC3']
+list_of_plates = ["X1","X2","X3"]
+shRNA_num = 2
+time_point = "96"
+#also export full-gene (landmark + inferred) level3 FC matrices
+infer_genes = False
+#level4 backend: None (in-process), 'local' (dask LocalCluster) or
+#the address of a dask scheduler, e.g. 'tcp://10.0.0.1:8786'
+dask_scheduler = None
+#pipelined run: cell lines read ahead / exports queued for the writer
+prefetch_depth = 1
+write_depth = 2
+#Y matrix exports: '.csv' (tab-separated), '.csv.gz' (compressed; '.csv.zst'
+#needs the zstandard package), '.gctx' (HDF5, column chunks) or '.gsb'
+#(GeneSpiderBundle, memory-mapped loading)
+export_ext = '.csv'
+#streamed level4 exports are written by the matrix writer (no bundles)
+lvl4_ext = '.csv' if export_ext == '.gsb' else export_ext
+
+if infer_genes:
+    report_file = output_dir+'landmark_inference_validation.tsv'
+    runner.add_stage('inference_model', fit_inference_stage,\
+                     input_files=[lvl3_gctx_file, gene_info_file],\
+                     output_files=[inference_model_file, report_file],\
+                     model_file=inference_model_file, report_file=report_file)
 
-            
-            
-            
-            
-#parse level4 data
 for cell_line in list_of_cell_lines:
-    #read data
-    HEPG2_data4, HEPG2_data_ctrl4 = gparser.read_gctx_data(cell_line,\
-    L1000_gctx_file =\
-    "/scratch/erikzhi/L1000_data/level4/GSE92742_Broad_LINCS_Level4_ZSPCINF_mlr12k_n1319138x12328.gctx",\
-    inst_info_file = \
-    "/scratch/erikzhi/L1000_data/LIMS/GSE92742_Broad_LINCS_inst_info.txt")
-    #select columns with 3 reps
-    HEPG_data_subset = gparser.filter_gctx_data(HEPG2_data4, ["X1","X2","X3"], 3)
-    #subset plates
-    #one shRNA
-    #HEPG_data_subset_p1_one, HEPG_data_subset_p2_one, HEPG_data_subset_p3_one = \
-    #    gparser.select_one_perturbator(HEPG_data_subset, ["X1","X2","X3"])
-    #bulk shRNA
-    HEPG_data_subset_p1_bulk, HEPG_data_subset_p2_bulk, HEPG_data_subset_p3_bulk = \
-        gparser.merge_all_perturbators(HEPG_data_subset, ["X1","X2","X3"])
-    
-    #split
-    test1 = gparser.gctoo2matrices_lvl5(HEPG_data_subset_p1_bulk, rep_counts=1)
-    test2 = gparser.gctoo2matrices_lvl5(HEPG_data_subset_p2_bulk, rep_counts=1)
-    test3 = gparser.gctoo2matrices_lvl5(HEPG_data_subset_p3_bulk, rep_counts=1)
-    
-    #prepare control
-    HEPG2_data_ctrl4.data_df.index = HEPG2_data_ctrl4.\
-                row_metadata_df['pr_gene_symbol']
-    HEPG2_data_ctrl4.data_df.sort_index(inplace=True)
-    HEPG2_data_ctrl4 = HEPG2_data_ctrl4.data_df
-    HEPG2_data_ctrl4 = HEPG2_data_ctrl4[HEPG2_data_ctrl4.index.\
-                                    isin(test1.index.tolist())]
-    HEPG2_data_ctrl4['mean'] = HEPG2_data_ctrl4.mean(axis=1)
-    
+    #parse level5
+    lvl5 = cell_line+'/lvl5/'
+    runner.add_stage(lvl5+'read', read_stage, persist=False, kind='read',\
+                     input_files=[lvl5_gctx_file, lvl5_info_file, gene_info_file],\
+                     cell_line=cell_line, gctx_file=lvl5_gctx_file,\
+                     info_file=lvl5_info_file, level=5, hrs="96")
+    runner.add_stage(lvl5+'matrix', lvl5_matrix_stage, deps=[lvl5+'read'])
+    #save as y-matrix
+    output_file = output_dir+cell_line+'_lvl5_y'+export_ext
+    runner.add_stage(lvl5+'export', export_stage, deps=[lvl5+'matrix'],\
+                     kind='write', output_files=[output_file],\
+                     output_file=output_file)
+    
+    #parse level3 data
+    lvl3 = cell_line+'/lvl3/'
+    runner.add_stage(lvl3+'read', read_stage, persist=False, kind='read',\
+                     input_files=[lvl3_gctx_file, inst_info_file, gene_info_file],\
+                     cell_line=cell_line, gctx_file=lvl3_gctx_file,\
+                     info_file=inst_info_file, level=3, hrs=time_point)
+    #subset
+    runner.add_stage(lvl3+'filter', filter_stage, deps=[lvl3+'read'],\
+                     persist=False, list_of_plates=list_of_plates,\
+                     num_of_plates=3)
+    runner.add_stage(lvl3+'merge', merge_stage, deps=[lvl3+'filter'],\
+                     persist=False, list_of_plates=list_of_plates,\
+                     shRNA_num=shRNA_num, best_shRNA=False)
     #calculate FC
-    test11 = gparser.calculate_FC(test1, HEPG2_data_ctrl4['mean'])
-    test22 = gparser.calculate_FC(test2, HEPG2_data_ctrl4['mean'])
-    test33 = gparser.calculate_FC(test3, HEPG2_data_ctrl4['mean'])
-    
-    #save matrix  
-    test_all = pd.concat([test1, test2, test3], axis=1)
-    test_all.to_csv\
-            (output_dir+cell_line+'_y_s.csv',\
-             index=True, header=True, sep = '\t')
\ No newline at end of file
+    runner.add_stage(lvl3+'FC', FC_stage, deps=[lvl3+'merge', lvl3+'read'],\
+                     rep_counts=1, common_experiments=True, fold_change=True)
+    #save FC matrices
+    output_file = output_dir+cell_line+'_'+time_point+'_lvl3'+export_ext
+    runner.add_stage(lvl3+'export', export_stage, deps=[lvl3+'FC'],\
+                     kind='write', output_files=[output_file],\
+                     output_file=output_file)
+    
+    if infer_genes:
+        runner.add_stage(lvl3+'infer_read', infer_stage,\
+                         deps=[lvl3+'read', 'inference_model'], persist=False)
+        runner.add_stage(lvl3+'infer_merge', infer_stage,\
+                         deps=[lvl3+'merge', 'inference_model'], persist=False)
+        runner.add_stage(lvl3+'FC_full', FC_stage,\
+                         deps=[lvl3+'infer_merge', lvl3+'infer_read'],\
+                         rep_counts=1, common_experiments=True, fold_change=True,\
+                         all_genes=True)
+        output_file = output_dir+cell_line+'_'+time_point+'_lvl3_full'+export_ext
+        runner.add_stage(lvl3+'export_full', export_stage, deps=[lvl3+'FC_full'],\
+                         kind='write', output_files=[output_file],\
+                     output_file=output_file)
+    
+    #parse level4 data, streamed in column blocks (bounded memory)
+    if dask_scheduler is None:
+        output_file = output_dir+cell_line+'_y_s'+lvl4_ext
+        runner.add_stage(cell_line+'/lvl4/stream_FC', gparser.stream_lvl4_FC,\
+                         persist=False,\
+                         input_files=[lvl4_gctx_file, inst_info_file, gene_info_file],\
+                         output_files=[output_file],\
+                         cell_line=cell_line, L1000_gctx_file=lvl4_gctx_file,\
+                         gene_info_file=gene_info_file, inst_info_file=inst_info_file,\
+                         output_file=output_file, list_of_plates=list_of_plates,\
+                         num_of_plates=3, min_shRNAs_num=shRNA_num, hrs=time_point)
+
+def dask_lvl4_stage(output_file_map, **params):
+    from L1000DaskBackend import L1000DaskBackend
+    scheduler_address = None if dask_scheduler == 'local' else dask_scheduler
+    with L1000DaskBackend(scheduler_address, gparser=gparser) as backend:
+        return backend.stream_lvl4_FC(list_of_cell_lines,\
+                                      output_files=output_file_map, **params)
+
+if dask_scheduler is not None:
+    #level4 data of all cell lines in one distributed pass
+    output_file_map = {cell_line: output_dir+cell_line+'_y_s'+lvl4_ext\
+                       for cell_line in list_of_cell_lines}
+    runner.add_stage('lvl4/stream_FC', dask_lvl4_stage, persist=False,\
+                     input_files=[lvl4_gctx_file, inst_info_file, gene_info_file],\
+                     output_files=list(output_file_map.values()),\
+                     output_file_map=output_file_map, L1000_gctx_file=lvl4_gctx_file,\
+                     gene_info_file=gene_info_file, inst_info_file=inst_info_file,\
+                     list_of_plates=list_of_plates, num_of_plates=3,\
+                     min_shRNAs_num=shRNA_num, hrs=time_point)
+
+#guarded: dask worker processes re-import this script
+if __name__ == '__main__':
+    #one group of targets per cell line, then the remaining targets
+    cell_line_groups = [[name for name in runner.stages\
+                         if name.startswith(cell_line+'/')]\
+                        for cell_line in list_of_cell_lines]
+    executed_stages = runner.run_pipelined(cell_line_groups,\
+                                           prefetch_depth, write_depth)
+    executed_stages += runner.run()
+    print(str(len(executed_stages))+' stages executed')
@@ -7,13 +7,21 @@ Created on Tue Mar 16 15:13:17 2021
 import csv
 import os
 import sys
+import numpy as np
 import pandas as pd
 import argparse
 from parse_rsem_output import *
 
+#GeneSpiderBundle and ChunkedMatrixWriter are shared with the L1000 pipeline
+default_shared_dir = os.environ.get('GENESPIDER_SCRIPTS',\
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+                 '..', '..', 'GCTX_counts_L1000', 'scripts'))
+
 def process_rsem_counts_to_GS_matrix(your_label,\
                                      your_rsem_dir, your_meta_file1,\
-                                     your_meta_file2, your_out_dir):
+                                     your_meta_file2, your_out_dir,\
+                                     output_format='csv', precision=None,\
+                                     csv_ext='.csv'):
     '''
     To wrap-up everything
     your_label: experiment label for output matrix
@@ -21,6 +29,10 @@ def process_rsem_counts_to_GS_matrix(your_label,\
     meta_file1: data/processed/metaGSM.txt
     meta_file2: output of first rule
     your_out_dir: dir with tables
+    output_format: 'csv' (_y.csv/_p.csv), 'bundle' (binary
+                   GeneSpiderBundle <label>.gsb) or 'both'
+    precision: significant digits of csv values (None: shortest repr)
+    csv_ext: '.csv', '.csv.gz' or '.gctx'
     '''
 
     #handle metadata and target genes
@@ -74,14 +86,24 @@ def process_rsem_counts_to_GS_matrix(your_label,\
 
     #export matrices as csv-files in GeneSpider format
     Y_file, P_file = save_FC_to_GS(Y_list)
-    Y_file.to_csv\
-            (str(os.path.join(os.getcwd(),str(your_out_dir),\
-                          str(your_label)+"_y.csv")),\
-             index=True, header=True, sep = '\t')
-    P_file.to_csv\
-            (str(os.path.join(os.getcwd(),str(your_out_dir),\
-                          str(your_label)+"_p.csv")),\
-             index=True, header=True, sep = '\t')
+    if output_format in ('bundle', 'both'):
+        from GeneSpiderBundle import GeneSpiderBundle
+        replicates = np.repeat([1, 2], [Y_matrix1.shape[1], Y_matrix2.shape[1]])
+        GeneSpiderBundle.from_matrices(Y_file, P_file, replicates,\
+            provenance={'label': your_label, 'rsem_dir': your_rsem_dir,\
+                        'controls': [ctrl1, ctrl2]})\
+            .write(str(os.path.join(os.getcwd(),str(your_out_dir),\
+                                    str(your_label)+".gsb")))
+    if output_format == 'bundle':
+        return True
+    from ChunkedMatrixWriter import ChunkedMatrixWriter
+    writer = ChunkedMatrixWriter(precision=precision)
+    writer.write(Y_file,\
+            str(os.path.join(os.getcwd(),str(your_out_dir),\
+                          str(your_label)+"_y"+csv_ext)))
+    writer.write(P_file,\
+            str(os.path.join(os.getcwd(),str(your_out_dir),\
+                          str(your_label)+"_p"+csv_ext)))
     return True
 
 
@@ -98,9 +120,20 @@ def main():
     parser.add_argument("-m1", "--meta_GSM_file", required=True, help="meta file 1")
     parser.add_argument("-m2", "--meta_SRR_file", required=True, help="meta file 2")
     parser.add_argument("-o", "--out_dir", required=True, help="output directory")
+    parser.add_argument("-f", "--output_format", default="csv",\
+                        choices=["csv", "bundle", "both"], help="Y/P output format")
+    parser.add_argument("-p", "--precision", type=int, default=None,\
+                        help="significant digits of csv values")
+    parser.add_argument("-x", "--csv_ext", default=".csv",\
+                        choices=[".csv", ".csv.gz", ".gctx"],\
+                        help="csv file extension (compression) or gctx")
+    parser.add_argument("-s", "--shared_dir", default=default_shared_dir,\
+                        help="directory of GeneSpiderBundle/ChunkedMatrixWriter "\
+                             "(default: $GENESPIDER_SCRIPTS or GCTX_counts_L1000/scripts)")
     args = parser.parse_args()
+    sys.path.append(args.shared_dir)
 
-    process_rsem_counts_to_GS_matrix(args.label, args.rsem_dir, args.meta_GSM_file, args.meta_SRR_file, args.out_dir)
+    process_rsem_counts_to_GS_matrix(args.label, args.rsem_dir, args.meta_GSM_file, args.meta_SRR_file, args.out_dir, args.output_format, args.precision, args.csv_ext)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scalable clustergram support: leaf orders of genes/experiments from a
+low-rank embedding (exact average linkage of small axes, k-means summary
+plus linkage of the centroids for large ones), persisted for reuse, and
+block-mean downsampling of the ordered matrix to the output resolution.
+"""
+import os
+import numpy as np
+
+
+def kmeans(points, n_clusters, n_iter=10, seed=0):
+    """
+
+    Returns:
+      -centroids, assignment - Lloyd's k-means, distances from one
+                               matrix product per iteration
+    -------
+    Requires:
+      -points - points x coordinates, np array
+      -n_clusters - number of centroids (initialised on a sample)
+
+    """
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)]
+    point_norms = (points**2).sum(axis=1)
+    for _ in range(n_iter):
+        distances = point_norms[:, None] - 2*points @ centroids.T +\
+            (centroids**2).sum(axis=1)[None, :]
+        assignment = distances.argmin(axis=1)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        #empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled]/counts[filled, None]
+    return centroids, assignment
+
+
+def axis_order(embedding, max_exact=2000, n_clusters=256, method='average', seed=0):
+    """
+
+    Returns:
+      -order - leaf order of the points (rows of embedding), np array
+    -------
+    Requires:
+      -embedding - points x low-rank coordinates, np array
+      -max_exact - largest number of points clustered directly
+      -n_clusters - k-means centroids summarising larger axes; points
+                    follow the linkage order of their centroid, then
+                    their first coordinate
+      -method - linkage method
+
+    """
+    from scipy.cluster.hierarchy import linkage, leaves_list
+
+    embedding = np.asarray(embedding, dtype=np.float64)
+    if len(embedding) <= max(max_exact, 2):
+        if len(embedding) < 2:
+            return np.arange(len(embedding))
+        return leaves_list(linkage(embedding, method=method))
+
+    centroids, assignment = kmeans(embedding, min(n_clusters, len(embedding)),\
+                                   seed=seed)
+    centroid_rank = np.empty(len(centroids), dtype=np.int64)
+    centroid_rank[leaves_list(linkage(centroids, method=method))] =\
+        np.arange(len(centroids))
+    return np.lexsort((embedding[:, 0], centroid_rank[assignment]))
+
+
+def matrix_fingerprint(matrix, num_samples=4096):
+    """
+    shape and a strided sample of the values, identifies a stored order
+    """
+    flat = np.asarray(matrix).reshape(-1)
+    step = max(1, flat.size//num_samples)
+    return np.concatenate([np.asarray(matrix.shape, dtype=np.float64),\
+                           flat[::step][:num_samples].astype(np.float64)])
+
+
+def cluster_orders(matrix, order_file=None, rank=50, max_exact=2000,\
+                   n_clusters=256, seed=0):
+    """
+
+    Returns:
+      -row_order, col_order - leaf orders of genes and experiments
+    -------
+    Requires:
+      -matrix - genes x experiments, np array
+      -order_file - .npz file of the orders, reused if it matches the
+                    matrix (None: not stored)
+      -rank - dimension of the embedding (randomised SVD)
+      -max_exact, n_clusters - see axis_order
+
+    """
+    from data_exploration_dimensionality import randomized_svd
+
+    fingerprint = matrix_fingerprint(matrix)
+    if order_file is not None and os.path.exists(order_file):
+        with np.load(order_file) as orders:
+            if np.array_equal(orders['fingerprint'], fingerprint, equal_nan=True):
+                return orders['row_order'], orders['col_order']
+
+    U, singular_values, Vt = randomized_svd(matrix, rank, n_power_iter=1, seed=seed)
+    row_order = axis_order(U*singular_values, max_exact, n_clusters, seed=seed)
+    col_order = axis_order(Vt.T*singular_values, max_exact, n_clusters, seed=seed)
+
+    if order_file is not None:
+        np.savez(order_file, row_order=row_order, col_order=col_order,\
+                 fingerprint=fingerprint)
+        #np.savez adds .npz to names without it
+        if not order_file.endswith('.npz'):
+            os.replace(order_file+'.npz', order_file)
+    return row_order, col_order
+
+
+def downsample_ordered(matrix, row_order, col_order, max_rows=1500, max_cols=2000):
+    """
+
+    Returns:
+      -image - block means of the reordered matrix, at most
+               max_rows x max_cols, np array (float32)
+    -------
+    Requires:
+      -matrix - genes x experiments, np array
+      -row_order, col_order - see cluster_orders
+      -max_rows, max_cols - output resolution (pixels)
+
+    """
+    row_bins = np.linspace(0, len(row_order), min(max_rows, len(row_order))+1)\
+        .astype(np.int64)
+    col_bins = np.linspace(0, len(col_order), min(max_cols, len(col_order))+1)\
+        .astype(np.int64)
+    col_counts = np.diff(col_bins)
+
+    #one band of rows at a time, never a full reordered copy
+    image = np.empty((len(row_bins)-1, len(col_bins)-1), dtype=np.float32)
+    for i in range(len(row_bins)-1):
+        band = np.asarray(matrix[np.sort(row_order[row_bins[i]:row_bins[i+1]])],\
+                          dtype=np.float64)[:, col_order]
+        image[i] = np.add.reduceat(band.mean(axis=0), col_bins[:-1])/col_counts
+    return image
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dimensionality analysis of GeneSpider expression matrices: truncated
+(randomised) singular value spectra and eigenvalues of stacked square
+replicate blocks, for the singular/eigenvalue plots of large datasets.
+"""
+import numpy as np
+
+
+def randomized_svd(matrix, k, n_oversamples=10, n_power_iter=4, seed=0):
+    """
+
+    Returns:
+      -U, singular_values, Vt - top-k factors (genes x k, k, k x
+                                experiments), singular values descending
+    -------
+    Requires:
+      -matrix - genes x experiments, np array
+      -k - number of singular values
+      -n_oversamples - extra random directions of the sketch
+      -n_power_iter - power iterations, the accuracy knob: each one
+                      sharpens the spectrum of the sketch (more accurate
+                      small values) for one more pass over the matrix
+      -seed - random seed of the sketch
+
+    """
+    matrix = np.asarray(matrix)
+    if matrix.dtype not in (np.float32, np.float64):
+        matrix = matrix.astype(np.float64)
+    transposed = matrix.shape[0] < matrix.shape[1]
+    if transposed:
+        matrix = matrix.T
+    num_cols = matrix.shape[1]
+    k = min(k, num_cols)
+    sketch_size = min(k + n_oversamples, num_cols)
+
+    #range finder with orthonormalised power iterations (Halko et al. 2011)
+    rng = np.random.default_rng(seed)
+    sketch = rng.standard_normal((num_cols, sketch_size)).astype(matrix.dtype)
+    basis, _ = np.linalg.qr(matrix @ sketch)
+    for _ in range(n_power_iter):
+        basis, _ = np.linalg.qr(matrix.T @ basis)
+        basis, _ = np.linalg.qr(matrix @ basis)
+    U_small, singular_values, Vt = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+    U = basis @ U_small[:, :k]
+    singular_values, Vt = singular_values[:k], Vt[:k]
+    if transposed:
+        return Vt.T, singular_values, U.T
+    return U, singular_values, Vt
+
+
+def randomized_singular_values(matrix, k, n_oversamples=10, n_power_iter=4,\
+                               seed=0):
+    """
+
+    Returns:
+      -singular_values - top-k singular values, descending, np array
+    -------
+    Requires:
+      -matrix, k, n_oversamples, n_power_iter, seed - see randomized_svd
+
+    """
+    return randomized_svd(matrix, k, n_oversamples, n_power_iter, seed)[1]
+
+
+def top_singular_values(matrix, k=None, exact_max_dim=2000, **sketch_params):
+    """
+
+    Returns:
+      -singular_values - ascending (as the dimensionality plot), np array;
+                         all of them (exact) if k is None and the matrix
+                         is small, else the top k (randomised)
+    -------
+    Requires:
+      -matrix - genes x experiments, np array
+      -k - number of singular values, None for all
+      -exact_max_dim - largest min(shape) decomposed exactly when k is None
+      -sketch_params - see randomized_singular_values
+
+    """
+    import scipy.linalg
+
+    if k is None and min(matrix.shape) <= exact_max_dim:
+        singular_values = scipy.linalg.svdvals(matrix)
+    else:
+        singular_values = randomized_singular_values(matrix,\
+                              k or min(100, min(matrix.shape)), **sketch_params)
+    return np.sort(singular_values)
+
+
+def batched_eigenvalues(replicate_blocks):
+    """
+
+    Returns:
+      -eigenvalues - reps x experiments, sorted by modulus (ascending)
+                     per replicate, complex np array
+    -------
+    Requires:
+      -replicate_blocks - genes x experiments x reps, square blocks
+                          (one experiment per perturbed gene)
+
+    """
+    stacked = np.ascontiguousarray(np.moveaxis(replicate_blocks, 2, 0))
+    if stacked.shape[1] != stacked.shape[2]:
+        raise ValueError('replicate blocks are not square: '+str(stacked.shape[1:]))
+    #one LAPACK call per block, no python loop
+    eigenvalues = np.linalg.eigvals(stacked)
+    order = np.argsort(np.abs(eigenvalues), axis=1)
+    return np.take_along_axis(eigenvalues, order, axis=1)
+
+
+def replicate_eigenvalue_spectrum(replicate_blocks):
+    """
+
+    Returns:
+      -av_eigenvals - modulus of the eigenvalues averaged over replicates
+                      (rank-wise), ascending, np array
+    -------
+    Requires:
+      -replicate_blocks - genes x experiments x reps, square blocks
+
+    """
+    return np.abs(batched_eigenvalues(replicate_blocks)).mean(axis=0)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loaders of GeneSpider expression matrices (csv or GeneSpiderBundle) for
+the exploration plots: one typed pass, float32 values, gene labels.
+GeneSpiderBundle is imported from GCTX_counts_L1000/scripts, which the
+caller puts on the path (see data_exploration.py).
+"""
+import os
+import numpy as np
+import pandas as pd
+
+
+def sniff_layout(file_name, delimiter=None, gene_column=None, num_rows=5):
+    """
+
+    Returns:
+      -delimiter, header fields, index of the gene label column, indices
+       of the other non-numeric columns (dropped), implicit index flag
+    -------
+    Requires:
+      -file_name - GeneSpider Y matrix (csv/tsv, optionally compressed)
+      -delimiter - None to detect ('\\t', ',' or ';')
+      -gene_column - name or index of the gene label column, None to
+                     detect (unnamed index column or first text column)
+
+    """
+    import csv
+    import itertools
+    from pandas.io.common import get_handle
+
+    with get_handle(file_name, 'r', compression='infer') as handle:
+        lines = list(itertools.islice(handle.handle, num_rows+1))
+    if delimiter is None:
+        delimiter = max(['\t', ',', ';'], key=lines[0].count)
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    header, data_rows = rows[0], rows[1:]
+
+    #header one field shorter than the rows: unnamed gene index column
+    implicit_index = len(data_rows) > 0 and len(data_rows[0]) == len(header)+1
+    if implicit_index:
+        header = ['']+header
+
+    def is_number(field):
+        try:
+            float(field)
+        except ValueError:
+            #missing values
+            return field.strip().lower() in ('', 'na', 'n/a', 'null')
+        return True
+
+    text_columns = [col for col in range(len(header))\
+                    if any(not is_number(row[col]) for row in data_rows\
+                           if col < len(row))]
+    if gene_column is None:
+        gene_idx = 0 if implicit_index or not text_columns else text_columns[0]
+    elif isinstance(gene_column, str):
+        gene_idx = header.index(gene_column)
+    else:
+        gene_idx = int(gene_column)
+    dropped = [col for col in text_columns if col != gene_idx]
+
+    return delimiter, header, gene_idx, dropped, implicit_index
+
+
+def csv_read_args(file_name, delimiter=None, gene_column=None, dtype=np.float32):
+    """
+    header, gene column index and pd.read_csv arguments of one typed pass
+    (data rows only, gene column as str, other text columns dropped)
+    """
+    delimiter, header, gene_idx, dropped, implicit_index =\
+        sniff_layout(file_name, delimiter, gene_column)
+    usecols = [col for col in range(len(header)) if col not in dropped]
+
+    #pyarrow parses with several threads when installed
+    try:
+        import pyarrow
+        engine = 'pyarrow'
+    except ImportError:
+        engine = 'c'
+    return header, gene_idx, dict(sep=delimiter, header=None, skiprows=1,\
+                                  usecols=usecols, engine=engine,\
+                                  dtype={col: (str if col == gene_idx else dtype)\
+                                         for col in usecols})
+
+
+def load_expression_matrix(file_name, delimiter=None, gene_column=None,\
+                           dtype=np.float32):
+    """
+
+    Returns:
+      -expression_df - pd dataframe genes x experiments (dtype), indexed
+                       by the gene labels; duplicated experiment labels
+                       get '.N' suffixes (as pd.read_csv)
+      -genes - gene labels, np array
+    -------
+    Requires:
+      -file_name - csv/tsv file or GeneSpiderBundle (.gsb, Y is mapped)
+      -delimiter, gene_column - see sniff_layout
+      -dtype - dtype of the values
+
+    """
+    if file_name.endswith('.gsb'):
+        from GeneSpiderBundle import GeneSpiderBundle
+        expression_df = GeneSpiderBundle.load(file_name).Y_df()
+        return expression_df, expression_df.index.values
+
+    header, gene_idx, read_args = csv_read_args(file_name, delimiter, gene_column, dtype)
+    data = pd.read_csv(file_name, **read_args)
+
+    genes = data.pop(gene_idx).values
+    labels = pd.Series([header[col] for col in data.columns])
+    occurrence = labels.groupby(labels).cumcount()
+    data.columns = labels.where(occurrence == 0, labels+'.'+occurrence.astype(str))
+    data.index = pd.Index(genes, name=header[gene_idx] or 'GENE_SYMBOL')
+    return data, genes
+
+
+def load_expression_data(file_name, delimiter=None, gene_column=None):
+    """
+
+    Returns:
+      -expression_data - pd dataframe in GS format: GENE_SYMBOL column,
+                         then float32 experiment columns; a
+                         GeneSpiderBundle (.gsb) with the same name is
+                         preferred over the csv file
+    -------
+    Requires:
+      -file_name - GeneSpider Y matrix
+      -delimiter, gene_column - see sniff_layout
+
+    """
+    bundle_file = os.path.splitext(file_name)[0]+'.gsb'
+    if os.path.exists(bundle_file):
+        file_name = bundle_file
+    expression_data, genes = load_expression_matrix(file_name, delimiter, gene_column)
+    expression_data.index = pd.RangeIndex(len(genes))
+    expression_data.insert(0, 'GENE_SYMBOL', genes)
+    return expression_data
+
+
+def iter_expression_blocks(file_name, block_rows=4096, delimiter=None,\
+                           gene_column=None, dtype=np.float32):
+    """
+
+    Returns:
+      -iterator of (genes, values) - consecutive blocks of at most
+                                     block_rows genes (labels, np array
+                                     block_rows x experiments, writeable),
+                                     read one at a time (fixed memory)
+    -------
+    Requires:
+      -file_name - csv/tsv file or GeneSpiderBundle (.gsb, Y is mapped)
+      -block_rows - genes per block
+      -delimiter, gene_column - see sniff_layout
+      -dtype - dtype of the values
+
+    """
+    if file_name.endswith('.gsb'):
+        from GeneSpiderBundle import GeneSpiderBundle
+        bundle = GeneSpiderBundle.load(file_name)
+        for start in range(0, len(bundle.genes), block_rows):
+            yield np.asarray(bundle.genes[start:start+block_rows]),\
+                np.array(bundle.Y[start:start+block_rows], dtype=dtype)
+        return
+
+    header, gene_idx, read_args = csv_read_args(file_name, delimiter, gene_column, dtype)
+    #(the python parser of chunked reads has no pyarrow engine)
+    read_args['engine'] = 'c'
+    with pd.read_csv(file_name, chunksize=block_rows, **read_args) as reader:
+        for data in reader:
+            genes = data.pop(gene_idx).values
+            yield genes, data.values
+
+
+def expression_header(file_name, delimiter=None, gene_column=None):
+    """
+    experiment labels of a GeneSpider Y matrix (csv or .gsb), list
+    """
+    if file_name.endswith('.gsb'):
+        from GeneSpiderBundle import GeneSpiderBundle
+        return GeneSpiderBundle.load(file_name).experiments
+    header, gene_idx, read_args = csv_read_args(file_name, delimiter, gene_column)
+    return [header[col] for col in read_args['usecols'] if col != gene_idx]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless QC metrics: the statistics behind the exploration plots
+(explained variance, dimensionality, replicate variance, perturbation
+scores, on-target ranks) computed vectorised and written as json
+(summary) and tab-separated columns (per experiment, per gene), without
+matplotlib, heatmapcluster or varname.
+"""
+import os
+import json
+import numpy as np
+
+
+def replicate_variance(replicate_blocks, bins):
+    """
+
+    Returns:
+      -summary - median of the replicate means, average replicate
+                 variance, histogram (counts, edges) of the means, dict
+    -------
+    Requires:
+      -replicate_blocks - genes x experiments x reps, np array
+      -bins - number of histogram bins
+
+    """
+    av_mean = replicate_blocks.mean(axis=2)
+    counts, edges = np.histogram(av_mean, bins)
+    return {'median_expression': float(np.median(av_mean)),\
+            'average_variance': float(replicate_blocks.var(axis=2).mean()),\
+            'expression_histogram': {'counts': counts.tolist(),\
+                                     'edges': edges.tolist()}}
+
+
+def dataset_metrics(your_dataset, reps=2, max_rank=6):
+    """
+
+    Returns:
+      -metrics - summary statistics, json-serialisable dict
+      -experiment_metrics - per experiment: target, column minimum,
+                            on-target value, perturbation score,
+                            on-target rank, pd dataframe
+      -gene_metrics - per gene: mean and variance over the experiments,
+                      pd dataframe
+    -------
+    Requires:
+      -your_dataset - GS-format dataframe or ExplorationDataset
+      -reps - number of replicates
+      -max_rank - on-target ranks reported as percentages (the full rank
+                  histogram is kept as counts)
+
+    """
+    import pandas as pd
+    from data_exploration_plots import ExplorationDataset
+
+    dataset = ExplorationDataset.of(your_dataset, reps)
+    num_genes, num_experiments = dataset.matrix.shape
+
+    pert_ranks = dataset.perturbation_ranks()
+    rank_histogram = pert_ranks['rank_histogram']
+
+    try:
+        eigenvalues = dataset.eigenvalue_spectrum(reps).tolist()
+    except ValueError:
+        #replicate blocks are not square
+        eigenvalues = None
+
+    metrics = {'genes': num_genes, 'experiments': num_experiments, 'replicates': reps,\
+               'explained_variance': dataset.explained_variance.tolist(),\
+               'singular_values': dataset.singular_values.tolist(),\
+               'eigenvalues': eigenvalues,\
+               'replicate_variance': replicate_variance(dataset.replicate_blocks(reps),\
+                                                        num_experiments//reps),\
+               'on_target_rank_percent':\
+                   dict(zip(map(str, range(1, max_rank+1)),\
+                            (rank_histogram[:max_rank]/num_experiments*100).tolist())),\
+               'on_target_rank_histogram': rank_histogram.tolist()}
+
+    targets = pert_ranks['targets']
+    experiment_metrics = pd.DataFrame({'experiment': dataset.experiments,\
+                                       'target': dataset.frame['GENE_SYMBOL'].values[targets]\
+                                           if 'GENE_SYMBOL' in dataset.frame else targets,\
+                                       'real_min': pert_ranks['column_min'],\
+                                       'int_min': pert_ranks['on_target'],\
+                                       'pert_score': pert_ranks['pert_score'],\
+                                       'on_target_rank': pert_ranks['ranks']})
+    gene_metrics = pd.DataFrame({'gene': dataset.frame['GENE_SYMBOL'].values\
+                                     if 'GENE_SYMBOL' in dataset.frame else np.arange(num_genes),\
+                                 'mean': dataset.matrix.mean(axis=1),\
+                                 'variance': dataset.matrix.var(axis=1)})
+    return metrics, experiment_metrics, gene_metrics
+
+
+def compute_metrics(your_dataset, output_dir, cell_line_name, num_of_reps,\
+                    streaming=False):
+    """
+
+    Returns:
+      -metrics_file, experiments_file - output_dir/cell_line_name/
+                                        cell_line_name_metrics.json and
+                                        _experiment_metrics.tsv (and
+                                        _gene_metrics.tsv); the same keys
+                                        and columns in both modes
+    -------
+    Requires:
+      -your_dataset - GS-format dataframe, ExplorationDataset or the
+                      name of a GeneSpider Y matrix (csv/.gsb)
+      -output_dir, cell_line_name, num_of_reps - as plot_all_explorative_plots
+      -streaming - read the file in blocks of genes (fixed memory; the
+                   decompositions are null), see data_exploration_streaming
+
+    """
+    path = os.path.join(output_dir, cell_line_name)
+    os.makedirs(path, exist_ok=True)
+    if streaming:
+        from data_exploration_streaming import streaming_statistics
+        if not isinstance(your_dataset, str):
+            raise ValueError('streaming metrics are computed from a file')
+        metrics, experiment_metrics, gene_metrics =\
+            streaming_statistics(your_dataset, num_of_reps)
+    else:
+        if isinstance(your_dataset, str):
+            from data_exploration_loader import load_expression_data
+            your_dataset = load_expression_data(your_dataset)
+        metrics, experiment_metrics, gene_metrics =\
+            dataset_metrics(your_dataset, num_of_reps)
+
+    metrics_file = os.path.join(path, cell_line_name+'_metrics.json')
+    with open(metrics_file, 'w') as json_file:
+        json.dump(metrics, json_file, indent=1)
+    experiments_file = os.path.join(path, cell_line_name+'_experiment_metrics.tsv')
+    experiment_metrics.to_csv(experiments_file, sep='\t', index=False)
+    gene_metrics.to_csv(os.path.join(path, cell_line_name+'_gene_metrics.tsv'),\
+                        sep='\t', index=False)
+    return metrics_file, experiments_file
+
+
+def compute_all_metrics(datasets, output_dir, n_workers=None, streaming=False):
+    """
+    compute_metrics of several datasets ((dataframe or file name, name,
+    number of replicates) each) in a process pool; files are loaded in
+    the workers
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if n_workers == 1:
+        return [compute_metrics(your_dataset, output_dir, cell_line_name, num_of_reps,\
+                                streaming) for your_dataset, cell_line_name, num_of_reps in datasets]
+    with ProcessPoolExecutor(n_workers) as pool:
+        futures = [pool.submit(compute_metrics, your_dataset, output_dir,\
+                               cell_line_name, num_of_reps, streaming)\
+                   for your_dataset, cell_line_name, num_of_reps in datasets]
+        return [future.result() for future in futures]
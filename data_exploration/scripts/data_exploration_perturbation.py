@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-target ranks and perturbation (off-target) scores of perturbation
+experiments, for any number of replicates: one vectorised pass over
+column blocks of the expression matrix, top-k ranks by partial sorting.
+"""
+import numpy as np
+
+
+def perturbation_targets(num_genes, num_experiments, targets=None, genes=None):
+    """
+
+    Returns:
+      -targets - on-target gene (row) of each experiment, np array (int)
+    -------
+    Requires:
+      -num_genes, num_experiments - shape of the expression matrix
+      -targets - None: replicates as consecutive square blocks
+                 (experiment i of a block perturbs gene i, GS format);
+                 row indices or gene labels (with genes) per experiment
+      -genes - gene labels of the rows, to map labelled targets
+
+    """
+    import pandas as pd
+
+    if targets is None:
+        return np.arange(num_experiments) % num_genes
+    targets = np.asarray(targets)
+    if targets.dtype.kind not in 'iu':
+        if genes is None:
+            raise ValueError('gene labels are required to map labelled targets')
+        indexer = pd.Index(genes).get_indexer(targets)
+        if (indexer < 0).any():
+            raise ValueError('targets not among the genes: '+\
+                             str(sorted(set(targets[indexer < 0]))[:10]))
+        targets = indexer
+    if len(targets) != num_experiments:
+        raise ValueError('one target per experiment is required')
+    return targets.astype(np.int64)
+
+
+def perturbation_ranks(matrix, targets=None, genes=None, max_rank=None,\
+                       block_cols=2048):
+    """
+
+    Returns:
+      -pert_ranks - dict of arrays:
+        targets - on-target gene of each experiment
+        on_target - on-target value of each experiment (int_min)
+        column_min - most negative value of each experiment (real_min)
+        pert_score - on_target/column_min (1: the target is the most
+                     down-regulated gene)
+        ranks - rank of the on-target value in its experiment (1: most
+                negative, ties share the lowest rank as rankdata 'min');
+                max_rank+1 for all ranks beyond max_rank
+        rank_histogram - number of experiments of rank 1, 2, ...
+                         (max_rank+1: beyond max_rank)
+    -------
+    Requires:
+      -matrix - genes x experiments, np array (or memmap)
+      -targets, genes - see perturbation_targets
+      -max_rank - None for exact ranks of all genes, else ranks up to
+                  max_rank from the max_rank smallest values of each
+                  experiment (np.partition)
+      -block_cols - experiments per block (bounds the temporary arrays)
+
+    """
+    num_genes, num_experiments = matrix.shape
+    targets = perturbation_targets(num_genes, num_experiments, targets, genes)
+    if max_rank is not None:
+        max_rank = min(max_rank, num_genes)
+
+    on_target = np.empty(num_experiments)
+    column_min = np.empty(num_experiments)
+    ranks = np.empty(num_experiments, dtype=np.int64)
+    for start in range(0, num_experiments, block_cols):
+        cols = slice(start, start+block_cols)
+        block = np.asarray(matrix[:, cols], dtype=np.float64)
+        block_targets = block[targets[cols], np.arange(block.shape[1])]
+        on_target[cols] = block_targets
+        if max_rank is None:
+            column_min[cols] = block.min(axis=0)
+            ranks[cols] = (block < block_targets[None, :]).sum(axis=0) + 1
+        else:
+            #the max_rank smallest values (unordered) of each experiment;
+            #a target within them has all its smaller values among them
+            smallest = np.partition(block, max_rank-1, axis=0)[:max_rank]
+            column_min[cols] = smallest.min(axis=0)
+            ranks[cols] = np.where(block_targets <= smallest.max(axis=0),\
+                                   (smallest < block_targets[None, :]).sum(axis=0) + 1,\
+                                   max_rank + 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pert_score = on_target/column_min
+    num_ranks = num_genes if max_rank is None else max_rank + 1
+    rank_histogram = np.bincount(ranks, minlength=num_ranks+1)[1:num_ranks+1]
+    return {'targets': targets, 'on_target': on_target, 'column_min': column_min,\
+            'pert_score': pert_score, 'ranks': ranks, 'rank_histogram': rank_histogram}
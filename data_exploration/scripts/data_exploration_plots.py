@@ -17,15 +17,218 @@ Created on Tue Mar 23 13:23:05 2021
 @author: erikzhi
 """
 
+import os
+from functools import cached_property
+
+
+class ExplorationDataset:
+    """
+    Dataset context shared by the plot functions: the GS-format dataframe
+    is converted once, and the scaled matrix, PCA scores, explained
+    variance, singular values and replicate blocks are computed on first
+    use and memoised, so plot_all_explorative_plots costs one PCA/SVD.
+    """
+
+    def __init__(self, your_data, reps=2, n_components=10, svd_rank=None,\
+                 render='auto', targets=None):
+        self.frame = your_data
+        self.reps = reps
+        #on-target gene of each experiment (None: square replicate blocks),
+        #see data_exploration_perturbation
+        self.targets = targets
+        #'vector', 'raster' (dense layers as images), 'binned' (2D/1D
+        #density computed in numpy) or 'auto' (binned for large layers)
+        self.render = render
+        self.n_components = n_components
+        #None: exact spectrum of small matrices, top 100 (randomised) of
+        #large ones, see data_exploration_dimensionality
+        self.svd_rank = svd_rank
+        self._eigenvalue_spectra = {}
+        self._perturbation_ranks = {}
+        #.npy file of the matrix (plot workers, see shared)
+        self.matrix_file = None
+
+    @classmethod
+    def of(cls, your_data, reps=2):
+        #plot functions accept a dataframe or a shared context
+        return your_data if isinstance(your_data, cls) else cls(your_data, reps)
+
+    @cached_property
+    def matrix(self):
+        """genes x experiments, rounded to 4 decimals, np array (the
+        dtype of the frame: float32 of the loader is kept)"""
+        import numpy as np
+        if self.matrix_file is not None:
+            return np.load(self.matrix_file, mmap_mode='r')
+        experiment_cols = self.frame.columns != 'GENE_SYMBOL'
+        values = self.frame.loc[:, experiment_cols]
+        dtypes = values.dtypes.unique()
+        dtype = dtypes[0] if len(dtypes) == 1 and dtypes[0].kind == 'f' else np.float64
+        values = values.to_numpy(dtype=dtype)
+        #round in place, unless the array is (a view of) the frame
+        if not values.flags.writeable or (values.size and np.shares_memory\
+                (values, self.frame.iloc[:, np.flatnonzero(experiment_cols)[0]].values)):
+            values = values.copy()
+        return np.round(values, 4, out=values)
+
+    @cached_property
+    def experiments(self):
+        return self.frame.columns[self.frame.columns != 'GENE_SYMBOL']
+
+    @cached_property
+    def scaled(self):
+        """experiments x genes, standardised per gene (as StandardScaler)"""
+        import numpy as np
+        scale = self.matrix.std(axis=1)
+        #constant genes are only centred
+        scale[scale == 0] = 1
+        return ((self.matrix - self.matrix.mean(axis=1)[:, None])/scale[:, None]).T
+
+    @cached_property
+    def pca_svd(self):
+        """top n_components left singular vectors and values of scaled
+        (exact for small matrices, randomised for large ones), the one
+        decomposition behind the PCA scores and explained variance"""
+        import numpy as np
+        from data_exploration_dimensionality import randomized_svd
+        if min(self.scaled.shape) <= 2000:
+            U, singular_values, _ = np.linalg.svd(self.scaled, full_matrices=False)
+        else:
+            U, singular_values, _ = randomized_svd(self.scaled, self.n_components)
+        return U[:, :self.n_components], singular_values[:self.n_components]
+
+    @cached_property
+    def pca_scores(self):
+        """experiments x components (as PCA.fit_transform, up to sign)"""
+        U, singular_values = self.pca_svd
+        return U*singular_values
+
+    @cached_property
+    def explained_variance(self):
+        """share of each component in the variance of the scores"""
+        #variance of the (centred) scores of a component: s**2/experiments
+        component_variance = self.pca_svd[1]**2
+        return component_variance/component_variance.sum()
+
+    @cached_property
+    def singular_values(self):
+        """singular values (all, or the top svd_rank), ascending"""
+        from data_exploration_dimensionality import top_singular_values
+        return top_singular_values(self.matrix, self.svd_rank)
+
+    def replicate_blocks(self, reps=None):
+        """genes x experiments x reps (consecutive column blocks), a view
+        of matrix"""
+        from data_exploration_streaming import replicate_view
+        return replicate_view(self.matrix, reps or self.reps)
+
+    def eigenvalue_spectrum(self, reps=None):
+        """|eigenvalues| of the square replicate blocks, averaged, ascending"""
+        from data_exploration_dimensionality import replicate_eigenvalue_spectrum
+        reps = reps or self.reps
+        if reps not in self._eigenvalue_spectra:
+            self._eigenvalue_spectra[reps] =\
+                replicate_eigenvalue_spectrum(self.replicate_blocks(reps))
+        return self._eigenvalue_spectra[reps]
+
+    def shared(self, matrix_file):
+        """copy for plot worker processes, sent once per worker: the
+        statistics computed so far, the matrix saved to matrix_file
+        (mapped read-only by the workers), the frame reduced to the gene
+        labels"""
+        import copy
+        import numpy as np
+        np.save(matrix_file, self.matrix)
+        self.experiments
+        shared = copy.copy(self)
+        shared.__dict__ = {name: value for name, value in self.__dict__.items()\
+                           if name not in ('matrix', 'scaled')}
+        shared.frame = self.frame.loc[:, self.frame.columns == 'GENE_SYMBOL']
+        shared.matrix_file = matrix_file
+        return shared
+
+    def perturbation_ranks(self, max_rank=None):
+        """on-target ranks and perturbation scores, any number of replicates"""
+        from data_exploration_perturbation import perturbation_ranks
+        if max_rank not in self._perturbation_ranks:
+            genes = self.frame['GENE_SYMBOL'].values\
+                if 'GENE_SYMBOL' in self.frame else None
+            self._perturbation_ranks[max_rank] =\
+                perturbation_ranks(self.matrix, self.targets, genes, max_rank)
+        return self._perturbation_ranks[max_rank]
+
+
+
+def render_mode(render, num_elements, max_vector=5000):
+    return ('binned' if num_elements > max_vector else 'vector')\
+        if render == 'auto' else render
+
+
+def draw_scatter_layers(ax, layers, render='auto', bins=300):
+    """
+    layers: (x, y, label, scatter style) per group of points; 'binned'
+    draws each layer as one image of log point density in its colour on
+    a common grid, so the output does not grow with the points.
+    Returns the legend handles
+    """
+    import numpy as np
+    from matplotlib.colors import to_rgba
+    from matplotlib.lines import Line2D
+    
+    mode = render_mode(render, sum(len(x) for x, y, label, style in layers))
+    if mode != 'binned':
+        return [ax.scatter(x, y, label=label, rasterized=(mode == 'raster'), **style)\
+                for x, y, label, style in layers]
+    
+    x_all = np.concatenate([x for x, y, label, style in layers])
+    y_all = np.concatenate([y for x, y, label, style in layers])
+    extent = (x_all.min(), x_all.max(), y_all.min(), y_all.max())
+    handles = []
+    for x, y, label, style in layers:
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins,\
+                                                  range=[extent[:2], extent[2:]])
+        image = np.zeros(counts.T.shape+(4,))
+        image[...] = to_rgba(style.get('c', 'black'))
+        image[..., 3] = style.get('alpha', 1.0)*np.log1p(counts.T)/\
+            max(np.log1p(counts.max()), 1e-12)
+        ax.imshow(image, origin='lower', extent=extent, aspect='auto',\
+                  interpolation='nearest')
+        handles.append(Line2D([], [], linestyle='', marker=style.get('marker', 'o'),\
+                              color=style.get('c', 'black'), label=label))
+    return handles
+
+
+def draw_histogram(ax, values, bins, render='auto', max_bins=512, **style):
+    """
+    'binned': counts from np.histogram drawn as one filled step path
+    (at most max_bins bins) instead of one patch per bin
+    """
+    import numpy as np
+    
+    mode = render_mode(render, bins, max_vector=256)
+    if mode != 'binned':
+        return ax.hist(values, bins=bins, rasterized=(mode == 'raster'), **style)
+    counts, edges = np.histogram(values, bins=min(bins, max_bins))
+    return ax.stairs(counts, edges, fill=True, **style)
+
 
 #1. clustergram
-def plot_expression_clustergram(your_data):
+def plot_expression_clustergram(your_data, scalable=None, order_file=None,\
+                                max_pixels=(1500, 2000), output_dir='.'):
+    """
+    scalable: None chooses by size (more than 2000 genes or experiments);
+    scalable mode clusters a low-rank embedding (k-means summary of large
+    axes), stores the leaf orders in order_file and draws the reordered
+    matrix as one raster downsampled to max_pixels (rows, cols)
+    """
     import numpy as np
-    from heatmapcluster import heatmapcluster
     import matplotlib.pyplot as plt
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data)
+    if scalable is None:
+        scalable = max(dataset.matrix.shape) > 2000
     
     fig = plt.figure(figsize=(20,15))
     
@@ -35,40 +238,50 @@ def plot_expression_clustergram(your_data):
 
     plt.rc('font', **font)
     
-    your_data_np = np.round(np.matrix(your_data.loc\
-     [:, your_data.columns != 'GENE_SYMBOL']), 4)
+    if scalable:
+        from data_exploration_clustering import cluster_orders, downsample_ordered
+        if order_file is None:
+            order_file = os.path.join(output_dir, str(data_name)+'_clustergram_order.npz')
+        row_order, col_order = cluster_orders(dataset.matrix, order_file)
+        image = downsample_ordered(dataset.matrix, row_order, col_order, *max_pixels)
+        limit = np.nanpercentile(np.abs(image), 99)
+        ax = fig.add_subplot(111)
+        heatmap = ax.imshow(image, aspect='auto', interpolation='nearest',\
+                            cmap=plt.cm.coolwarm, vmin=-limit, vmax=limit,\
+                            extent=(0, len(col_order), len(row_order), 0))
+        fig.colorbar(heatmap, ax=ax)
+        ax.set_xlabel('experiments (clustered)')
+        ax.set_ylabel('genes (clustered)')
+        plt.savefig(os.path.join(output_dir, str(data_name)+'_plot_expression_clustergram.svg'))
+        plt.close()
+        return
     
-    h = heatmapcluster(your_data_np, your_data.index, your_data.columns[1:],
+    from heatmapcluster import heatmapcluster
+    h = heatmapcluster(dataset.matrix, dataset.frame.index, dataset.experiments,
                    num_row_clusters=3, num_col_clusters=3,
                    label_fontsize=8,
                    xlabel_rotation=-75,
                    cmap=plt.cm.coolwarm,
                    show_colorbar=True,
                    top_dendrogram=True)
-    plt.savefig(str(data_name)+'_plot_expression_clustergram.svg')
-    plt.show()
+    plt.savefig(os.path.join(output_dir, str(data_name)+'_plot_expression_clustergram.svg'))
     
     plt.close()
     
     return
 
 #2 pca1
-def plot_pca_expression_pc1_vs_pc2(your_data):
+def plot_pca_expression_pc1_vs_pc2(your_data, output_dir='.'):
     import numpy as np
     import matplotlib.pyplot as plt
-    from sklearn.preprocessing import StandardScaler
-    from sklearn.decomposition import PCA
-    from sklearn.pipeline import Pipeline
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data)
     
-    your_data_np = np.round(np.matrix(your_data.loc\
-     [:, your_data.columns != 'GENE_SYMBOL']), 4)
-    
-    pipeline = Pipeline([('scaling', StandardScaler()), ('pca', PCA(n_components=10))])
-    pca_data = pipeline.fit_transform(your_data_np.T)
-    explained_variance = np.var(pca_data, axis=0)/sum(np.var(pca_data, axis=0))
+    #scaled PCA(10), shared by both PCA plots
+    pca_data = dataset.pca_scores
+    explained_variance = dataset.explained_variance
     
     #1250 for lasso 500 for lesshub
     
@@ -87,38 +300,34 @@ def plot_pca_expression_pc1_vs_pc2(your_data):
 
     plt.rc('font', **font)
     
-    ax.scatter(rep1[:, 0], rep1[:, 1], alpha=0.7, s=75, marker='o', edgecolor ="black",
-                linewidths = 0.5, c='green')
-    ax.scatter(rep2[:, 0], rep2[:, 1], alpha=0.7, s=75, marker='^', edgecolor ="black",
-                linewidths = 0.5, c='blue')
-    plt.gca().legend(('rep1','rep2'), loc='upper right', shadow=True, ncol=2)
+    handles = draw_scatter_layers(ax,
+        [(rep1[:, 0], rep1[:, 1], 'rep1', dict(alpha=0.7, s=75, marker='o', edgecolor ="black",
+                linewidths = 0.5, c='green')),
+         (rep2[:, 0], rep2[:, 1], 'rep2', dict(alpha=0.7, s=75, marker='^', edgecolor ="black",
+                linewidths = 0.5, c='blue'))], dataset.render)
+    plt.gca().legend(handles=handles, loc='upper right', shadow=True, ncol=2)
     
     ax.set_xlabel(('PC1: '+ str(round(explained_variance[0], 2)*100)+'%'))
     ax.set_ylabel(('PC2: '+ str(round(explained_variance[1], 2)*100)+'%'))
     plt.title("PCA, -"+ str(len(rep1)) + " experiments")
     
-    fig.savefig(str(data_name)+'_plot_pca_expression_pc1_vs_pc2.svg')
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_plot_pca_expression_pc1_vs_pc2.svg'))
     plt.close()
     
     return
 
 #2 pca2
-def plot_pca_expression_pc2_vs_pc3(your_data):
+def plot_pca_expression_pc2_vs_pc3(your_data, output_dir='.'):
     import numpy as np
     import matplotlib.pyplot as plt
-    from sklearn.preprocessing import StandardScaler
-    from sklearn.decomposition import PCA
-    from sklearn.pipeline import Pipeline
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data)
     
-    your_data_np = np.round(np.matrix(your_data.loc\
-     [:, your_data.columns != 'GENE_SYMBOL']), 4)
-    
-    pipeline = Pipeline([('scaling', StandardScaler()), ('pca', PCA(n_components=10))])
-    pca_data = pipeline.fit_transform(your_data_np.T)
-    explained_variance = np.var(pca_data, axis=0)/sum(np.var(pca_data, axis=0))
+    #scaled PCA(10), shared by both PCA plots
+    pca_data = dataset.pca_scores
+    explained_variance = dataset.explained_variance
     
     #1250 for lasso 500 for lesshub
     
@@ -137,54 +346,45 @@ def plot_pca_expression_pc2_vs_pc3(your_data):
 
     plt.rc('font', **font)
     
-    ax.scatter(rep1[:, 1], rep1[:, 2], alpha=0.7, s=75, marker='o', edgecolor ="black",
-                linewidths = 0.5, c='green')
-    ax.scatter(rep2[:, 1], rep2[:, 2], alpha=0.7, s=75, marker='^', edgecolor ="black",
-                linewidths = 0.5, c='blue')
-    plt.gca().legend(('rep1','rep2'), loc='upper right', shadow=True, ncol=2)
+    handles = draw_scatter_layers(ax,
+        [(rep1[:, 1], rep1[:, 2], 'rep1', dict(alpha=0.7, s=75, marker='o', edgecolor ="black",
+                linewidths = 0.5, c='green')),
+         (rep2[:, 1], rep2[:, 2], 'rep2', dict(alpha=0.7, s=75, marker='^', edgecolor ="black",
+                linewidths = 0.5, c='blue'))], dataset.render)
+    plt.gca().legend(handles=handles, loc='upper right', shadow=True, ncol=2)
     
     ax.set_xlabel(('PC2: '+ str(round(explained_variance[1], 2)*100)+'%'))
     ax.set_ylabel(('PC3: '+ str(round(explained_variance[2], 2)*100)+'%'))
     plt.title("PCA, -"+ str(len(rep1)) + " experiments")
     
-    fig.savefig(str(data_name)+'_plot_pca_expression_pc2_vs_pc3.svg')
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_plot_pca_expression_pc2_vs_pc3.svg'))
     plt.close()
     
     return
 
 #4 singular and eigenvals distribution
-def plot_singular_and_eigenvals_distr(your_data, reps=2):
+def plot_singular_and_eigenvals_distr(your_data, reps=2, output_dir='.'):
     import numpy as np
-    import scipy
     import matplotlib.pyplot as plt
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data, reps)
     
-    
-    your_data_np = np.round(np.matrix(your_data.loc\
-     [:, your_data.columns != 'GENE_SYMBOL']), 4)
-    
-    cols = int(your_data_np.shape[1]/reps)
-    rows = int(your_data_np.shape[0])
-    ind=0
-    
-    #2 svd distribution
-    svd_distr = scipy.linalg.svdvals(your_data_np)
-    svd_distr.sort()
-
-    reshaped_data = np.empty((rows,cols,reps))
-    list_eigen = np.empty((cols, reps))
-    for i in range(reps):
-        reshaped_data[:,:,i] = your_data_np[:,ind:cols]
-        eigvals_distr = scipy.linalg.eigvals(your_data_np[:,ind:cols])
-        list_eigen[:,i] = eigvals_distr
-        ind = ind+cols
-        cols = ind+cols
+    #2 svd distribution (top-k of large matrices, randomised)
+    svd_distr = dataset.singular_values
 
-    av_eigenvals = np.abs(np.mean(list_eigen, axis=1))
-    av_eigenvals.sort()
-    x = np.linspace(1,len(av_eigenvals),len(av_eigenvals))
+    #eigenvalues of the square replicate blocks, one batched call
+    try:
+        av_eigenvals = dataset.eigenvalue_spectrum(reps)
+    except ValueError:
+        #replicate blocks are not square: singular values only
+        av_eigenvals = None
+    num_x = len(svd_distr) if av_eigenvals is None else len(av_eigenvals)
+    x = np.linspace(1,num_x,num_x)
+    #truncated spectra: the largest values at the right end
+    x_svd = x[len(x)-len(svd_distr):] if len(svd_distr) <= len(x) else\
+        np.linspace(1,len(svd_distr),len(svd_distr))
     
     fig = plt.figure(figsize=(20,15))
     
@@ -194,49 +394,33 @@ def plot_singular_and_eigenvals_distr(your_data, reps=2):
 
     plt.rc('font', **font)
     
-    plt.plot(x, av_eigenvals, '-o')  # arguments are passed to np.histogram
-    plt.plot(x, svd_distr, '-ro')  # arguments are passed to np.histogram
-    plt.legend(["eigenvalues", "singular values"], loc='upper center',\
-           bbox_to_anchor=(0.5, 1.00), shadow=True, ncol=2)
+    if av_eigenvals is not None:
+        plt.plot(x, av_eigenvals, '-o', label="eigenvalues")
+    plt.plot(x_svd, svd_distr, '-ro', label="singular values")
+    plt.legend(loc='upper center', bbox_to_anchor=(0.5, 1.00), shadow=True, ncol=2)
     plt.title("Dimensionality")
     
-    fig.savefig(str(data_name)+'_plot_singular_and_eigenvals_distr.svg')
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_plot_singular_and_eigenvals_distr.svg'))
     plt.close()
     
     return
 
 
 #5 Standard Error (in expression between replicates) and Y-expression
-def plot_median_expression_vs_sd_error(your_data, reps=2):
+def plot_median_expression_vs_sd_error(your_data, reps=2, output_dir='.'):
     
     import numpy as np
     import matplotlib.pyplot as plt
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data, reps)
     
-    your_data_np = np.round(np.matrix(your_data.loc\
-     [:, your_data.columns != 'GENE_SYMBOL']), 4)
-    
-    cols = int(your_data_np.shape[1]/reps)
-    rows = int(your_data_np.shape[0])
-    ind=0
+    from data_exploration_streaming import replicate_moments
     
-    reshaped_data = np.empty((rows,cols,reps))
-    #list_eigen = np.empty((cols, reps))
-    
-    #reshaped_data = np.array(np.hsplit(your_data_np, reps))
-    if reps==2:
-        for i in range(reps):
-            reshaped_data[:,:,i] = your_data_np[:,ind:cols]
-            #eigvals_distr = scipy.linalg.eigvals(your_data_np[:,ind:cols])
-            #list_eigen[:,i] = eigvals_distr
-            ind = ind+cols
-            cols = ind+cols
-    
-
-    av_variance = np.var(reshaped_data, axis=2)
-    av_mean = np.mean(reshaped_data, axis=2)
+    #over a reshaped view of the replicate blocks (no stacked copy)
+    av_mean, av_variance = replicate_moments(dataset.matrix, reps)
+    cols = av_mean.shape[1]
     
     fig = plt.figure(figsize=(20,15))
     ax = fig.add_subplot(111)
@@ -247,7 +431,7 @@ def plot_median_expression_vs_sd_error(your_data, reps=2):
 
     plt.rc('font', **font)
     
-    plt.hist(av_mean.flatten(), bins=cols, color='b', alpha=0.4)  # arguments are passed to np.histogram
+    draw_histogram(ax, av_mean.flatten(), cols, dataset.render, color='b', alpha=0.4)
     
     plt.axvline(x = np.median(av_mean.flatten()), color = 'black', label = 'average var: '+' '+\
                 str(np.round(av_variance.mean(), decimals=4)))
@@ -257,46 +441,23 @@ def plot_median_expression_vs_sd_error(your_data, reps=2):
     plt.legend(loc='upper center', bbox_to_anchor=(0.5, 1.00), shadow=True, ncol=2)
     plt.title("logFC histogram and average variance")
     
-    fig.savefig(str(data_name)+'_plot_median_expression_vs_av_variance.svg')
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_plot_median_expression_vs_av_variance.svg'))
     plt.close()
     
     return
 
 
 #6. F-matrix score distribution // how much was performed the target gene in all experiments
-def plot_pert_score(your_data, reps=3):
-    import pandas as pd
-    import numpy as np
+def plot_pert_score(your_data, reps=3, output_dir='.'):
     import matplotlib.pyplot as plt
     from varname import nameof
     
     data_name = nameof(your_data)
+    dataset = ExplorationDataset.of(your_data, reps)
     
-    #get intended perturbation values
-    if reps==2:
-        step=your_data.shape[0]+1
-        rep1 = your_data.iloc[:,1:step]
-        rep2 = your_data.iloc[:,step:your_data.shape[1]]
-        real1 = pd.Series(np.diag(rep1), index=[rep1.index, rep1.columns])
-        real2 = pd.Series(np.diag(rep2), index=[rep2.index, rep2.columns])
-        real_all = real1.append(real2)
-    else:
-        step=your_data.shape[0]+1
-        rep1 = your_data.iloc[:,1:step]
-        rep2 = your_data.iloc[:,step:step+step-1]
-        rep3 = your_data.iloc[:,step+step-1:your_data.shape[1]]
-
-        real1 = pd.Series(np.diag(rep1), index=[rep1.index, rep1.columns])
-        real2 = pd.Series(np.diag(rep2), index=[rep2.index, rep2.columns])
-        real3 = pd.Series(np.diag(rep3), index=[rep3.index, rep3.columns])
-        real_all = real1.append(real2)
-        real_all = real_all.append(real3)
-    
-    #get most negative values
-    fmat_real = pd.DataFrame({'real_min': your_data.loc[:, your_data.columns != 'GENE_SYMBOL'].min()})
-    fmat_real['int_min'] = real_all.values
-    #calculate pert score
-    fmat_real['pert score'] = fmat_real['int_min']/fmat_real['real_min']
+    #on-target value / most negative value of each experiment (scores
+    #only: the partial sort finds the minimum)
+    pert_score = dataset.perturbation_ranks(1)['pert_score']
     
     
     #plot it 
@@ -307,19 +468,20 @@ def plot_pert_score(your_data, reps=3):
 
     plt.rc('font', **font)
     
-    plt.hist(fmat_real['pert score'], bins=your_data.shape[0]*3, color='b', alpha=0.4)
+    draw_histogram(plt.gca(), pert_score, dataset.matrix.shape[0]*3,\
+                   dataset.render, color='b', alpha=0.4)
     plt.title("Perturbation off-target score")
-    fig.savefig(str(data_name)+'_plot_pert_score.svg')
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_plot_pert_score.svg'))
     plt.close()
     
     return
 
-def calc_pert_rank(your_dataset, reps=2):
+def calc_pert_rank(your_dataset, reps=2, output_dir='.', max_rank=6):
     
-    from scipy.stats import rankdata as rd
     import matplotlib.pyplot as plt
     from varname import nameof
-    import numpy as np
+    
+    dataset = ExplorationDataset.of(your_dataset, reps)
     
     fig = plt.figure(figsize=(20,15))
     
@@ -329,81 +491,108 @@ def calc_pert_rank(your_dataset, reps=2):
 
     plt.rc('font', **font)
     
-    if reps==3:
-        pert_mat = np.concatenate((np.eye(your_dataset.shape[0]),
-                                   np.eye(your_dataset.shape[0])),\
-                                  axis=1)*(-1)   
+    #ranks 1..max_rank of the on-target genes (partial sort), % of experiments
+    rank_histogram = dataset.perturbation_ranks(max_rank)['rank_histogram']
+    rank_within_sought = rank_histogram[:max_rank]/dataset.matrix.shape[1]*100
     
-        pert_mat = np.concatenate((pert_mat, np.eye(your_dataset.shape[0])),\
-                                  axis=1)*(-1)   
-    else:
-        pert_mat = np.concatenate((np.eye(your_dataset.shape[0]),np.eye(your_dataset.shape[0])),axis=1)*(-1)
-    
-    rank_within_sought_r1 = 0
-    rank_within_sought_r2 = 0
-    rank_within_sought_r3 = 0
-    rank_within_sought_r4 = 0
-    rank_within_sought_r5 = 0
-    rank_within_sought_r6 = 0
-    
-    print(pert_mat.shape)
-    perts = np.nonzero(pert_mat)
-    your_dataset = np.round(np.matrix(your_dataset.loc\
-     [:, your_dataset.columns != 'GENE_SYMBOL']), 4)
-    data_rank = rd(your_dataset,axis=0,method='min')
-    
-    for i in range(data_rank.shape[1]):
-        if data_rank[perts[0][i],perts[1][i]] == 1:
-            rank_within_sought_r1 +=1
-        elif data_rank[perts[0][i],perts[1][i]] == 2:
-            rank_within_sought_r2 +=1
-        elif data_rank[perts[0][i],perts[1][i]] == 3:
-            rank_within_sought_r3 +=1
-        elif data_rank[perts[0][i],perts[1][i]] == 4:
-            rank_within_sought_r4 +=1
-        elif data_rank[perts[0][i],perts[1][i]] == 5:
-            rank_within_sought_r5 +=1
-        elif data_rank[perts[0][i],perts[1][i]] <= 6:
-            rank_within_sought_r6 +=1
-    
-    rank_within_sought = [rank_within_sought_r1,rank_within_sought_r2,rank_within_sought_r3,\
-                          rank_within_sought_r4,rank_within_sought_r5,rank_within_sought_r6]
-    rank_within_sought = list(map(lambda x: (x/data_rank.shape[1])*100, rank_within_sought))
-    
-    
-    names = ['1', '2', '3', "4", '5', '6']
+    
+    names = [str(rank) for rank in range(1, len(rank_within_sought)+1)]
     plt.bar(names, rank_within_sought, width=0.7, color=plt.get_cmap('tab20c').colors, edgecolor='k', 
         linewidth=2)
     plt.xlabel("ranks")
     plt.ylabel("pecrentage of experiments")
     
     data_name = nameof(your_dataset)
-    fig.savefig(str(data_name)+'_pert_ranks.svg')
-    plt.show()
+    fig.savefig(os.path.join(output_dir, str(data_name)+'_pert_ranks.svg'))
+    plt.close()
     
     return
 
+#plots of plot_all_explorative_plots: (function, takes reps)
+all_explorative_plots = [('plot_expression_clustergram', False),
+                         ('plot_pca_expression_pc1_vs_pc2', False),
+                         ('plot_pca_expression_pc2_vs_pc3', False),
+                         ('plot_singular_and_eigenvals_distr', True),
+                         ('plot_median_expression_vs_sd_error', True),
+                         ('plot_pert_score', True),
+                         ('calc_pert_rank', True)]
+
+
+#shared contexts of a plot worker, set by init_plot_worker
+worker_datasets = None
+
+
+def init_plot_worker(shared_datasets=None):
+    #non-interactive backend, before pyplot is imported
+    import matplotlib
+    matplotlib.use('Agg')
+    global worker_datasets
+    worker_datasets = shared_datasets
+
+
+def run_plot(plot_name, takes_reps, dataset_num, num_of_reps, path):
+    """
+    task: one plot of one (shared) dataset into path (no chdir)
+    """
+    your_dataset = worker_datasets[dataset_num]
+    if takes_reps:
+        globals()[plot_name](your_dataset, num_of_reps, output_dir=path)
+    else:
+        globals()[plot_name](your_dataset, output_dir=path)
+    return os.path.join(path, plot_name)
+
+
+def plot_all_datasets(datasets, output_dir, n_workers=None, render=None):
+    """
+    all explorative plots of several datasets in one process pool, one
+    task per plot.
+    datasets: (GS-format dataframe or ExplorationDataset, name,
+    number of replicates) each; plots go to output_dir/name. The
+    statistics shared by several plots are computed once per dataset
+    and sent once per worker (pool initializer), the matrices as .npy
+    files mapped by the workers.
+    """
+    import multiprocessing
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir) as shared_dir:
+        shared_datasets, jobs = [], []
+        for dataset_num, (your_dataset, cell_line_name, num_of_reps) in enumerate(datasets):
+            path = os.path.join(output_dir, cell_line_name)
+            print(path)
+            os.makedirs(path, exist_ok=True)
+            your_dataset = ExplorationDataset.of(your_dataset, num_of_reps)
+            if render is not None:
+                your_dataset.render = render
+            #shared statistics (PCA, dimensionality, ranks)
+            your_dataset.pca_scores
+            your_dataset.explained_variance
+            your_dataset.singular_values
+            try:
+                your_dataset.eigenvalue_spectrum(num_of_reps)
+            except ValueError:
+                #replicate blocks are not square, see the plot
+                pass
+            your_dataset.perturbation_ranks(1)
+            your_dataset.perturbation_ranks(6)
+            shared_datasets.append(your_dataset.shared\
+                (os.path.join(shared_dir, str(dataset_num)+'.npy')))
+            jobs += [(plot_name, takes_reps, dataset_num, num_of_reps, path)\
+                     for plot_name, takes_reps in all_explorative_plots]
+        
+        #spawned workers start without the parent's (interactive) backend
+        with ProcessPoolExecutor(n_workers, initializer=init_plot_worker,\
+                initargs=(shared_datasets,),\
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(run_plot, *job) for job in jobs]
+            return [future.result() for future in futures]
+
+
 #function to run all plots
-def plot_all_explorative_plots(your_dataset, output_dir, cell_line_name, num_of_reps):
-    import os
-    
-    home_dir = '/home/erik/sweden/sonnhammer/scripts'
-    directory = cell_line_name
-    path = os.path.join(output_dir, directory)
-    print(path)
-    if not os.path.exists(path):
-        os.mkdir(path)
-    os.chdir(path)
-    
-    #call all functions
-    plot_expression_clustergram(your_dataset)
-    plot_pca_expression_pc1_vs_pc2(your_dataset)
-    plot_pca_expression_pc2_vs_pc3(your_dataset)
-    #plot_singular_and_eigenvals_distr(your_dataset)
-    plot_median_expression_vs_sd_error(your_dataset, num_of_reps)
-    plot_pert_score(your_dataset, num_of_reps)
-    calc_pert_rank(your_dataset, num_of_reps)
-    
-    #return to script dir
-    os.chdir(home_dir)
-    return
\ No newline at end of file
+def plot_all_explorative_plots(your_dataset, output_dir, cell_line_name, num_of_reps,\
+                               render=None, n_workers=None):
+    
+    return plot_all_datasets([(your_dataset, cell_line_name, num_of_reps)],\
+                             output_dir, n_workers, render)
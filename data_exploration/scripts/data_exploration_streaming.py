@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out-of-core exploration statistics: the matrix is read in blocks of
+genes (csv or GeneSpiderBundle) and the per-gene, per-experiment and
+replicate statistics are updated incrementally, so QC of exports larger
+than memory runs in a fixed memory budget (blocks are sized from it).
+"""
+import numpy as np
+
+
+#bytes per value of a block: the float32 values, the parsed csv chunk
+#and the float64 temporaries of the moments and histograms
+BLOCK_BYTES_PER_VALUE = 32
+
+
+class RunningMoments:
+    """
+    count, mean and variance (ddof 0) updated block by block; block
+    moments are merged as in Welford's algorithm (Chan et al.), without
+    the cancellation of running sums of squares
+    """
+
+    def __init__(self, shape=()):
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+
+    def update(self, values, axis=0):
+        """merge the moments of values along axis (nan: missing)"""
+        count = np.sum(~np.isnan(values), axis=axis)
+        with np.errstate(invalid='ignore'):
+            mean = np.nan_to_num(np.nanmean(values, axis=axis))
+            M2 = np.nansum((values - np.expand_dims(mean, axis))**2, axis=axis)
+        total = self.count + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(total > 0, mean - self.mean, 0)
+            weight = np.where(total > 0, count/total, 0)
+        self.mean = self.mean + delta*weight
+        self.M2 = self.M2 + M2 + delta**2*self.count*weight
+        self.count = total
+        return self
+
+    @property
+    def variance(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.M2/self.count
+
+
+def replicate_view(values, reps):
+    """
+
+    Returns:
+      -replicate_blocks - genes x experiments of one replicate x reps,
+                          a view of values (no copy)
+    -------
+    Requires:
+      -values - genes x experiments, replicates as consecutive blocks
+      -reps - number of replicates
+
+    """
+    cols = values.shape[1]//reps
+    return np.moveaxis(values[:, :reps*cols].reshape(values.shape[0], reps, cols), 1, 2)
+
+
+def replicate_moments(values, reps):
+    """
+
+    Returns:
+      -av_mean, av_variance - mean and variance over the replicates,
+                              genes x experiments of one replicate
+    -------
+    Requires:
+      -values - genes x experiments, replicates as consecutive blocks;
+                reshaped as a view, no stacked copy
+      -reps - number of replicates
+
+    """
+    stacked = replicate_view(values, reps)
+    return stacked.mean(axis=2), stacked.var(axis=2)
+
+
+def streaming_statistics(file_name, reps=2, max_rank=6, bins=None,\
+                         memory_budget=1 << 29, median_bins=1 << 16, targets=None):
+    """
+
+    Returns:
+      -metrics - summary statistics, the keys of dataset_metrics
+                 (data_exploration_metrics); the decompositions need the
+                 whole matrix and are None, the rank histogram ends with
+                 the experiments beyond max_rank; json-serialisable dict
+      -experiment_metrics - per experiment: target, column minimum,
+                            on-target value, perturbation score,
+                            on-target rank (ranks beyond max_rank are
+                            max_rank+1), pd dataframe
+      -gene_metrics - per gene: mean and variance over the experiments,
+                      pd dataframe
+    -------
+    Requires:
+      -file_name - GeneSpider Y matrix, csv/tsv or GeneSpiderBundle (.gsb)
+      -reps - number of replicates
+      -max_rank - on-target ranks kept (the max_rank smallest values of
+                  each experiment are kept while streaming)
+      -bins - bins of the replicate mean histogram (default: experiments
+              of one replicate, as the plot)
+      -memory_budget - bytes for a block and its temporaries; blocks
+                       have max(1, memory_budget // (experiments x
+                       BLOCK_BYTES_PER_VALUE)) genes, so the full L1000
+                       export is read a few genes at a time
+      -median_bins - bins of the histogram the median is read from
+      -targets - on-target gene (row index or label) of each experiment,
+                 None for square replicate blocks
+
+    Two passes over the file: the first one collects the gene labels,
+    gene moments, column minima and the range of the replicate means; the
+    second one the on-target values, the smallest values of each
+    experiment and the histograms. Besides the block, memory is
+    (max_rank + 8) x experiments float64 (running minima, smallest values,
+    per experiment results) and the gene labels and moments; with more
+    experiments than memory_budget/BLOCK_BYTES_PER_VALUE a single gene
+    exceeds the budget.
+    """
+    import pandas as pd
+    from data_exploration_loader import iter_expression_blocks, expression_header
+    from data_exploration_perturbation import perturbation_targets
+
+    experiments = expression_header(file_name)
+    num_experiments = len(experiments)
+    block_rows = max(1, memory_budget//(num_experiments*BLOCK_BYTES_PER_VALUE))
+
+    #pass 1
+    gene_blocks, gene_means, gene_variances = [], [], []
+    replicate_variance = RunningMoments()
+    column_min = np.full(num_experiments, np.inf)
+    mean_range = [np.inf, -np.inf]
+    for genes, values in iter_expression_blocks(file_name, block_rows):
+        gene_blocks.append(genes)
+        gene_moments = RunningMoments(len(genes)).update(values, axis=1)
+        gene_means.append(gene_moments.mean)
+        gene_variances.append(gene_moments.variance)
+        column_min = np.fmin(column_min, np.nanmin(values, axis=0))
+        av_mean, av_variance = replicate_moments(values, reps)
+        replicate_variance.update(av_variance.reshape(-1))
+        mean_range = [min(mean_range[0], np.nanmin(av_mean)),\
+                      max(mean_range[1], np.nanmax(av_mean))]
+    genes = np.concatenate(gene_blocks)
+    num_genes = len(genes)
+    max_rank = min(max_rank, num_genes)
+    targets = perturbation_targets(num_genes, num_experiments, targets, genes)
+
+    #pass 2
+    bins = bins or num_experiments//reps
+    mean_histogram = np.zeros(bins, dtype=np.int64)
+    median_histogram = np.zeros(median_bins, dtype=np.int64)
+    on_target = np.full(num_experiments, np.nan)
+    smallest = np.full((max_rank, num_experiments), np.inf)
+    start = 0
+    for _, values in iter_expression_blocks(file_name, block_rows):
+        in_block = (targets >= start) & (targets < start+len(values))
+        on_target[in_block] = values[targets[in_block]-start, np.nonzero(in_block)[0]]
+        av_mean = replicate_view(values, reps).mean(axis=2)
+        mean_histogram += np.histogram(av_mean, bins, range=mean_range)[0]
+        median_histogram += np.histogram(av_mean, median_bins, range=mean_range)[0]
+        start += len(values)
+        #running max_rank smallest values (unordered) of each experiment:
+        #the block is partitioned in place (last use), only its max_rank
+        #smallest rows are merged
+        if len(values) > max_rank:
+            values.partition(max_rank-1, axis=0)
+        smallest = np.partition(np.concatenate([smallest, values[:max_rank]]),\
+                                max_rank-1, axis=0)[:max_rank]
+
+    with np.errstate(invalid='ignore'):
+        ranks = np.where(on_target <= smallest.max(axis=0),\
+                         (smallest < on_target[None, :]).sum(axis=0) + 1, max_rank + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pert_score = on_target/column_min
+    rank_histogram = np.bincount(ranks, minlength=max_rank+2)[1:max_rank+2]
+
+    #median of the replicate means, to the width of a median_bins bin
+    edges = np.linspace(mean_range[0], mean_range[1], median_bins+1)
+    cumulative = np.cumsum(median_histogram)
+    median_bin = np.searchsorted(cumulative, cumulative[-1]/2)
+    median_expression = float((edges[median_bin]+edges[median_bin+1])/2)
+
+    metrics = {'genes': num_genes, 'experiments': num_experiments, 'replicates': reps,\
+               'explained_variance': None, 'singular_values': None,\
+               'eigenvalues': None,\
+               'replicate_variance':\
+                   {'median_expression': median_expression,\
+                    'average_variance': float(replicate_variance.mean),\
+                    'expression_histogram':\
+                        {'counts': mean_histogram.tolist(),\
+                         'edges': np.linspace(mean_range[0], mean_range[1],\
+                                              bins+1).tolist()}},\
+               'on_target_rank_percent':\
+                   dict(zip(map(str, range(1, max_rank+1)),\
+                            (rank_histogram[:max_rank]/num_experiments*100).tolist())),\
+               'on_target_rank_histogram': rank_histogram.tolist()}
+
+    experiment_metrics = pd.DataFrame({'experiment': experiments, 'target': genes[targets],\
+                                       'real_min': column_min, 'int_min': on_target,\
+                                       'pert_score': pert_score, 'on_target_rank': ranks})
+    gene_metrics = pd.DataFrame({'gene': genes, 'mean': np.concatenate(gene_means),\
+                                 'variance': np.concatenate(gene_variances)})
+    return metrics, experiment_metrics, gene_metrics